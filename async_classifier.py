@@ -0,0 +1,131 @@
+import time
+import uuid
+import asyncio
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class RateWindow:
+    # Requests and tokens sent with one API key over the last minute. Only touched from the
+    # event loop thread, so it needs no lock.
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.events = deque()  # [sent_at, tokens] per request
+        self.tokens = 0
+
+    def _trim(self, now):
+        while self.events and now - self.events[0][0] >= 60:
+            self.tokens -= self.events.popleft()[1]
+
+    async def acquire(self, tokens):
+        # Waits until the request fits both budgets; a request bigger than the whole token
+        # budget still goes once the window is empty
+        while True:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self.events) < self.requests_per_minute and (
+                    not self.events or self.tokens + tokens <= self.tokens_per_minute):
+                event = [now, tokens]
+                self.events.append(event)
+                self.tokens += tokens
+                return event
+            await asyncio.sleep(max(self.events[0][0] + 60 - now, 0.05))
+
+    def settle(self, event, actual_tokens):
+        # Replaces the estimate with the usage OpenAI reported, while it is still in the window
+        if event in self.events:
+            self.tokens += actual_tokens - event[1]
+            event[1] = actual_tokens
+
+class AsyncClassifier:
+    # Runs chat.completions requests for the synchronous /classify path on one background
+    # event loop, with a pooled AsyncOpenAI client and a rate window per API key, so many
+    # small jobs share connections and stay inside each key's RPM/TPM limits.
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.loop = None
+        self.start_lock = threading.Lock()
+        self.clients = {}
+        self.windows = {}
+        self.semaphore = None
+
+    def _ensure_loop(self):
+        with self.start_lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='async_classifier', daemon=True).start()
+                self.semaphore = asyncio.run_coroutine_threadsafe(self._make_semaphore(), loop).result()
+                self.loop = loop
+
+    async def _make_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    def _client(self, key_id, secret):
+        if key_id not in self.clients:
+            from openai import AsyncOpenAI  # Deferred with the other OpenAI imports
+            self.clients[key_id] = AsyncOpenAI(api_key=secret)
+        return self.clients[key_id]
+
+    def _window(self, key_id):
+        if key_id not in self.windows:
+            self.windows[key_id] = RateWindow(self.requests_per_minute, self.tokens_per_minute)
+        return self.windows[key_id]
+
+    def classify(self, key_id, secret, requests, on_result, on_sent=None, breaker=None):
+        # requests are (custom_id, body, estimated_tokens). on_result receives one batch-style
+        # output line per request as it finishes and on_sent is called as each is sent, both
+        # on the loop thread. Returns a concurrent Future; cancelling it stops unsent requests.
+        # With the key's upstream circuit breaker, each request is admitted and recorded by it,
+        # and requests it turns away answer 503 without being sent.
+        self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self._classify_all(key_id, secret, requests, on_result, on_sent, breaker), self.loop)
+
+    async def _classify_all(self, key_id, secret, requests, on_result, on_sent, breaker):
+        await asyncio.gather(*(self._classify_one(key_id, secret, custom_id, body, estimated_tokens,
+                                                  on_result, on_sent, breaker)
+                               for custom_id, body, estimated_tokens in requests))
+
+    async def _classify_one(self, key_id, secret, custom_id, body, estimated_tokens, on_result, on_sent, breaker):
+        client = self._client(key_id, secret)
+        window = self._window(key_id)
+        result = {'id': f"classify_req_{uuid.uuid4().hex}", 'custom_id': custom_id}
+        async with self.semaphore:
+            event = await window.acquire(estimated_tokens)
+            try:
+                if breaker:
+                    breaker.before_call()
+            except Exception as e:
+                logger.warning(f"Classify request {custom_id} not sent: {str(e)}")
+                result['response'] = {'status_code': 503, 'body': None}
+                result['error'] = {'message': str(e)}
+                on_result(result)
+                return
+            if on_sent:
+                on_sent(key_id)
+            try:
+                completion = await client.chat.completions.create(**body)
+                if breaker:
+                    breaker.record()
+                if completion.usage:
+                    window.settle(event, completion.usage.total_tokens)
+                result['response'] = {'status_code': 200, 'body': completion.model_dump()}
+                result['error'] = None
+            except asyncio.CancelledError:
+                # Cut off by the caller, not by OpenAI, so it says nothing about the key
+                if breaker:
+                    breaker.release_probe()
+                raise
+            except Exception as e:
+                if breaker:
+                    breaker.record(e)
+                logger.warning(f"Classify request {custom_id} failed: {str(e)}")
+                status_code = getattr(e, 'status_code', None)
+                result['response'] = {'status_code': status_code, 'body': None} if status_code else None
+                result['error'] = {'message': str(e)}
+        on_result(result)
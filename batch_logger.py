@@ -2,98 +2,369 @@ import json
 import time
 import queue
 import threading
-import psycopg2
-from psycopg2 import sql
 import os
 import logging
+import db_instrumentation
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
+BATCH_LOGS_DDL = '''
+    CREATE TABLE IF NOT EXISTS batch_logs (
+        id SERIAL PRIMARY KEY,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        batch_id TEXT,
+        status TEXT,
+        user_token TEXT,
+        total_requests INTEGER,
+        completed_requests INTEGER,
+        failed_requests INTEGER,
+        created_at TIMESTAMP,
+        completed_at TIMESTAMP,
+        input_file_id TEXT,
+        output_file_id TEXT,
+        remaining_balance INTEGER,
+        completion_window TEXT,
+        endpoint TEXT,
+        metadata TEXT,
+        processing_rate FLOAT,
+        overall_processing_rate FLOAT,
+        estimated_remaining_time FLOAT,
+        total_elapsed_time FLOAT
+    )
+'''
+
+# Added once status logging became change-only: sample_count is how many polls a
+# compacted row stands for, and the index serves the last-logged-state lookup
+BATCH_LOGS_COMPACTION_DDL = [
+    'ALTER TABLE batch_logs ADD COLUMN IF NOT EXISTS sample_count INTEGER DEFAULT 1',
+    'CREATE INDEX IF NOT EXISTS batch_logs_batch_id_timestamp_idx ON batch_logs (batch_id, timestamp)',
+]
+
+BATCH_STATS_DDL = [
+    '''CREATE TABLE IF NOT EXISTS batch_stats (
+        period TEXT,
+        user_token TEXT,
+        bucket TIMESTAMP,
+        batches_created INTEGER DEFAULT 0,
+        batches_completed INTEGER DEFAULT 0,
+        requests_completed INTEGER DEFAULT 0,
+        requests_failed INTEGER DEFAULT 0,
+        tokens_debited INTEGER DEFAULT 0,
+        PRIMARY KEY (period, user_token, bucket)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS batch_stats_ttc (
+        period TEXT,
+        user_token TEXT,
+        bucket TIMESTAMP,
+        ttc_bucket INTEGER,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (period, user_token, bucket, ttc_bucket)
+    )''',
+]
+
+BATCH_LOGS_PARTITION_MONTHS_AHEAD = 2
+
+def batch_logs_partitions_sql(months_ahead=BATCH_LOGS_PARTITION_MONTHS_AHEAD):
+    # Creates the monthly partitions of batch_logs from the current month to months_ahead
+    # months out, named batch_logs_yYYYYmMM; safe to run any number of times
+    return f'''
+        DO $$
+        DECLARE month_start TIMESTAMP;
+        BEGIN
+            FOR i IN 0..{int(months_ahead)} LOOP
+                month_start := date_trunc('month', now()) + make_interval(months => i);
+                EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF batch_logs FOR VALUES FROM (%L) TO (%L)',
+                               'batch_logs_' || to_char(month_start, '"y"YYYY"m"MM'),
+                               month_start, month_start + interval '1 month');
+            END LOOP;
+        END $$
+    '''
+
+# Turns batch_logs into a table range-partitioned by month on timestamp, so recent months'
+# rows and indexes stay small and hot. The existing table becomes the partition holding
+# everything before the current month; only the current month's rows are copied, into
+# their new partition, since attaching fails while the old table holds any of them.
+BATCH_LOGS_PARTITIONING_DDL = [
+    "UPDATE batch_logs SET timestamp = COALESCE(created_at, 'epoch') WHERE timestamp IS NULL",
+    'ALTER TABLE batch_logs RENAME TO batch_logs_legacy',
+    # Replaced by the partitioned table's (id, timestamp) key, which attaching builds on it
+    'ALTER TABLE batch_logs_legacy DROP CONSTRAINT batch_logs_pkey',
+    'ALTER INDEX batch_logs_batch_id_timestamp_idx RENAME TO batch_logs_legacy_batch_id_timestamp_idx',
+    'ALTER TABLE batch_logs_legacy ALTER COLUMN timestamp SET NOT NULL',
+    'CREATE TABLE batch_logs (LIKE batch_logs_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)',
+    'ALTER SEQUENCE batch_logs_id_seq OWNED BY batch_logs.id',
+    # Unique keys of a partitioned table must include the partition key
+    'ALTER TABLE batch_logs ADD PRIMARY KEY (id, timestamp)',
+    'CREATE INDEX batch_logs_batch_id_timestamp_idx ON batch_logs (batch_id, timestamp)',
+    batch_logs_partitions_sql(),
+    '''WITH moved AS (
+           DELETE FROM batch_logs_legacy WHERE timestamp >= date_trunc('month', now()) RETURNING *)
+       INSERT INTO batch_logs SELECT * FROM moved''',
+    "ALTER TABLE batch_logs ATTACH PARTITION batch_logs_legacy FOR VALUES FROM (MINVALUE) TO (date_trunc('month', now()))",
+]
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+ALL_USERS = '*'  # user_token of the rollup rows that total every user
+ROLLUP_PERIODS = ('minute', 'day')
+HEARTBEAT_SECONDS = 300  # An unchanged batch is still logged this often
+LAST_LOGGED_MAX = 10000  # Batches whose last logged state is kept in memory
+
+# Upper bounds (seconds) of the time-to-complete histogram; the last bucket is open-ended
+TTC_BUCKET_BOUNDS = [30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400]
+
+def to_timestamp(value):
+    # OpenAI reports times as Unix timestamps; the log tables store TIMESTAMPs
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return value
+
+def rollup_buckets(at):
+    yield 'minute', at.replace(second=0, microsecond=0)
+    yield 'day', at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def ttc_bucket(seconds):
+    for index, bound in enumerate(TTC_BUCKET_BOUNDS):
+        if seconds <= bound:
+            return index
+    return len(TTC_BUCKET_BOUNDS)
+
+def ttc_percentile(histogram, fraction):
+    # histogram maps ttc_bucket -> count; returns the bucket's upper bound in seconds
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for index in sorted(histogram):
+        seen += histogram[index]
+        if seen >= fraction * total:
+            return TTC_BUCKET_BOUNDS[min(index, len(TTC_BUCKET_BOUNDS) - 1)]
+    return TTC_BUCKET_BOUNDS[-1]
+
 class BatchLogger:
-    def __init__(self):
+    # Nothing touches the database or starts a thread until the first log call.
+    # Pass create_table=False when the batch_logs table is managed by migrations.
+    def __init__(self, create_table=True, heartbeat_seconds=HEARTBEAT_SECONDS):
         self.log_queue = queue.Queue()
-        self.worker_thread = threading.Thread(target=self._log_worker, daemon=True)
-        self.worker_thread.start()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.last_logged = OrderedDict()  # batch_id -> (state, logged_at), least recently used first
+        self.worker_thread = None
+        self.start_lock = threading.Lock()
         self.lock = threading.Lock()
         self.DATABASE_URL = os.environ.get('DATABASE_URL')
-        self._create_table()
+        self.table_ready = not create_table
+
+    def _connect(self):
+        import psycopg2  # Deferred so importing this module stays cheap
+        return db_instrumentation.connect(psycopg2.connect, self.DATABASE_URL)
+
+    def _ensure_worker(self):
+        if self.worker_thread is not None:
+            return
+        with self.start_lock:
+            if self.worker_thread is None:
+                self.worker_thread = threading.Thread(target=self._log_worker, daemon=True)
+                self.worker_thread.start()
 
     def _create_table(self):
         logger.info("Creating batch_logs table if it doesn't exist")
-        conn = psycopg2.connect(self.DATABASE_URL)
+        conn = self._connect()
         c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS batch_logs (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                batch_id TEXT,
-                status TEXT,
-                user_token TEXT,
-                total_requests INTEGER,
-                completed_requests INTEGER,
-                failed_requests INTEGER,
-                created_at TIMESTAMP,
-                completed_at TIMESTAMP,
-                input_file_id TEXT,
-                output_file_id TEXT,
-                remaining_balance INTEGER,
-                completion_window TEXT,
-                endpoint TEXT,
-                metadata TEXT,
-                processing_rate FLOAT,
-                overall_processing_rate FLOAT,
-                estimated_remaining_time FLOAT,
-                total_elapsed_time FLOAT
-            )
-        ''')
+        c.execute(BATCH_LOGS_DDL)
+        for statement in BATCH_LOGS_COMPACTION_DDL + BATCH_STATS_DDL:
+            c.execute(statement)
         conn.commit()
         conn.close()
+        self.table_ready = True
         logger.info("batch_logs table created or already exists")
 
-    def log_batch_status(self, batch_id, status, user_token):
-        self.log_queue.put((batch_id, status, user_token))
+    def log_batch_status(self, batch_id, status, user_token, previous_status=None):
+        # previous_status is the stored status this refresh replaced, as read under the batch
+        # job's row lock; it lets the rollups count a batch's terminal transition exactly once
+        self._ensure_worker()
+        self.log_queue.put((self._write_log, (batch_id, status, user_token, previous_status)))
+
+    def log_batch_created(self, batch_id, user_token, num_requests):
+        self._ensure_worker()
+        self.log_queue.put((self._write_created, (batch_id, user_token, num_requests, datetime.now())))
 
     def _log_worker(self):
         while True:
-            batch_id, status, user_token = self.log_queue.get()
-            self._write_log(batch_id, status, user_token)
+            write, args = self.log_queue.get()
+            try:
+                write(*args)
+            except Exception as e:
+                logger.error(f"Failed to write batch log for {args[0]}: {str(e)}")
             self.log_queue.task_done()
 
-    def _write_log(self, batch_id, status, user_token):
+    def _write_created(self, batch_id, user_token, num_requests, created_at):
         with self.lock:
-            conn = psycopg2.connect(self.DATABASE_URL)
+            conn = self._connect()
             c = conn.cursor()
+            self._bump_rollups(c, user_token, created_at, batches_created=1, tokens_debited=num_requests)
+            conn.commit()
+            conn.close()
+
+    def _write_log(self, batch_id, status, user_token, previous_status=None):
+        with self.lock:
+            if not self.table_ready:
+                self._create_table()
+            conn = self._connect()
+            c = conn.cursor()
+
+            # Only write a row when the status or request counts changed, or as a heartbeat
+            counts = status['request_counts']
+            state = (status['status'], counts['total'], counts['completed'], counts['failed'])
+            logged = self._should_log(c, batch_id, state)
+            if logged:
+                c.execute('''
+                    INSERT INTO batch_logs (
+                        batch_id, status, user_token, total_requests, completed_requests, 
+                        failed_requests, created_at, completed_at, input_file_id, output_file_id,
+                        remaining_balance, completion_window, endpoint, metadata, processing_rate,
+                        overall_processing_rate, estimated_remaining_time, total_elapsed_time
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ''', (
+                    batch_id,
+                    status['status'],
+                    user_token,
+                    status['request_counts']['total'],
+                    status['request_counts']['completed'],
+                    status['request_counts']['failed'],
+                    to_timestamp(status['created_at']),
+                    to_timestamp(status.get('completed_at')),
+                    status['input_file_id'],
+                    status.get('output_file_id'),
+                    status.get('remaining_balance'),
+                    status['completion_window'],
+                    status['endpoint'],
+                    json.dumps(status.get('metadata', {})),
+                    status.get('processing_rate', 0),
+                    status.get('overall_processing_rate', 0),
+                    status.get('estimated_remaining_time', 0),
+                    status.get('total_elapsed_time', 0)
+                ))
+
+            # Roll the terminal transition into the aggregates in the same transaction
+            if (previous_status is not None and status['status'] in TERMINAL_STATUSES
+                    and previous_status not in TERMINAL_STATUSES):
+                created_at = to_timestamp(status['created_at'])
+                finished_at = to_timestamp(status.get('completed_at')) or datetime.now()
+                completed = status['status'] == 'completed'
+                self._bump_rollups(
+                    c, user_token, finished_at,
+                    batches_completed=1 if completed else 0,
+                    requests_completed=status['request_counts']['completed'],
+                    requests_failed=status['request_counts']['failed'],
+                    ttc_seconds=(finished_at - created_at).total_seconds() if completed else None
+                )
             
-            # Insert the log entry
+            conn.commit()
+            conn.close()
+            if logged:
+                self._remember(batch_id, state, datetime.now())
+
+    def _should_log(self, c, batch_id, state):
+        last = self.last_logged.get(batch_id)
+        if last is None:
+            # First poll since startup (or evicted): seed from the newest stored row
             c.execute('''
-                INSERT INTO batch_logs (
-                    batch_id, status, user_token, total_requests, completed_requests, 
-                    failed_requests, created_at, completed_at, input_file_id, output_file_id,
-                    remaining_balance, completion_window, endpoint, metadata, processing_rate,
-                    overall_processing_rate, estimated_remaining_time, total_elapsed_time
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                batch_id,
-                status['status'],
-                user_token,
-                status['request_counts']['total'],
-                status['request_counts']['completed'],
-                status['request_counts']['failed'],
-                status['created_at'],
-                status.get('completed_at'),
-                status['input_file_id'],
-                status.get('output_file_id'),
-                status.get('remaining_balance'),
-                status['completion_window'],
-                status['endpoint'],
-                json.dumps(status.get('metadata', {})),
-                status.get('processing_rate', 0),
-                status.get('overall_processing_rate', 0),
-                status.get('estimated_remaining_time', 0),
-                status.get('total_elapsed_time', 0)
-            ))
-            
+                SELECT status, total_requests, completed_requests, failed_requests, timestamp
+                FROM batch_logs WHERE batch_id = %s
+                ORDER BY timestamp DESC LIMIT 1
+            ''', (batch_id,))
+            row = c.fetchone()
+            if row is None:
+                return True
+            last = (tuple(row[:4]), row[4])
+            self._remember(batch_id, *last)
+        last_state, logged_at = last
+        if last_state != state:
+            return True
+        return datetime.now() - logged_at >= timedelta(seconds=self.heartbeat_seconds)
+
+    def _remember(self, batch_id, state, logged_at):
+        self.last_logged[batch_id] = (state, logged_at)
+        self.last_logged.move_to_end(batch_id)
+        while len(self.last_logged) > LAST_LOGGED_MAX:
+            self.last_logged.popitem(last=False)
+
+    def compact(self, older_than_days):
+        # Collapse rows older than the cutoff to one row per distinct state of each batch.
+        # The newest row of each group is kept and its sample_count sums the group's.
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        with self.lock:
+            if not self.table_ready:
+                self._create_table()
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute('''
+                WITH groups AS (
+                    SELECT batch_id, status, total_requests, completed_requests, failed_requests,
+                           MAX(id) AS keep_id, SUM(COALESCE(sample_count, 1)) AS samples
+                    FROM batch_logs
+                    WHERE timestamp < %s
+                    GROUP BY batch_id, status, total_requests, completed_requests, failed_requests
+                    HAVING COUNT(*) > 1
+                ), summarized AS (
+                    UPDATE batch_logs SET sample_count = groups.samples
+                    FROM groups WHERE batch_logs.id = groups.keep_id
+                    RETURNING batch_logs.id
+                )
+                DELETE FROM batch_logs
+                USING groups
+                WHERE batch_logs.timestamp < %s
+                  AND batch_logs.id <> groups.keep_id
+                  AND batch_logs.batch_id IS NOT DISTINCT FROM groups.batch_id
+                  AND batch_logs.status IS NOT DISTINCT FROM groups.status
+                  AND batch_logs.total_requests IS NOT DISTINCT FROM groups.total_requests
+                  AND batch_logs.completed_requests IS NOT DISTINCT FROM groups.completed_requests
+                  AND batch_logs.failed_requests IS NOT DISTINCT FROM groups.failed_requests
+            ''', (cutoff, cutoff))
+            deleted = c.rowcount
             conn.commit()
             conn.close()
+        logger.info(f"Compacted batch_logs older than {cutoff}: removed {deleted} rows")
+        return deleted
+
+    def ensure_partitions(self, months_ahead=BATCH_LOGS_PARTITION_MONTHS_AHEAD):
+        # Creates upcoming monthly partitions ahead of the writes that need them. A plain
+        # (unpartitioned) batch_logs, as created with create_table=True, is left alone.
+        with self.lock:
+            if not self.table_ready:
+                self._create_table()
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('batch_logs')")
+            if c.fetchone():
+                c.execute(batch_logs_partitions_sql(months_ahead))
+                conn.commit()
+                logger.info(f"batch_logs partitions ensured {months_ahead} months ahead")
+            conn.close()
 
-batch_logger = BatchLogger()
+    def _bump_rollups(self, c, user_token, at, batches_created=0, batches_completed=0,
+                      requests_completed=0, requests_failed=0, tokens_debited=0, ttc_seconds=None):
+        # Each event updates the minute and day buckets, for the user and for the '*' total
+        for period, bucket in rollup_buckets(at):
+            for token in (user_token, ALL_USERS):
+                c.execute('''
+                    INSERT INTO batch_stats (
+                        period, user_token, bucket, batches_created, batches_completed,
+                        requests_completed, requests_failed, tokens_debited
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (period, user_token, bucket) DO UPDATE SET
+                        batches_created = batch_stats.batches_created + EXCLUDED.batches_created,
+                        batches_completed = batch_stats.batches_completed + EXCLUDED.batches_completed,
+                        requests_completed = batch_stats.requests_completed + EXCLUDED.requests_completed,
+                        requests_failed = batch_stats.requests_failed + EXCLUDED.requests_failed,
+                        tokens_debited = batch_stats.tokens_debited + EXCLUDED.tokens_debited
+                ''', (period, token, bucket, batches_created, batches_completed,
+                      requests_completed, requests_failed, tokens_debited))
+                if ttc_seconds is not None:
+                    c.execute('''
+                        INSERT INTO batch_stats_ttc (period, user_token, bucket, ttc_bucket, count)
+                        VALUES (%s, %s, %s, %s, 1)
+                        ON CONFLICT (period, user_token, bucket, ttc_bucket) DO UPDATE SET
+                            count = batch_stats_ttc.count + 1
+                    ''', (period, token, bucket, ttc_bucket(ttc_seconds)))
@@ -0,0 +1,106 @@
+import gzip
+import zlib
+import logging
+from werkzeug.wsgi import LimitedStream, get_content_length
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional; gzip always works
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Encodings we can decode, in order of preference when compressing responses
+SUPPORTED_ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/csv')
+MIN_COMPRESS_BYTES = 1024
+CHUNK_SIZE = 64 * 1024
+
+def decompressing_stream(fileobj, encoding):
+    # Wrap a readable byte stream so reads return decoded data, without buffering it all
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+def encoding_for_filename(filename):
+    # Compressed upload parts are named like 'shard.jsonl.gz' or 'shard.jsonl.zst'
+    if filename.endswith('.gz'):
+        return 'gzip', filename[:-len('.gz')]
+    if filename.endswith('.zst'):
+        return 'zstd', filename[:-len('.zst')]
+    return None, filename
+
+def compress_bytes(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+def gzip_chunks(path):
+    # Stream a file through gzip in chunks, for building cached compressed copies
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+def choose_encoding(accept_encodings):
+    # accept_encodings is werkzeug's parsed Accept-Encoding header
+    for encoding in SUPPORTED_ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+def compress_response(response, accept_encodings):
+    # after_request helper: compress buffered JSON/text bodies the client can decode
+    # Streamed bodies are left alone: buffering them here would defeat the streaming
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+
+    response.set_data(compress_bytes(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+class DecompressRequestMiddleware:
+    # Decodes request bodies sent with Content-Encoding: gzip/zstd before Flask
+    # parses them, so multipart uploads can be compressed as a whole on the wire
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            if encoding not in SUPPORTED_ENCODINGS:
+                logger.warning(f"Rejected request with unsupported Content-Encoding: {encoding}")
+                start_response('415 Unsupported Media Type', [('Content-Type', 'text/plain')])
+                return [f"Unsupported Content-Encoding: {encoding}".encode()]
+
+            content_length = get_content_length(environ)
+            stream = environ['wsgi.input']
+            if content_length is not None:
+                stream = LimitedStream(stream, content_length)
+            environ['wsgi.input'] = decompressing_stream(stream, encoding)
+            # The decoded length is unknown; the decoder marks the end of the body
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            environ.pop('HTTP_CONTENT_ENCODING', None)
+        return self.wsgi_app(environ, start_response)
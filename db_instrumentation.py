@@ -0,0 +1,374 @@
+import re
+import sys
+import time
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Prefix that asks each database for the plan of a statement without running it
+EXPLAIN_PREFIXES = {
+    'postgres': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+EXPLAIN_INTERVAL_SECONDS = 5 * 60  # A slow statement's plan is logged at most this often
+MAX_FINGERPRINTS = 1000  # Statements seen after this many are counted under OTHER
+OTHER = '<other>'
+CONNECTION_HELPERS = ('get_db_connection', '_connect')  # Attributed to whoever called them
+FINGERPRINT_CACHE_SIZE = 2000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\?")
+_TUPLE = re.compile(r"\((?:\s*(?:\?|NULL|TRUE|FALSE)(?:::\w+)?\s*,?)+\)", re.IGNORECASE)
+_TUPLES = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+_fingerprints = {}
+
+def fingerprint(query):
+    # The statement with literals and placeholders replaced by ?, value lists folded to (...)
+    # and whitespace collapsed, so every call of a db_* helper lands on the same entry
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    cached = _fingerprints.get(query)
+    if cached is not None:
+        return cached
+    normalized = _STRING.sub('?', query)
+    normalized = _NUMBER.sub('?', normalized)
+    normalized = _PLACEHOLDER.sub('?', normalized)
+    normalized = _TUPLE.sub('(...)', normalized)
+    normalized = _TUPLES.sub('(...)', normalized)
+    normalized = _WHITESPACE.sub(' ', normalized).strip()
+    # execute_values inlines its rows, so those statements are never worth caching
+    if len(query) < 4096:
+        if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[query] = normalized
+    return normalized
+
+def caller_name():
+    # Nearest db_* function on the stack, or else the first function outside this module
+    frame = sys._getframe(1)
+    first = None
+    while frame is not None:
+        if frame.f_globals.get('__name__') != __name__:
+            name = frame.f_code.co_name
+            if name.startswith('db_'):
+                return name
+            if first is None and name not in CONNECTION_HELPERS:
+                first = name
+        frame = frame.f_back
+    return first or '?'
+
+class StatementStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.slow = 0
+        self.execute_seconds = 0.0
+        self.execute_max = 0.0
+        self.fetch_seconds = 0.0
+
+    def snapshot(self, caller, statement):
+        total = self.execute_seconds + self.fetch_seconds
+        return {
+            'caller': caller,
+            'statement': statement,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'slow': self.slow,
+            'execute_total_ms': round(self.execute_seconds * 1000, 2),
+            'execute_mean_ms': round(self.execute_seconds * 1000 / self.calls, 2) if self.calls else None,
+            'execute_max_ms': round(self.execute_max * 1000, 2),
+            'fetch_total_ms': round(self.fetch_seconds * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+            'mean_ms': round(total * 1000 / self.calls, 2) if self.calls else None,
+        }
+
+class ConnectStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+
+    def snapshot(self, caller):
+        return {
+            'caller': caller,
+            'connects': self.count,
+            'total_ms': round(self.seconds * 1000, 2),
+            'mean_ms': round(self.seconds * 1000 / self.count, 2) if self.count else None,
+            'max_ms': round(self.max * 1000, 2),
+        }
+
+SNAPSHOT_ORDERS = {
+    'total': lambda entry: entry['total_ms'],
+    'mean': lambda entry: entry['mean_ms'] or 0,
+    'max': lambda entry: entry['execute_max_ms'],
+    'calls': lambda entry: entry['calls'],
+}
+
+class DbInstrumentation:
+    # Timings of the storage layer per (db_* helper, statement fingerprint): connects,
+    # executes and fetches. Statements slower than slow_query_ms are logged with their
+    # plan. While disabled, connect() hands back the driver's own connection untouched,
+    # so the only cost is one attribute check per connection.
+    def __init__(self, enabled=False, slow_query_ms=200, explain=True):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.explain = explain
+        self.lock = threading.Lock()
+        self.reset()
+
+    def configure(self, enabled=None, slow_query_ms=None, explain=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if slow_query_ms is not None:
+            self.slow_query_ms = slow_query_ms
+        if explain is not None:
+            self.explain = explain
+        logger.info(f"DB instrumentation {'enabled' if self.enabled else 'disabled'} "
+                    f"(slow query threshold {self.slow_query_ms} ms)")
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}  # (caller, fingerprint) -> StatementStats
+            self.connects = {}  # caller -> ConnectStats
+            self.explained = {}  # (caller, fingerprint) -> monotonic time of the last logged plan
+            self.since = datetime.now()
+
+    def connect(self, factory, *args, dialect='postgres', **kwargs):
+        if not self.enabled:
+            return factory(*args, **kwargs)
+        caller = caller_name()
+        started = time.perf_counter()
+        conn = factory(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            stats = self.connects.get(caller)
+            if stats is None:
+                stats = self.connects[caller] = ConnectStats()
+            stats.count += 1
+            stats.seconds += elapsed
+            stats.max = max(stats.max, elapsed)
+        return InstrumentedConnection(conn, self, dialect)
+
+    def _stats(self, key):
+        # Caller holds self.lock
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= MAX_FINGERPRINTS:
+                key = (key[0], OTHER)
+                stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+        return stats
+
+    def record_execute(self, key, elapsed, rows, error=False):
+        with self.lock:
+            stats = self._stats(key)
+            stats.calls += 1
+            stats.execute_seconds += elapsed
+            stats.execute_max = max(stats.execute_max, elapsed)
+            if error:
+                stats.errors += 1
+            elif rows is not None and rows > 0:
+                stats.rows += rows
+            slow = not error and elapsed * 1000 >= self.slow_query_ms
+            if slow:
+                stats.slow += 1
+            explain_due = False
+            if slow and self.explain:
+                now = time.monotonic()
+                if now - self.explained.get(key, -EXPLAIN_INTERVAL_SECONDS) >= EXPLAIN_INTERVAL_SECONDS:
+                    self.explained[key] = now
+                    explain_due = True
+        return slow, explain_due
+
+    def record_fetch(self, key, elapsed):
+        with self.lock:
+            self._stats(key).fetch_seconds += elapsed
+
+    def snapshot(self, limit=20, order='total'):
+        with self.lock:
+            statements = [stats.snapshot(caller, statement)
+                          for (caller, statement), stats in self.statements.items()]
+            connects = [stats.snapshot(caller) for caller, stats in self.connects.items()]
+            since = self.since
+        statements.sort(key=SNAPSHOT_ORDERS.get(order, SNAPSHOT_ORDERS['total']), reverse=True)
+        connects.sort(key=lambda entry: entry['total_ms'], reverse=True)
+        return {
+            'enabled': self.enabled,
+            'slow_query_ms': self.slow_query_ms,
+            'since': since.isoformat(),
+            'order': order if order in SNAPSHOT_ORDERS else 'total',
+            'fingerprints': len(statements),
+            'statements': statements[:limit],
+            'connects': connects[:limit],
+        }
+
+class InstrumentedConnection:
+    # Stands in for a DB-API connection; everything but cursors and commit passes straight through
+    __slots__ = ('_conn', '_instrumentation', '_dialect')
+
+    def __init__(self, conn, instrumentation, dialect):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_instrumentation', instrumentation)
+        object.__setattr__(self, '_dialect', dialect)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self)
+
+    def execute(self, query, params=()):
+        # sqlite3's shortcut for a one-off cursor
+        cursor = self.cursor()
+        cursor.execute(query, params)
+        return cursor
+
+    def commit(self):
+        key = (caller_name(), 'COMMIT')
+        started = time.perf_counter()
+        try:
+            self._conn.commit()
+        except Exception:
+            self._instrumentation.record_execute(key, time.perf_counter() - started, None, error=True)
+            raise
+        self._instrumentation.record_execute(key, time.perf_counter() - started, None)
+
+    def explain(self, query, params):
+        # The plan as text, or None when the statement can't be explained. Runs on a fresh
+        # cursor of the same connection, inside a savepoint on Postgres so a failed EXPLAIN
+        # can't abort the caller's transaction.
+        conn = self._conn
+        savepoint = self._dialect == 'postgres' and not getattr(conn, 'autocommit', False)
+        cursor = conn.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT db_instrumentation_explain")
+            try:
+                if isinstance(query, bytes):
+                    query = query.decode('utf-8')
+                prefix = EXPLAIN_PREFIXES[self._dialect]
+                if params is None:
+                    cursor.execute(prefix + str(query))
+                else:
+                    cursor.execute(prefix + str(query), params)
+                plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+            except Exception as e:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT db_instrumentation_explain")
+                logger.debug(f"Couldn't explain statement: {str(e)}")
+                plan = None
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT db_instrumentation_explain")
+            return plan
+        finally:
+            cursor.close()
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+class InstrumentedCursor:
+    __slots__ = ('_cursor', '_connection', '_key')
+
+    def __init__(self, cursor, connection):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_key', None)
+
+    def _run(self, method, query, params, explainable=True):
+        instrumentation = self._connection._instrumentation
+        key = (caller_name(), fingerprint(query))
+        object.__setattr__(self, '_key', key)
+        started = time.perf_counter()
+        try:
+            result = method(query) if params is None else method(query, params)
+        except Exception:
+            instrumentation.record_execute(key, time.perf_counter() - started, None, error=True)
+            raise
+        elapsed = time.perf_counter() - started
+        slow, explain_due = instrumentation.record_execute(key, elapsed, getattr(self._cursor, 'rowcount', None))
+        if slow:
+            plan = None
+            if explain_due and explainable and key[1].split(' ', 1)[0].upper() in EXPLAINABLE:
+                plan = self._connection.explain(query, params)
+            message = f"Slow query in {key[0]} ({elapsed * 1000:.0f} ms): {key[1]}"
+            logger.warning(f"{message}\n{plan}" if plan else message)
+        return result
+
+    def execute(self, query, params=None):
+        return self._run(self._cursor.execute, query, params)
+
+    def executemany(self, query, params):
+        return self._run(self._cursor.executemany, query, params, explainable=False)
+
+    def _timed_fetch(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self._key is not None:
+                self._connection._instrumentation.record_fetch(self._key, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._timed_fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        # Server-side cursors do their work here, a page at a time; recorded once, when
+        # the loop ends or is abandoned
+        iterator = iter(self._cursor)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - started
+                    return
+                elapsed += time.perf_counter() - started
+                yield row
+        finally:
+            if self._key is not None:
+                self._connection._instrumentation.record_fetch(self._key, elapsed)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+# Shared by every connection in the process; the server configures it at startup
+instrumentation = DbInstrumentation()
+
+def connect(factory, *args, dialect='postgres', **kwargs):
+    return instrumentation.connect(factory, *args, dialect=dialect, **kwargs)
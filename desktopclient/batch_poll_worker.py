@@ -13,7 +13,7 @@ class BatchPollWorker(QObject):
     def run(self):
         while True:
             try:
-                batch_jobs = self.client.get_batch_jobs()
+                batch_jobs = self.client.sync_batch_jobs()
                 if batch_jobs is None:
                     self.error_signal.emit("Failed to get batch jobs. Token may be invalid.")
                 else:
@@ -10,7 +10,7 @@ class BatchStatusThread(QThread):
 
     def run(self):
         try:
-            batch_jobs = self.client.get_batch_jobs()
+            batch_jobs = self.client.sync_batch_jobs()
             if batch_jobs is None:
                 self.error_signal.emit("Failed to get batch jobs. Token may be invalid.")
             else:
@@ -0,0 +1,78 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import time
+
+from deskclient import DeskClient
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_PROMPT = "Output KEEP if the image is worth printing, or DELETE if it's not suitable for printing."
+
+# Benchmark of bytes on the wire and wall time for the JSONL we upload and the
+# batch results we download, uncompressed vs. the encodings the server accepts.
+#
+#   python bench_compression.py ~/Pictures/some_folder --uplink-mbps 10 --downlink-mbps 50
+
+def codecs():
+    yield 'identity', (lambda data: data), (lambda data: data)
+    yield 'gzip-1', (lambda data: gzip.compress(data, compresslevel=1)), gzip.decompress
+    yield 'gzip-6', (lambda data: gzip.compress(data, compresslevel=6)), gzip.decompress
+    if zstandard:
+        yield 'zstd-3', zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+
+def bench(label, data, link_mbps):
+    print(f"\n{label}: {len(data) / (1024 * 1024):.2f} MB uncompressed, link {link_mbps} Mbit/s")
+    print(f"{'encoding':<10} {'wire MB':>9} {'ratio':>7} {'compress s':>11} {'transfer s':>11} {'decompress s':>13} {'total s':>9}")
+    for name, compress, decompress in codecs():
+        start = time.perf_counter()
+        encoded = compress(data)
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = decompress(encoded)
+        decompress_time = time.perf_counter() - start
+        assert decoded == data
+
+        transfer_time = len(encoded) * 8 / (link_mbps * 1000 * 1000)
+        total = compress_time + transfer_time + decompress_time
+        print(f"{name:<10} {len(encoded) / (1024 * 1024):>9.2f} {len(data) / len(encoded):>7.2f} "
+              f"{compress_time:>11.3f} {transfer_time:>11.3f} {decompress_time:>13.3f} {total:>9.3f}")
+
+def build_upload(folder_path):
+    client = DeskClient(server_url="", user_token="")
+    if not client.process_folder(folder_path, DEFAULT_PROMPT):
+        return None
+    return ''.join(json.dumps(request) + '\n' for request in client.requests).encode('utf-8')
+
+def build_download(results_dir):
+    data = b''
+    for path in sorted(glob.glob(os.path.join(results_dir, '*.jsonl'))):
+        with open(path, 'rb') as f:
+            data += f.read()
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure JSONL upload and result download compression")
+    parser.add_argument('folder', help="Folder of photos to build a batch from")
+    parser.add_argument('--uplink-mbps', type=float, default=10)
+    parser.add_argument('--downlink-mbps', type=float, default=50)
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(__file__), '..', 'completed_results'),
+                        help="Folder of batch output JSONL files to use as download samples")
+    args = parser.parse_args()
+
+    upload = build_upload(args.folder)
+    if upload:
+        bench(f"Upload ({args.folder})", upload, args.uplink_mbps)
+
+    download = build_download(args.results)
+    if download:
+        bench(f"Download ({args.results})", download, args.downlink_mbps)
+
+if __name__ == "__main__":
+    main()
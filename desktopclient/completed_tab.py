@@ -4,6 +4,7 @@ from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QT
                              QHeaderView, QPushButton, QLabel, QSplitter, QMessageBox)
 from PyQt6.QtCore import Qt, pyqtSignal, QFileSystemWatcher
 from PyQt6.QtGui import QColor
+from deskclient import DeskClient
 
 class CompletedBatchResultsWidget(QWidget):
     decision_made = pyqtSignal(str, str, str)  # custom_id, content, decision
@@ -107,7 +108,7 @@ class CompletedBatchResultsWidget(QWidget):
                 for line in file:
                     data = json.loads(line)
                     custom_id = data.get('custom_id', '')
-                    content = data.get('response', {}).get('body', {}).get('choices', [{}])[0].get('message', {}).get('content', '')
+                    content = DeskClient.result_decision(data) or ''
                     self.add_result_to_table(custom_id, content)
         except FileNotFoundError:
             print(f"File not found: {file_path}")
@@ -1,5 +1,6 @@
 import json
 import os
+import gzip
 import base64
 import requests
 from typing import List, Dict
@@ -13,17 +14,76 @@ import uuid
 import asyncio
 import aiohttp
 import shutil
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 
 register_heif_opener()
 
 MAX_REQUESTS_PER_FILE = 50000
 MAX_FILE_SIZE_MB = 100
+MAX_FILES_PER_UPLOAD = 20
+# Shards are gzip-compressed as they are written; the server decodes them on upload
+SHARD_EXTENSION = ".jsonl.gz"
+PENDING_DIR = "pending_batches"
+
+class ETagAdapter(HTTPAdapter):
+    """
+    Transport adapter that revalidates repeated JSON GETs with If-None-Match.
+    A 304 from the server is turned back into a 200 carrying the cached body,
+    so callers never see the difference.
+    """
+    def __init__(self, max_entries=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (url, user token) -> (etag, body), least recently used first
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def remember(self, key, etag, body):
+        with self.lock:
+            self.entries[key] = (etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET' or 'Range' in request.headers:
+            return super().send(request, stream=stream, **kwargs)
+
+        key = (request.url, request.headers.get('User-Token'))
+        cached = self.lookup(key)
+        if cached and 'If-None-Match' not in request.headers:
+            request.headers['If-None-Match'] = cached[0]
+
+        response = super().send(request, stream=stream, **kwargs)
+        if response.status_code == 304 and cached:
+            response.status_code = 200
+            response._content = cached[1]
+        elif (response.status_code == 200 and not stream and response.headers.get('ETag')
+              and response.headers.get('Content-Type', '').startswith('application/json')):
+            self.remember(key, response.headers['ETag'], response.content)
+        return response
 
 class DeskClient:
     def __init__(self, server_url, user_token):
         self.requests = []
         self.server_url = server_url
         self.user_token = user_token
+        # Status and job-list polls go through this session so unchanged responses come back as 304s
+        self.etag_adapter = ETagAdapter()
+        self.session = requests.Session()
+        self.session.mount('http://', self.etag_adapter)
+        self.session.mount('https://', self.etag_adapter)
+        # Local copy of the token's batch jobs, kept current by sync_batch_jobs
+        self.batch_jobs = {}
+        self.batch_jobs_cursor = None
 
     def process_folder(self, folder_path: str, custom_prompt: str):
         # Clear previous requests
@@ -105,14 +165,15 @@ class DeskClient:
         }
         self.requests.append(request)
 
-    def create_batch_jsonl(self, output_file_base: str):
+    def create_batch_jsonl(self, output_file_base: str) -> List[str]:
         file_index = 1
         requests_processed = 0
         total_requests = len(self.requests)
+        output_files = []
 
         while requests_processed < total_requests:
-            output_file = f"{output_file_base}_{file_index}.jsonl"
-            with open(output_file, 'w') as f:
+            output_file = f"{output_file_base}_{file_index}{SHARD_EXTENSION}"
+            with gzip.open(output_file, 'wt', encoding='utf-8', compresslevel=6) as f:
                 file_size = 0
                 requests_count = 0
 
@@ -121,6 +182,7 @@ class DeskClient:
                     json_line = json.dumps(request) + '\n'
                     line_size = len(json_line.encode('utf-8'))
 
+                    # The limits apply to the uncompressed JSONL that OpenAI receives
                     if requests_count >= MAX_REQUESTS_PER_FILE or \
                        file_size + line_size > MAX_FILE_SIZE_MB * 1024 * 1024:
                         break
@@ -130,12 +192,42 @@ class DeskClient:
                     requests_count += 1
                     requests_processed += 1
 
+            output_files.append(output_file)
             print(f"Created JSONL file '{output_file}' with {requests_count} requests.")
-            print(f"File size: {file_size / (1024 * 1024):.2f} MB")
+            print(f"File size: {file_size / (1024 * 1024):.2f} MB "
+                  f"({os.path.getsize(output_file) / (1024 * 1024):.2f} MB compressed)")
             file_index += 1
 
         print(f"Total requests processed: {requests_processed}")
         print(f"Total files created: {file_index - 1}")
+        return output_files
+
+    @staticmethod
+    def pending_batch_path(batch_id: str, source_path: str) -> str:
+        extension = SHARD_EXTENSION if source_path.endswith('.gz') else ".jsonl"
+        return os.path.join(PENDING_DIR, f"{batch_id}{extension}")
+
+    @staticmethod
+    def find_pending_batch_file(batch_id: str):
+        for extension in (SHARD_EXTENSION, ".jsonl"):
+            pending_path = os.path.join(PENDING_DIR, f"{batch_id}{extension}")
+            if os.path.exists(pending_path):
+                return pending_path
+        return None
+
+    @staticmethod
+    def open_jsonl(file_path: str):
+        if file_path.endswith('.gz'):
+            return gzip.open(file_path, 'rt', encoding='utf-8')
+        return open(file_path, 'r')
+
+    @staticmethod
+    def result_decision(item: Dict):
+        # Result lines are either compact decisions from /batches/<id>/decisions
+        # or raw OpenAI output lines from /retrieve_file_content
+        if 'decision' in item:
+            return item['decision']
+        return item.get('response', {}).get('body', {}).get('choices', [{}])[0].get('message', {}).get('content')
 
     def upload_jsonl(self, file_path: str):
         url = f"{self.server_url}/upload_jsonl"
@@ -152,9 +244,16 @@ class DeskClient:
             if batch_id:
                 print(f"Upload successful. Batch ID: {batch_id}")
                 # Move the file to a 'pending_batches' directory and rename it to the batch_id
-                pending_dir = "pending_batches"
-                os.makedirs(pending_dir, exist_ok=True)
-                pending_path = os.path.join(pending_dir, f"{batch_id}.jsonl")
+                os.makedirs(PENDING_DIR, exist_ok=True)
+                pending_path = self.pending_batch_path(batch_id, file_path)
+                shutil.move(file_path, pending_path)
+                print(f"Moved batch file to: {pending_path}")
+            elif batch_data.get('status') == 'queued':
+                # The server creates the batch later; it is matched back by its submission ID
+                submission_id = batch_data['submission_id']
+                print(f"Upload queued. Submission ID: {submission_id}")
+                os.makedirs(PENDING_DIR, exist_ok=True)
+                pending_path = self.pending_batch_path(submission_id, file_path)
                 shutil.move(file_path, pending_path)
                 print(f"Moved batch file to: {pending_path}")
             else:
@@ -164,6 +263,110 @@ class DeskClient:
             print(f"Upload failed with status code {response.status_code}:")
             print(response.text)
 
+    def upload_jsonl_files(self, file_paths: List[str]):
+        """
+        Upload several JSONL shards in a single multipart request.
+
+        :param file_paths: Paths of the JSONL shards to upload
+        :return: A list of the created batch IDs; queued parts are kept under their submission ID
+        """
+        if len(file_paths) > MAX_FILES_PER_UPLOAD:
+            batch_ids = []
+            for start in range(0, len(file_paths), MAX_FILES_PER_UPLOAD):
+                batch_ids.extend(self.upload_jsonl_files(file_paths[start:start + MAX_FILES_PER_UPLOAD]))
+            return batch_ids
+
+        url = f"{self.server_url}/upload_jsonl"
+        headers = {
+            'User-Token': self.user_token
+        }
+        handles = [open(file_path, 'rb') for file_path in file_paths]
+        try:
+            files = [('file', (os.path.basename(file_path), handle, 'application/jsonl'))
+                     for file_path, handle in zip(file_paths, handles)]
+            response = requests.post(url, headers=headers, files=files)
+        finally:
+            for handle in handles:
+                handle.close()
+
+        if response.status_code != 202:
+            print(f"Upload failed with status code {response.status_code}:")
+            print(response.text)
+            return []
+
+        batch_data = response.json()
+        # A single-file upload comes back in the original flat format
+        created = batch_data.get('batches') or [{
+            'filename': os.path.basename(file_paths[0]),
+            'batch_id': batch_data.get('batch_id')
+        }]
+
+        os.makedirs(PENDING_DIR, exist_ok=True)
+        paths_by_name = {os.path.basename(file_path): file_path for file_path in file_paths}
+        batch_ids = []
+        for batch in created:
+            batch_id = batch.get('batch_id')
+            if not batch_id:
+                continue
+            batch_ids.append(batch_id)
+            print(f"Upload successful. Batch ID: {batch_id}")
+            # Move the file to a 'pending_batches' directory and rename it to the batch_id
+            source_path = paths_by_name[batch['filename']]
+            pending_path = self.pending_batch_path(batch_id, source_path)
+            shutil.move(source_path, pending_path)
+            print(f"Moved batch file to: {pending_path}")
+
+        if batch_data.get('status') == 'queued':
+            queued = [{'filename': os.path.basename(file_paths[0]), 'submission_id': batch_data['submission_id']}]
+        else:
+            queued = batch_data.get('queued', [])
+        for submission in queued:
+            # The server creates the batch once capacity frees up; it is matched back by submission ID
+            print(f"Upload queued. Submission ID: {submission['submission_id']}")
+            source_path = paths_by_name[submission['filename']]
+            pending_path = self.pending_batch_path(submission['submission_id'], source_path)
+            shutil.move(source_path, pending_path)
+            print(f"Moved batch file to: {pending_path}")
+
+        for error in batch_data.get('errors', []):
+            print(f"Upload of {error['filename']} failed: {error['error']}")
+        print(json.dumps(batch_data, indent=2))
+        return batch_ids
+
+    def classify_jsonl(self, file_path: str):
+        """
+        Classify a small JSONL file synchronously instead of through a batch.
+
+        :param file_path: Path of a JSONL file with at most 50 requests
+        :return: The number of results received
+        """
+        url = f"{self.server_url}/classify"
+        headers = {
+            'User-Token': self.user_token
+        }
+        with open(file_path, 'rb') as file:
+            files = {'file': (os.path.basename(file_path), file, 'application/jsonl')}
+            response = requests.post(url, headers=headers, files=files, stream=True)
+
+        if response.status_code != 200:
+            print(f"Classify failed with status code {response.status_code}:")
+            print(response.text)
+            return 0
+
+        # Results arrive one line at a time, as each request finishes
+        received = 0
+        for line in response.iter_lines():
+            if not line:
+                continue
+            item = json.loads(line)
+            received += 1
+            content = self.result_decision(item)
+            if item.get('error') or not content:
+                print(f"Classify request {item.get('custom_id')} failed: {item.get('error')}")
+                continue
+            self.update_image_status(item['custom_id'], content)
+        return received
+
     @staticmethod
     def is_image(file_path: str) -> bool:
         return file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.heic'))
@@ -220,7 +423,7 @@ class DeskClient:
         
         for attempt in range(retries):
             try:
-                response = requests.get(url, headers=headers)
+                response = self.session.get(url, headers=headers)
                 print(f"Attempt {attempt + 1}: Status code {response.status_code}")
                 print(f"Response headers: {response.headers}")
                 print(f"Response content: {response.text[:1000]}...")  # Print first 1000 characters
@@ -292,26 +495,32 @@ class DeskClient:
         
         print(f"Remaining Balance: {batch_data['remaining_balance']}")
         
-        # Process the output file
-        self.process_output_file(batch_data['output_file_id'])
+        # Fetch only the compact decisions; fall back to the raw output file if that fails
+        decisions_filename = f"decisions_{batch_data['id']}.jsonl"
+        if self.save_batch_decisions(batch_data['id'], decisions_filename):
+            self.process_batch_results(decisions_filename)
+            os.remove(decisions_filename)
+        else:
+            self.process_output_file(batch_data['output_file_id'])
         
         # After processing, delete the batch files
         deletion_results = self.delete_batch_files(batch_data['id'])
         if deletion_results:
-            print("Batch files deletion results:")
+            print("Batch files deletion scheduled:")
             print(json.dumps(deletion_results, indent=2))
         else:
             print("Failed to delete batch files.")
 
         batch_id = batch_data['id']
-        pending_file = os.path.join("pending_batches", f"{batch_id}.jsonl")
-        if os.path.exists(pending_file):
+        submission_id = (batch_data.get('metadata') or {}).get('submission_id')
+        pending_file = self.find_pending_batch_file(batch_id) or (submission_id and self.find_pending_batch_file(submission_id))
+        if pending_file:
             print(f"Processing completed batch {batch_id}.")
             # Here you can process the file if needed
             os.remove(pending_file)
             print(f"Removed pending batch file: {pending_file}")
         else:
-            print(f"Pending file for batch {batch_id} not found: {pending_file}")
+            print(f"Pending file for batch {batch_id} not found in {PENDING_DIR}")
 
     def retrieve_file_content(self, file_id):
         """
@@ -339,22 +548,80 @@ class DeskClient:
 
     def save_output_file(self, file_id, output_filename):
         """
-        Retrieve the content of the output file and save it locally.
+        Download the output file and save it locally, resuming an interrupted download.
         
         :param file_id: The ID of the output file to retrieve
         :param output_filename: The name of the file to save the content to
         :return: True if successful, False otherwise
         """
-        content = self.retrieve_file_content(file_id)
-        if content is not None:
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                f.write(content)
-            print(f"Output file saved as {output_filename}")
-            return True
-        else:
+        url = f"{self.server_url}/retrieve_file_content/{file_id}"
+        headers = {
+            'User-Token': self.user_token
+        }
+        partial_filename = f"{output_filename}.part"
+        partial_size = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+        if partial_size:
+            # Output files never change, so the file ID is the ETag the partial copy came from
+            headers['Range'] = f"bytes={partial_size}-"
+            headers['If-Range'] = f'"{file_id}"'
+            print(f"Resuming download of {file_id} from byte {partial_size}")
+
+        try:
+            with requests.get(url, headers=headers, stream=True) as response:
+                if response.status_code not in (200, 206):
+                    print(f"Failed to retrieve file content. Status code: {response.status_code}")
+                    print(response.text)
+                    print("Failed to save output file")
+                    return False
+
+                # 206 means the server honoured the range; 200 means start over
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(partial_filename, mode) as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+        except requests.exceptions.RequestException as e:
+            print(f"Download of {file_id} interrupted: {e}")
             print("Failed to save output file")
             return False
 
+        os.replace(partial_filename, output_filename)
+        print(f"Output file saved as {output_filename}")
+        return True
+
+    def save_batch_decisions(self, batch_id, output_filename, page_size=10000):
+        """
+        Download the decisions of a completed batch as NDJSON, one page at a time.
+        Each line holds custom_id, decision and usage, instead of the full OpenAI output.
+        
+        :param batch_id: The ID of the completed batch
+        :param output_filename: The name of the file to save the decisions to
+        :param page_size: Number of decisions requested per page
+        :return: True if successful, False otherwise
+        """
+        url = f"{self.server_url}/batches/{batch_id}/decisions"
+        headers = {
+            'User-Token': self.user_token
+        }
+        params = {'format': 'ndjson', 'limit': page_size}
+        partial_filename = f"{output_filename}.part"
+        with open(partial_filename, 'wb') as f:
+            while True:
+                response = requests.get(url, headers=headers, params=params)
+                if response.status_code != 200:
+                    print(f"Failed to retrieve decisions. Status code: {response.status_code}")
+                    print(response.text)
+                    os.remove(partial_filename)
+                    return False
+                f.write(response.content)
+                next_after = response.headers.get('X-Next-After')
+                if not next_after:
+                    break
+                params['after'] = next_after
+
+        os.replace(partial_filename, output_filename)
+        print(f"Decisions saved as {output_filename}")
+        return True
+
     def process_output_file(self, file_id):
         """
         Process the output file after a batch job is completed.
@@ -388,7 +655,7 @@ class DeskClient:
                 try:
                     item = json.loads(line.strip())
                     custom_id = item.get('custom_id')
-                    content = item.get('response', {}).get('body', {}).get('choices', [{}])[0].get('message', {}).get('content')
+                    content = self.result_decision(item)
                     if custom_id and content:
                         self.update_image_status(custom_id, content)
                     else:
@@ -420,7 +687,7 @@ class DeskClient:
         headers = {
             'User-Token': self.user_token
         }
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=headers)
         
         if response.status_code == 200:
             batch_jobs = response.json()['batch_jobs']
@@ -433,6 +700,38 @@ class DeskClient:
             print(response.text)
             return None
 
+    def sync_batch_jobs(self):
+        """
+        Keep the local copy of this token's batch jobs current. The first call fetches the
+        full list; later calls only fetch jobs changed or deleted since the previous cursor.
+        
+        :return: The list of batch jobs, or None if the request fails
+        """
+        url = f"{self.server_url}/user/batch_jobs"
+        headers = {
+            'User-Token': self.user_token
+        }
+        params = {'since': self.batch_jobs_cursor} if self.batch_jobs_cursor else None
+        response = self.session.get(url, headers=headers, params=params)
+
+        if response.status_code != 200:
+            print(f"Failed to sync batch jobs. Status code: {response.status_code}")
+            print(response.text)
+            return None
+
+        data = response.json()
+        if self.batch_jobs_cursor is None:
+            self.batch_jobs = {job['id']: job for job in data['batch_jobs']}
+        else:
+            for job in data['batch_jobs']:
+                self.batch_jobs[job['id']] = job
+            for batch_id in data.get('deleted', []):
+                self.batch_jobs.pop(batch_id, None)
+            print(f"Synced {len(data['batch_jobs'])} changed and {len(data.get('deleted', []))} deleted batch jobs")
+        # Servers without delta sync send no cursor, so every call stays a full fetch
+        self.batch_jobs_cursor = data.get('cursor')
+        return list(self.batch_jobs.values())
+
     def get_file_ids(self):
         url = f"{self.server_url}/user/file_ids"
         headers = {
@@ -453,10 +752,11 @@ class DeskClient:
 
     def delete_batch_files(self, batch_id):
         """
-        Delete the input and output files associated with a batch job.
+        Schedule deletion of the input and output files associated with a batch job.
+        The server deletes the files in the background.
         
         :param batch_id: The ID of the batch job
-        :return: A dictionary with the deletion results, or None if the deletion fails
+        :return: A dictionary describing the scheduled deletion, or None if the request fails
         """
         url = f"{self.server_url}/delete_batch_files/{batch_id}"
         headers = {
@@ -464,22 +764,77 @@ class DeskClient:
         }
         response = requests.delete(url, headers=headers)
         
-        if response.status_code == 200:
-            return response.json()['deletion_results']
+        if response.status_code == 202:
+            return response.json()
         else:
             print(f"Failed to delete batch files. Status code: {response.status_code}")
             print(response.text)
             return None
 
+    def register_webhook(self, callback_url, batch_id=None):
+        """
+        Ask the server to POST a signed completion payload to callback_url when a batch
+        finishes, instead of polling for it.
+        
+        :param callback_url: The http(s) URL the server should call
+        :param batch_id: Limit the webhook to one batch; all of this token's batches if None
+        :return: A dictionary with the webhook_id and the signing secret, or None if the request fails
+        """
+        url = f"{self.server_url}/webhooks"
+        headers = {
+            'User-Token': self.user_token
+        }
+        data = {'url': callback_url}
+        if batch_id:
+            data['batch_id'] = batch_id
+        response = requests.post(url, headers=headers, json=data)
+
+        if response.status_code == 201:
+            return response.json()
+        else:
+            print(f"Failed to register webhook. Status code: {response.status_code}")
+            print(response.text)
+            return None
+
+    def delete_webhook(self, webhook_id):
+        """
+        Remove a webhook registered with register_webhook.
+        
+        :param webhook_id: The ID returned when the webhook was registered
+        :return: True if the webhook was deleted, False otherwise
+        """
+        url = f"{self.server_url}/webhooks/{webhook_id}"
+        headers = {
+            'User-Token': self.user_token
+        }
+        response = requests.delete(url, headers=headers)
+
+        if response.status_code == 200:
+            return True
+        else:
+            print(f"Failed to delete webhook. Status code: {response.status_code}")
+            print(response.text)
+            return False
+
     async def async_get_batch_status(self, session, batch_id):
         url = f"{self.server_url}/batches/{batch_id}"
         headers = {
             'User-Token': self.user_token
         }
+        # Shares the ETag cache with the synchronous session
+        key = (url, self.user_token)
+        cached = self.etag_adapter.lookup(key)
+        if cached:
+            headers['If-None-Match'] = cached[0]
         
         async with session.get(url, headers=headers) as response:
+            if response.status == 304 and cached:
+                return json.loads(cached[1])
             if response.status == 200:
-                return await response.json()
+                body = await response.read()
+                if response.headers.get('ETag'):
+                    self.etag_adapter.remember(key, response.headers['ETag'], body)
+                return json.loads(body)
             else:
                 print(f"Failed to get batch status for {batch_id}. Status code: {response.status}")
                 return None
@@ -509,8 +864,12 @@ class DeskClient:
         print("Processing completed batch data:")
         print(json.dumps(batch_data, indent=2))
         
-        # Process the output file
-        output_filename = await self.async_process_output_file(session, batch_data['output_file_id'])
+        # Fetch only the compact decisions; fall back to the raw output file if that fails
+        output_filename = await self.async_save_batch_decisions(session, batch_data['id'])
+        if output_filename:
+            self.process_batch_results(output_filename)
+        else:
+            output_filename = await self.async_process_output_file(session, batch_data['output_file_id'])
         
         if output_filename:
             # Move the output file to a 'completed_results' folder
@@ -520,13 +879,30 @@ class DeskClient:
             shutil.move(output_filename, completed_path)
             print(f"Moved completed results to: {completed_path}")
         
-        # After processing, delete the batch files on the server
-        deletion_results = await self.async_delete_batch_files(session, batch_data['id'])
-        if deletion_results:
-            print("Batch files deletion results:")
-            print(json.dumps(deletion_results, indent=2))
-        else:
-            print("Failed to delete batch files on the server.")
+        # Server-side file cleanup is done in bulk by async_process_all_batches
+
+    async def async_save_batch_decisions(self, session, batch_id, page_size=10000):
+        url = f"{self.server_url}/batches/{batch_id}/decisions"
+        headers = {
+            'User-Token': self.user_token
+        }
+        params = {'format': 'ndjson', 'limit': page_size}
+        output_filename = f"decisions_{batch_id}.jsonl"
+        with open(output_filename, 'wb') as f:
+            while True:
+                async with session.get(url, headers=headers, params=params) as response:
+                    if response.status != 200:
+                        print(f"Failed to retrieve decisions. Status code: {response.status}")
+                        f.close()
+                        os.remove(output_filename)
+                        return None
+                    f.write(await response.read())
+                    next_after = response.headers.get('X-Next-After')
+                if not next_after:
+                    break
+                params['after'] = next_after
+        print(f"Decisions saved as {output_filename}")
+        return output_filename
 
     async def async_retrieve_file_content(self, session, file_id):
         url = f"{self.server_url}/retrieve_file_content/{file_id}"
@@ -559,7 +935,19 @@ class DeskClient:
             'User-Token': self.user_token
         }
         async with session.delete(url, headers=headers) as response:
-            if response.status == 200:
+            if response.status == 202:
+                return await response.json()
+            else:
+                print(f"Failed to delete batch files. Status code: {response.status}")
+                return None
+
+    async def async_delete_many_batch_files(self, session, batch_ids):
+        url = f"{self.server_url}/batches/files"
+        headers = {
+            'User-Token': self.user_token
+        }
+        async with session.delete(url, headers=headers, json={'batch_ids': batch_ids}) as response:
+            if response.status == 202:
                 return await response.json()
             else:
                 print(f"Failed to delete batch files. Status code: {response.status}")
@@ -568,7 +956,17 @@ class DeskClient:
     async def async_process_all_batches(self, batch_jobs):
         async with aiohttp.ClientSession() as session:
             tasks = [self.async_poll_batch_status(session, job['id']) for job in batch_jobs]
-            await asyncio.gather(*tasks)
+            results = await asyncio.gather(*tasks)
+
+            # Clean up every completed batch's files with a single request
+            completed_ids = [status['id'] for status in results if status]
+            if completed_ids:
+                deletion_results = await self.async_delete_many_batch_files(session, completed_ids)
+                if deletion_results:
+                    print("Batch files deletion scheduled:")
+                    print(json.dumps(deletion_results, indent=2))
+                else:
+                    print("Failed to delete batch files on the server.")
 
 # # Example usage
 # if __name__ == "__main__":
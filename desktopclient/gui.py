@@ -193,8 +193,8 @@ class MainWindow(QMainWindow):
         layout = QVBoxLayout(status_widget)
 
         self.status_table = QTableWidget()
-        self.status_table.setColumnCount(4)
-        self.status_table.setHorizontalHeaderLabels(["Batch ID", "Status", "Created At", "Completed At"])
+        self.status_table.setColumnCount(5)
+        self.status_table.setHorizontalHeaderLabels(["Batch ID", "Status", "Progress", "Created At", "Completed At"])
         self.status_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
         self.status_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)  # Make table non-editable
         self.status_table.itemDoubleClicked.connect(self.show_batch_details)
@@ -232,9 +232,9 @@ class MainWindow(QMainWindow):
 
     def load_file_paths(self, batch_id):
         self.file_list.clear()
-        file_path = f"pending_batches/{batch_id}.jsonl"
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
+        file_path = DeskClient.find_pending_batch_file(batch_id)
+        if file_path:
+            with DeskClient.open_jsonl(file_path) as f:
                 for line in f:
                     data = json.loads(line)
                     file_path = data.get('custom_id', 'Unknown file path')
@@ -263,8 +263,19 @@ class MainWindow(QMainWindow):
         for row, job in enumerate(batch_jobs):
             self.status_table.setItem(row, 0, QTableWidgetItem(job['id']))
             self.status_table.setItem(row, 1, QTableWidgetItem(job['status']))
-            self.status_table.setItem(row, 2, QTableWidgetItem(job['created_at']))
-            self.status_table.setItem(row, 3, QTableWidgetItem(job.get('completed_at', 'N/A')))
+            self.status_table.setItem(row, 2, QTableWidgetItem(self.format_progress(job.get('request_counts'))))
+            self.status_table.setItem(row, 3, QTableWidgetItem(job['created_at']))
+            self.status_table.setItem(row, 4, QTableWidgetItem(job.get('completed_at') or 'N/A'))
+
+    @staticmethod
+    def format_progress(request_counts):
+        # Snapshot stored by the server at the batch's last status refresh
+        if not request_counts or not request_counts.get('total'):
+            return 'N/A'
+        progress = f"{request_counts['completed']}/{request_counts['total']}"
+        if request_counts.get('failed'):
+            progress += f" ({request_counts['failed']} failed)"
+        return progress
 
     def check_balance(self):
         try:
@@ -13,21 +13,22 @@ class WorkerThread(QThread):
 
     def run(self):
         output_base = f"batch_requests_{self.run_id}"
-        self.client.create_batch_jsonl(output_base)
-        
-        file_index = 1
-        while True:
-            file_path = f"{output_base}_{file_index}.jsonl"
+        file_paths = self.client.create_batch_jsonl(output_base)
+
+        if file_paths:
+            # All shards go up in one request so they share a single rate-limit slot
+            self.update_signal.emit(f"Uploading {len(file_paths)} files...")
+            batch_ids = self.client.upload_jsonl_files(file_paths)
+            self.update_signal.emit(f"Created {len(batch_ids)} batches")
+
+        for file_path in file_paths:
             if not os.path.exists(file_path):
-                break
-            self.update_signal.emit(f"Uploading {file_path}...")
-            self.client.upload_jsonl(file_path)
+                continue
             try:
                 os.remove(file_path)
                 self.update_signal.emit(f"Removed batch request file: {file_path}")
             except OSError as e:
                 self.update_signal.emit(f"Error removing batch request file {file_path}: {e}")
-            file_index += 1
 
         self.update_signal.emit("Upload complete")
         balance = self.client.check_balance()
@@ -0,0 +1,109 @@
+import os
+import re
+import threading
+import tempfile
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class FileCache:
+    # On-disk LRU cache of OpenAI file contents, keyed by file_id.
+    # OpenAI files never change once written, so a cached copy never goes stale.
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        self.entries = OrderedDict()  # file_id -> size in bytes, least recently used first
+        self.total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_existing()
+
+    def _load_existing(self):
+        # Rebuild the LRU order from access times so the cache survives restarts
+        cached = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            cached.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(cached):
+            self.entries[name] = size
+            self.total_bytes += size
+        logger.info(f"File cache loaded {len(self.entries)} files ({self.total_bytes} bytes) from {self.cache_dir}")
+        with self.lock:
+            self._evict()
+
+    def _path(self, file_id):
+        # Keys are OpenAI file IDs, optionally with a '.gz' suffix for compressed copies
+        if not re.fullmatch(r'[A-Za-z0-9_-]+(\.gz)?', file_id):
+            raise ValueError(f"Invalid file ID: {file_id}")
+        return os.path.join(self.cache_dir, file_id)
+
+    def get(self, file_id):
+        path = self._path(file_id)
+        with self.lock:
+            if file_id not in self.entries:
+                return None
+            self.entries.move_to_end(file_id)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another thread between the lookup and now
+            return None
+        return path
+
+    def put(self, file_id, chunks):
+        path = self._path(file_id)
+        # Write to a temporary file first so readers never see a partial download
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(file_id, 0)
+            self.entries[file_id] = size
+            self._evict()
+        logger.info(f"Cached file {file_id} ({size} bytes)")
+        return path
+
+    def get_or_fetch(self, file_id, fetch):
+        # fetch(file_id) yields the file's bytes; it only runs on a miss, once per file_id
+        path = self.get(file_id)
+        if path:
+            logger.info(f"File cache hit: {file_id}")
+            return path
+
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(file_id, threading.Lock())
+        with fetch_lock:
+            path = self.get(file_id)
+            if path:
+                return path
+            logger.info(f"File cache miss: {file_id}")
+            try:
+                return self.put(file_id, fetch(file_id))
+            finally:
+                with self.lock:
+                    self.fetch_locks.pop(file_id, None)
+
+    def _evict(self):
+        # Caller holds self.lock; always keep the most recent entry, even if it is oversized
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            file_id, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, file_id))
+            except FileNotFoundError:
+                pass
+            logger.info(f"Evicted file {file_id} from cache ({size} bytes)")
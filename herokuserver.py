@@ -1,23 +1,46 @@
-from flask import Flask, request, jsonify, Response
+import time
+STARTUP_STARTED_AT = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, send_file
 import os
 import secrets
-import time
 from datetime import datetime, timedelta
 import uuid
+import threading
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
 import math
-import requests
-from openai import OpenAI
 import csv
 import json
-import psycopg2
-from psycopg2 import sql
-from batch_logger import BatchLogger  # Import the BatchLogger class
-from dotenv import load_dotenv
+from batch_logger import (BatchLogger, BATCH_LOGS_DDL, BATCH_LOGS_COMPACTION_DDL, BATCH_STATS_DDL, ALL_USERS,  # Import the BatchLogger class
+                          BATCH_LOGS_PARTITIONING_DDL,
+                          TERMINAL_STATUSES, TTC_BUCKET_BOUNDS, ttc_percentile, to_timestamp)
+from webhooks import WebhookDispatcher, WEBHOOKS_DDL, UnsafeWebhookURL, resolve_webhook_url
+from signed_tokens import issue_token, is_signed_token, verify_token
+from priority_executor import PriorityThreadPool
+from submission_scheduler import FairScheduler, Submission
+from key_pool import (KeyPool, UnknownKeyError, API_KEYS_DDL, USER_KEY_PREFIX, ENCRYPTED_SECRET_PREFIX,
+                      key_id_for, encrypt_secret, decrypt_secret)
+from async_classifier import AsyncClassifier
+from upstream import Upstream, UpstreamError, CircuitOpenError, is_transient
+import telemetry_export
+import db_instrumentation
+import request_profiler
+from collections import OrderedDict
+from file_cache import FileCache
+from compression import (DecompressRequestMiddleware, compress_response, decompressing_stream,
+                         encoding_for_filename, gzip_chunks)
+from werkzeug.datastructures import FileStorage
 import logging
 import sys
-from psycopg2.extras import RealDictCursor
 import io  # Add this import
+import tempfile
+import shutil
+import queue
+from contextlib import ExitStack
+
+# openai, psycopg2 and requests are imported on first use; they dominate import
+# time and most dyno restarts serve cheap requests before any of them are needed
 
 # Configure logging to write to stdout
 logging.basicConfig(
@@ -27,15 +50,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
-logger.info("Environment variables loaded from .env file")
+# Startup phase timings in milliseconds, reported at /admin/startup
+startup_timings = {}
+startup_phase_started_at = STARTUP_STARTED_AT
+
+def record_startup_phase(phase):
+    global startup_phase_started_at
+    now = time.perf_counter()
+    startup_timings[phase] = round((now - startup_phase_started_at) * 1000, 2)
+    startup_phase_started_at = now
+    logger.info(f"Startup phase {phase} took {startup_timings[phase]} ms")
+
+record_startup_phase('imports')
 
-# Set OpenAI API key as an environment variable
-os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
-logger.info("OpenAI API key set from environment variable")
+# Load environment variables from .env file; Heroku sets them directly, so skip the import there
+if os.path.exists('.env'):
+    from dotenv import load_dotenv
+    load_dotenv()
+    logger.info("Environment variables loaded from .env file")
 
 app = Flask(__name__)
+# Request bodies sent with Content-Encoding: gzip/zstd are decoded before Flask parses them
+app.wsgi_app = DecompressRequestMiddleware(app.wsgi_app)
+# Requests sent with X-Profile and the admin token are profiled; see /admin/profiles
+request_profiler.install(app)
 logger.info("Flask app initialized")
 
 # All locks declared at the top
@@ -46,152 +84,984 @@ logger.info("Locks initialized")
 # In-memory storage for rate limits
 rate_limits = {}
 
+# QoS profile of each tier: request rate, concurrently in-flight OpenAI batches, upload
+# priority (lower runs first) and fair-share weight (submissions per round-robin turn).
+# 'default' covers tokens bought without a tier.
+TIER_PROFILES = {
+    'default': {'requests_per_minute': 5, 'max_in_flight_batches': 10, 'priority': 2, 'weight': 1},
+    'basic': {'requests_per_minute': 5, 'max_in_flight_batches': 10, 'priority': 2, 'weight': 1},
+    'standard': {'requests_per_minute': 15, 'max_in_flight_batches': 25, 'priority': 1, 'weight': 2},
+    'premium': {'requests_per_minute': 60, 'max_in_flight_batches': 60, 'priority': 0, 'weight': 4},
+}
+TOKEN_TIER_CACHE_SIZE = 10000
+
+# A token's tier never changes, so it is cached instead of read on every request
+token_tiers = OrderedDict()
+token_tiers_lock = Lock()
+
 # Configuration
 MAX_BATCH_REQUESTS = 50000
 MAX_BATCH_SIZE_MB = 100
+MAX_FILES_PER_UPLOAD = 20
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+DELETION_WORKERS = int(os.environ.get('DELETION_WORKERS', 8))
+DELETION_MAX_ATTEMPTS = 5
+DELETION_RETRY_BASE_SECONDS = 2
+FILE_CACHE_DIR = os.environ.get('FILE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'file_cache'))
+FILE_CACHE_MAX_MB = int(os.environ.get('FILE_CACHE_MAX_MB', 512))
+FILE_CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+UPLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+STATUS_FRESH_SECONDS = 10  # A batch refreshed this recently is revalidated without calling OpenAI
+BATCH_LOG_RETENTION_DAYS = int(os.environ.get('BATCH_LOG_RETENTION_DAYS', 7))
+BATCH_LOG_COMPACTION_INTERVAL_SECONDS = 60 * 60
+MAX_WEBHOOKS_PER_TOKEN = 20
+WEBHOOK_REFRESH_INTERVAL_SECONDS = int(os.environ.get('WEBHOOK_REFRESH_INTERVAL_SECONDS', 60))
+WEBHOOK_REFRESH_BATCH_LIMIT = 100
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', 2))
+RESULTS_INSERT_PAGE_SIZE = 1000
+DECISIONS_DEFAULT_LIMIT = 1000
+DECISIONS_MAX_LIMIT = 10000
+# Server-owned OpenAI keys, comma separated; OPENAI_API_KEY alone still works and stays the
+# key for batches created before keys were recorded
+OPENAI_API_KEYS = [key.strip() for key in [os.environ.get('OPENAI_API_KEY', '')]
+                   + os.environ.get('OPENAI_API_KEYS', '').split(',') if key.strip()]
+OPENAI_KEY_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_KEY_REQUESTS_PER_MINUTE', 500))
+# Batch creation is admitted against each key's org enqueued-token limit, estimated from the
+# JSONL; no single user may hold more than their share of the server keys' combined limit
+ORG_ENQUEUED_TOKEN_LIMIT = int(os.environ.get('ORG_ENQUEUED_TOKEN_LIMIT', 2000000))
+USER_ENQUEUED_TOKEN_SHARE = float(os.environ.get('USER_ENQUEUED_TOKEN_SHARE', 0.5))
+ESTIMATED_CHARS_PER_TOKEN = 4
+ESTIMATED_TOKENS_PER_IMAGE = {'low': 85, 'high': 765}  # A 'high'/'auto' image at the usual 1024px
+ESTIMATED_TOKENS_PER_MESSAGE = 4
+# Queued parts wait here. Heroku dynos lose their filesystem on every restart, so there it
+# should be a mounted durable volume; parts whose spooled file is gone are refunded instead
+SUBMISSION_SPOOL_DIR = os.environ.get('SUBMISSION_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'submission_spool'))
+SUBMISSION_WAIT_SECONDS = 20  # Parts not started by then are answered as 'queued'
+BATCH_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('BATCH_RECONCILE_INTERVAL_SECONDS', 300))
+BATCH_LIST_PAGE_SIZE = 100  # The most batches.list returns per page
+FILE_GC_INTERVAL_SECONDS = int(os.environ.get('FILE_GC_INTERVAL_SECONDS', 6 * 60 * 60))
+# Periodic runs only log what they would delete unless FILE_GC_DELETE is set
+FILE_GC_DELETE = os.environ.get('FILE_GC_DELETE', '').lower() in ('1', 'true', 'yes')
+FILE_GC_MIN_AGE = timedelta(hours=24)  # Younger unreferenced files may belong to an upload still creating its batch
+FILE_GC_RETENTION = timedelta(hours=int(os.environ.get('FILE_GC_RETENTION_HOURS', 72)))  # Left for the client after a batch ends
+FILE_GC_RATE_SHARE = 0.5  # Deletions wait while a key has less than this share of its request rate free
+CLASSIFY_MAX_REQUESTS = 50  # Bigger jobs belong on /upload_jsonl
+CLASSIFY_CONCURRENCY = int(os.environ.get('CLASSIFY_CONCURRENCY', 16))  # Requests in flight across all /classify calls
+CLASSIFY_RESULT_TIMEOUT_SECONDS = 120
+CLASSIFY_OUTPUT_TOKEN_ESTIMATE = 300  # Counted against a key's TPM when a request sets no max_tokens
+OPENAI_KEY_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_KEY_TOKENS_PER_MINUTE', 200000))
+# Per-operation timeouts (seconds) for OpenAI calls, which otherwise wait up to 10 minutes
+UPSTREAM_TIMEOUTS = {
+    'default': 30,
+    'batches.retrieve': 10,
+    'batches.create': 60,
+    'files.delete': 10,
+    'files.content': 60,  # Until the response starts; the body then streams at its own pace
+    'files.create': 300,
+    'models.list': 10,  # Checks a user's key before it is stored
+}
+UPSTREAM_MAX_ATTEMPTS = 3  # For idempotent calls only
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get('UPSTREAM_BREAKER_FAILURES', 5))  # Transient failures in a row per key
+UPSTREAM_BREAKER_RESET_SECONDS = int(os.environ.get('UPSTREAM_BREAKER_RESET_SECONDS', 30))
+UPSTREAM_HEDGE_MIN_SECONDS = 0.5  # A retrieve slower than max(this, recent p95) gets a second request
+BATCH_JOB_ARCHIVE_DAYS = int(os.environ.get('BATCH_JOB_ARCHIVE_DAYS', 30))  # Terminal batches older than this are archived
+BATCH_JOB_ARCHIVE_INTERVAL_SECONDS = 60 * 60
+BATCH_JOB_ARCHIVE_CHUNK = 500  # Rows moved per transaction, so the mover never holds locks for long
+BATCH_LOGS_MAINTENANCE_INTERVAL_SECONDS = 24 * 60 * 60
 DATABASE_URL = os.environ.get('DATABASE_URL')
 logger.info(f"Database URL set from environment variable")
+# Per-statement timings and the slow query log; off by default, since every query then
+# goes through a proxy
+DB_INSTRUMENTATION = os.environ.get('DB_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+DB_SLOW_QUERY_MS = int(os.environ.get('DB_SLOW_QUERY_MS', 200))
+DB_STATS_DEFAULT_LIMIT = 20
+TOKEN_LIFETIME = timedelta(hours=24)
+# When set, new tokens are HMAC-signed and carry their expiry, so validating them needs no query
+TOKEN_SIGNING_KEY = os.environ.get('TOKEN_SIGNING_KEY')
+# Fernet key (Fernet.generate_key()) that users' OpenAI keys are encrypted with in api_keys;
+# POST /user/api_key is refused without it
+API_KEY_ENCRYPTION_KEY = os.environ.get('API_KEY_ENCRYPTION_KEY')
+OWN_KEY_LOOKUP_CACHE_SIZE = 10000
+OWN_KEY_LOOKUP_TTL_SECONDS = 60  # Another dyno may have stored a key for the token since
+
+# Bounds decoded request bodies too, since compressed uploads arrive without a usable Content-Length
+app.config['MAX_CONTENT_LENGTH'] = (MAX_FILES_PER_UPLOAD + 1) * MAX_BATCH_SIZE_MB * 1024 * 1024
+
+# Shared pool for uploading shards and creating their batches concurrently; higher tiers go first
+upload_executor = PriorityThreadPool(max_workers=UPLOAD_WORKERS)
+
+# Background pool for deleting OpenAI files outside the request
+deletion_executor = ThreadPoolExecutor(max_workers=DELETION_WORKERS)
+
+# Background pool for ingesting completed output files into batch_results
+ingestion_executor = ThreadPoolExecutor(max_workers=INGESTION_WORKERS)
+
+# Downloaded OpenAI files, kept on local disk so repeat downloads skip OpenAI
+file_cache = FileCache(FILE_CACHE_DIR, FILE_CACHE_MAX_MB * 1024 * 1024)
+
+# Columns of batch_jobs kept when a batch is archived, named rather than * so adding a
+# column to batch_jobs can't break the archive mover or the batch_jobs_all view. A new
+# column is only archived once it is added here and to batch_jobs_archive.
+ARCHIVED_BATCH_JOB_COLUMNS = [
+    'id', 'status', 'created_at', 'token', 'openai_file_id', 'output_file_id', 'results_ingested_at',
+    'request_total', 'request_completed', 'request_failed', 'completed_at', 'expires_at',
+    'last_refreshed_at', 'version', 'change_seq', 'enqueued_tokens', 'api_key_id', 'missing_upstream_at',
+]
+
+# Schema changes, applied in order and recorded in schema_migrations so a
+# restart only has to read the current version instead of re-running DDL
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS tokens
+           (token TEXT PRIMARY KEY, amount INTEGER, used INTEGER, expiry TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS batch_jobs
+           (id TEXT PRIMARY KEY, status TEXT, created_at TIMESTAMP, token TEXT, openai_file_id TEXT, output_file_id TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS file_deletions
+           (file_id TEXT PRIMARY KEY, batch_id TEXT, token TEXT, status TEXT, attempts INTEGER,
+            last_error TEXT, updated_at TIMESTAMP)''',
+        BATCH_LOGS_DDL,
+    ]),
+    (2, BATCH_STATS_DDL),
+    (3, BATCH_LOGS_COMPACTION_DDL),
+    (4, WEBHOOKS_DDL),
+    (5, [
+        # Only the fields clients use from each output line, so decisions are served without OpenAI
+        '''CREATE TABLE IF NOT EXISTS batch_results
+           (batch_id TEXT, custom_id TEXT, decision TEXT, prompt_tokens INTEGER, completion_tokens INTEGER,
+            total_tokens INTEGER, error TEXT, PRIMARY KEY (batch_id, custom_id))''',
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS results_ingested_at TIMESTAMP',
+    ]),
+    (6, [
+        # Progress snapshot written on every refresh, so job lists never need OpenAI
+        '''ALTER TABLE batch_jobs
+           ADD COLUMN IF NOT EXISTS request_total INTEGER,
+           ADD COLUMN IF NOT EXISTS request_completed INTEGER,
+           ADD COLUMN IF NOT EXISTS request_failed INTEGER,
+           ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP,
+           ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP,
+           ADD COLUMN IF NOT EXISTS last_refreshed_at TIMESTAMP''',
+        'CREATE INDEX IF NOT EXISTS batch_jobs_token_created_at_idx ON batch_jobs (token, created_at)',
+    ]),
+    (7, [
+        # Change counters behind the ETags of /batches/<id> and /user/batch_jobs
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS version INTEGER DEFAULT 1',
+        'ALTER TABLE tokens ADD COLUMN IF NOT EXISTS jobs_version INTEGER DEFAULT 0',
+    ]),
+    (8, [
+        # Change cursor for delta sync of a token's jobs: every insert, change and delete takes
+        # the next value; deletes leave a tombstone so clients can drop the row
+        'CREATE SEQUENCE IF NOT EXISTS batch_jobs_change_seq',
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS change_seq BIGINT',
+        "UPDATE batch_jobs SET change_seq = nextval('batch_jobs_change_seq') WHERE change_seq IS NULL",
+        "ALTER TABLE batch_jobs ALTER COLUMN change_seq SET DEFAULT nextval('batch_jobs_change_seq')",
+        'CREATE INDEX IF NOT EXISTS batch_jobs_token_change_seq_idx ON batch_jobs (token, change_seq)',
+        '''CREATE TABLE IF NOT EXISTS batch_job_deletions
+           (batch_id TEXT PRIMARY KEY, token TEXT, deleted_at TIMESTAMP,
+            change_seq BIGINT DEFAULT nextval('batch_jobs_change_seq'))''',
+        'CREATE INDEX IF NOT EXISTS batch_job_deletions_token_change_seq_idx ON batch_job_deletions (token, change_seq)',
+    ]),
+    (9, [
+        "ALTER TABLE tokens ADD COLUMN IF NOT EXISTS tier TEXT DEFAULT 'default'",
+    ]),
+    (10, [
+        # Estimated tokens a batch holds against the org's enqueued-token limit; zeroed once released
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS enqueued_tokens INTEGER DEFAULT 0',
+        '''CREATE TABLE IF NOT EXISTS batch_submissions
+           (id TEXT PRIMARY KEY, token TEXT, filename TEXT, path TEXT, num_requests INTEGER,
+            estimated_tokens INTEGER, status TEXT, batch_id TEXT, error TEXT,
+            created_at TIMESTAMP, updated_at TIMESTAMP)''',
+        'CREATE INDEX IF NOT EXISTS batch_submissions_status_created_at_idx ON batch_submissions (status, created_at)',
+    ]),
+    (11, API_KEYS_DDL + [
+        # The key that created the batch; NULL for batches from before the key pool
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS api_key_id TEXT',
+        # File calls are routed to their batch's key
+        'CREATE INDEX IF NOT EXISTS batch_jobs_openai_file_id_idx ON batch_jobs (openai_file_id)',
+        'CREATE INDEX IF NOT EXISTS batch_jobs_output_file_id_idx ON batch_jobs (output_file_id)',
+    ]),
+    (12, [
+        # Set by the reconciler when an unfinished batch is absent from its key's batches.list
+        'ALTER TABLE batch_jobs ADD COLUMN IF NOT EXISTS missing_upstream_at TIMESTAMP',
+    ]),
+    (13, [
+        # Deletions often run after their batch row is gone, so they carry the key themselves
+        'ALTER TABLE file_deletions ADD COLUMN IF NOT EXISTS api_key_id TEXT',
+        'ALTER TABLE file_deletions ADD COLUMN IF NOT EXISTS reason TEXT',
+    ]),
+    (14, [
+        # Per-token counters kept up to date by the statements that change batch jobs and
+        # balances, so account summaries are one primary-key read instead of a batch_jobs scan
+        '''CREATE TABLE IF NOT EXISTS token_stats
+           (token TEXT PRIMARY KEY, active_batches INTEGER DEFAULT 0, completed_batches INTEGER DEFAULT 0,
+            failed_batches INTEGER DEFAULT 0, requests_submitted BIGINT DEFAULT 0,
+            tokens_spent BIGINT DEFAULT 0, updated_at TIMESTAMP)''',
+        # Batches cost one token per request, so past spending is taken from their request totals
+        f'''INSERT INTO token_stats (token, active_batches, completed_batches, failed_batches,
+                                     requests_submitted, tokens_spent, updated_at)
+            SELECT t.token,
+                   COUNT(b.id) FILTER (WHERE b.status <> ALL(ARRAY{list(TERMINAL_STATUSES)})),
+                   COUNT(b.id) FILTER (WHERE b.status = 'completed'),
+                   COUNT(b.id) FILTER (WHERE b.status = ANY(ARRAY{list(TERMINAL_STATUSES)}) AND b.status <> 'completed'),
+                   COALESCE(SUM(b.request_total), 0), COALESCE(SUM(b.request_total), 0), now()
+            FROM tokens t LEFT JOIN batch_jobs b ON b.token = t.token
+            GROUP BY t.token
+            ON CONFLICT (token) DO NOTHING''',
+    ]),
+    (15, BATCH_LOGS_PARTITIONING_DDL + [
+        # Terminal batch jobs past BATCH_JOB_ARCHIVE_DAYS move here, keeping batch_jobs and its
+        # indexes down to the batches still in play. Created with batch_jobs' columns as of
+        # this migration; later ones reach it only through ARCHIVED_BATCH_JOB_COLUMNS.
+        '''CREATE TABLE IF NOT EXISTS batch_jobs_archive
+           (LIKE batch_jobs INCLUDING DEFAULTS, archived_at TIMESTAMP, PRIMARY KEY (id))''',
+        'CREATE INDEX IF NOT EXISTS batch_jobs_archive_token_created_at_idx ON batch_jobs_archive (token, created_at)',
+        'CREATE INDEX IF NOT EXISTS batch_jobs_archive_openai_file_id_idx ON batch_jobs_archive (openai_file_id)',
+        'CREATE INDEX IF NOT EXISTS batch_jobs_archive_output_file_id_idx ON batch_jobs_archive (output_file_id)',
+        # Reads that need history go through the view; each branch uses its own table's indexes
+        f'''CREATE OR REPLACE VIEW batch_jobs_all AS
+            SELECT {', '.join(ARCHIVED_BATCH_JOB_COLUMNS)}, NULL::timestamp AS archived_at FROM batch_jobs
+            UNION ALL
+            SELECT {', '.join(ARCHIVED_BATCH_JOB_COLUMNS)}, archived_at FROM batch_jobs_archive''',
+    ]),
+    (16, [
+        # Batches flagged as gone upstream now count as failed rather than active
+        f'''UPDATE token_stats s SET active_batches = s.active_batches - m.batches,
+                                    failed_batches = s.failed_batches + m.batches
+            FROM (SELECT token, COUNT(*) AS batches FROM batch_jobs
+                  WHERE missing_upstream_at IS NOT NULL AND status <> ALL(ARRAY{list(TERMINAL_STATUSES)})
+                  GROUP BY token) m
+            WHERE s.token = m.token''',
+    ]),
+    (17, [
+        # The key a submission was sent with, so one cut off mid-create can be looked up there
+        'ALTER TABLE batch_submissions ADD COLUMN IF NOT EXISTS api_key_id TEXT',
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+db_instrumentation.instrumentation.configure(enabled=DB_INSTRUMENTATION, slow_query_ms=DB_SLOW_QUERY_MS)
+
+def get_db_connection():
+    import psycopg2  # Deferred until the first query
+    return db_instrumentation.connect(psycopg2.connect, DATABASE_URL)
 
 # Initialize database
 def init_db():
     logger.info("Initializing database")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS tokens
-                 (token TEXT PRIMARY KEY, amount INTEGER, used INTEGER, expiry TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS batch_jobs
-                 (id TEXT PRIMARY KEY, status TEXT, created_at TIMESTAMP, token TEXT, openai_file_id TEXT, output_file_id TEXT)''')
+    c.execute("SELECT to_regclass('schema_migrations')")
+    current_version = 0
+    if c.fetchone()[0]:
+        c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        current_version = c.fetchone()[0]
+
+    if current_version >= SCHEMA_VERSION:
+        conn.close()
+        logger.info(f"Database schema is up to date (version {current_version})")
+        return
+
+    # CREATE TABLE IF NOT EXISTS is not safe against a concurrent create, so it takes the lock too
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                 (version INTEGER PRIMARY KEY, applied_at TIMESTAMP)''')
     conn.commit()
+    for version, statements in MIGRATIONS:
+        # The advisory lock stops two dynos booting together from applying the same migration
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+        c.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+        if c.fetchone():
+            conn.commit()
+            continue
+        logger.info(f"Applying schema migration {version}")
+        for statement in statements:
+            c.execute(statement)
+        c.execute("INSERT INTO schema_migrations (version, applied_at) VALUES (%s, %s)", (version, datetime.now()))
+        conn.commit()
     conn.close()
-    logger.info("Database initialized successfully")
-    
-    # Initialize batch_logs table
-    batch_logger._create_table()
+    logger.info(f"Database initialized successfully (version {SCHEMA_VERSION})")
 
 # Database operations
-def db_create_token(token, amount):
-    logger.info(f"Creating token: {token} with amount: {amount}")
-    conn = psycopg2.connect(DATABASE_URL)
+def db_create_token(token, amount, expiry, tier='default'):
+    logger.info(f"Creating token: {token} with amount: {amount} (tier: {tier})")
+    conn = get_db_connection()
     c = conn.cursor()
-    expiry = datetime.now() + timedelta(hours=24)
-    c.execute("INSERT INTO tokens (token, amount, used, expiry) VALUES (%s, %s, %s, %s)", 
-              (token, amount, 0, expiry))
+    c.execute("INSERT INTO tokens (token, amount, used, expiry, tier) VALUES (%s, %s, %s, %s, %s)", 
+              (token, amount, 0, expiry, tier))
+    c.execute("INSERT INTO token_stats (token, updated_at) VALUES (%s, %s)", (token, datetime.now()))
     conn.commit()
     conn.close()
     logger.info(f"Token created successfully: {token}")
 
 def db_get_token(token):
     logger.info(f"Retrieving token: {token}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT * FROM tokens WHERE token = %s", (token,))
+    c.execute("SELECT token, amount, used, expiry, jobs_version, tier FROM tokens WHERE token = %s", (token,))
     result = c.fetchone()
     conn.close()
     if result:
         logger.info(f"Token retrieved: {token}")
-        return {'token': result[0], 'amount': result[1], 'used': result[2], 'expiry': result[3]}
+        return {'token': result[0], 'amount': result[1], 'used': result[2], 'expiry': result[3],
+                'jobs_version': result[4], 'tier': result[5]}
     logger.warning(f"Token not found: {token}")
     return None
 
-def db_update_token_amount(token, new_amount):
-    logger.info(f"Updating token amount: {token} to {new_amount}")
-    conn = psycopg2.connect(DATABASE_URL)
+def db_adjust_token_amount(token, delta, requests_submitted=0, minimum=None):
+    # Adds delta to the balance in one statement, so concurrent charges and refunds never lose
+    # an update, and counts it in token_stats in the same transaction. With minimum set, the
+    # change is refused if the balance would drop below it. Returns the new balance, or None.
+    logger.info(f"Adjusting token amount: {token} by {delta}")
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("UPDATE tokens SET amount = %s WHERE token = %s", (new_amount, token))
+    c.execute("""UPDATE tokens SET amount = amount + %s
+                 WHERE token = %s AND (%s::integer IS NULL OR amount + %s >= %s)
+                 RETURNING amount""", (delta, token, minimum, delta, minimum))
+    result = c.fetchone()
+    if result:
+        bump_token_stats(c, token, tokens_spent=-delta, requests_submitted=requests_submitted)
     conn.commit()
     conn.close()
-    logger.info(f"Token amount updated successfully: {token}")
+    return result[0] if result else None
+
+def bump_token_stats(c, token, **deltas):
+    # Adds deltas to the token's token_stats counters, in the caller's transaction. Callers
+    # touch tokens before token_stats, so the two row locks are always taken in that order.
+    columns = [column for column, delta in deltas.items() if delta]
+    if not columns:
+        return
+    c.execute(f"""INSERT INTO token_stats (token, {', '.join(columns)}, updated_at)
+                  VALUES (%s, {', '.join(['%s'] * len(columns))}, %s)
+                  ON CONFLICT (token) DO UPDATE SET
+                      {', '.join(f'{column} = token_stats.{column} + EXCLUDED.{column}' for column in columns)},
+                      updated_at = EXCLUDED.updated_at""",
+              [token] + [deltas[column] for column in columns] + [datetime.now()])
+
+def batch_stats_column(status, missing_upstream=False):
+    # The token_stats counter a batch job counts toward. One flagged as gone upstream will
+    # never finish, so it counts as failed until it shows up again.
+    if status == 'completed':
+        return 'completed_batches'
+    if status in TERMINAL_STATUSES or missing_upstream:
+        return 'failed_batches'
+    return 'active_batches'
+
+def batch_stats_deltas(previous, current):
+    # token_stats deltas for a batch job going from previous to current (status, missing_upstream)
+    before, after = batch_stats_column(*previous), batch_stats_column(*current)
+    return {} if before == after else {before: -1, after: 1}
+
+def db_get_account_summary(token):
+    # Balance, tier and counters by primary key; None if the token has no row
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT t.amount, t.tier, t.expiry, s.active_batches, s.completed_batches, s.failed_batches,
+                        s.requests_submitted, s.tokens_spent
+                 FROM tokens t LEFT JOIN token_stats s ON s.token = t.token
+                 WHERE t.token = %s""", (token,))
+    result = c.fetchone()
+    conn.close()
+    if result is None:
+        return None
+    return {'balance': result[0], 'tier': result[1] or 'default', 'expiry': result[2],
+            'active_batches': result[3] or 0, 'completed_batches': result[4] or 0,
+            'failed_batches': result[5] or 0, 'requests_submitted': result[6] or 0,
+            'tokens_spent': result[7] or 0}
 
 def db_delete_token(token):
     logger.info(f"Deleting token: {token}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM tokens WHERE token = %s", (token,))
+    c.execute("DELETE FROM token_stats WHERE token = %s", (token,))
     conn.commit()
     conn.close()
     logger.info(f"Token deleted successfully: {token}")
 
-def db_create_batch_job(batch_id, status, created_at, token, openai_file_id, output_file_id=None):
+def db_create_batch_job(batch_id, status, created_at, token, openai_file_id, output_file_id=None, enqueued_tokens=0,
+                        api_key_id=None, num_requests=0):
     logger.info(f"Creating batch job: {batch_id}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("INSERT INTO batch_jobs (id, status, created_at, token, openai_file_id, output_file_id) VALUES (%s, %s, %s, %s, %s, %s)", 
-              (batch_id, status, created_at, token, openai_file_id, output_file_id))
+    lock_token_changes(c, token)
+    c.execute("INSERT INTO batch_jobs (id, status, created_at, token, openai_file_id, output_file_id, enqueued_tokens, api_key_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", 
+              (batch_id, status, created_at, token, openai_file_id, output_file_id, enqueued_tokens, api_key_id))
+    bump_token_stats(c, token, active_batches=1, requests_submitted=num_requests)
     conn.commit()
     conn.close()
     logger.info(f"Batch job created successfully: {batch_id}")
 
 def db_get_batch_job(batch_id):
     logger.info(f"Retrieving batch job: {batch_id}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT * FROM batch_jobs WHERE id = %s", (batch_id,))
+    c.execute("""SELECT id, status, created_at, token, openai_file_id, output_file_id, version, last_refreshed_at,
+                        api_key_id, request_total, request_completed, request_failed, completed_at, expires_at,
+                        archived_at, results_ingested_at
+                 FROM batch_jobs_all WHERE id = %s""", (batch_id,))
     result = c.fetchone()
     conn.close()
     if result:
         logger.info(f"Batch job retrieved: {batch_id}")
         return {'id': result[0], 'status': result[1], 'created_at': result[2], 
-                'token': result[3], 'openai_file_id': result[4], 'output_file_id': result[5]}
+                'token': result[3], 'openai_file_id': result[4], 'output_file_id': result[5],
+                'version': result[6], 'last_refreshed_at': result[7], 'api_key_id': result[8],
+                'request_total': result[9], 'request_completed': result[10], 'request_failed': result[11],
+                'completed_at': result[12], 'expires_at': result[13], 'archived': result[14] is not None,
+                'results_ingested_at': result[15]}
     logger.warning(f"Batch job not found: {batch_id}")
     return None
 
-def db_update_batch_job(batch_id, status=None, output_file_id=None):
-    logger.info(f"Updating batch job: {batch_id}")
-    conn = psycopg2.connect(DATABASE_URL)
+def lock_token_changes(c, token):
+    # Bumps the token's jobs_version, holding its row lock until commit. Taking it before any
+    # change_seq is drawn means one token's changes commit in sequence order, so a delta-sync
+    # cursor can never skip a change that commits late.
+    c.execute("UPDATE tokens SET jobs_version = jobs_version + 1 WHERE token = %s", (token,))
+
+def batch_progress_snapshot(openai_batch):
+    # The batch_jobs columns mirrored from an OpenAI batch
+    counts = openai_batch.request_counts
+    return {
+        'id': openai_batch.id,
+        'status': openai_batch.status,
+        'output_file_id': openai_batch.output_file_id,
+        'request_total': counts.total if counts else None,
+        'request_completed': counts.completed if counts else None,
+        'request_failed': counts.failed if counts else None,
+        'completed_at': to_timestamp(openai_batch.completed_at),
+        'expires_at': to_timestamp(openai_batch.expires_at),
+        'refreshed_at': datetime.now(),
+    }
+
+def db_update_batch_progress(batch_id, openai_batch):
+    # Stores the status, file and progress fields of a freshly retrieved OpenAI batch in one write.
+    # The row's version (and its token's jobs_version) only moves when one of them changed.
+    # Returns (version, previous status): the batch job's current version and the status this
+    # write replaced, which concurrent refreshes of the same batch never both see as unfinished.
+    logger.info(f"Updating progress snapshot for batch job: {batch_id}")
+    snapshot = batch_progress_snapshot(openai_batch)
+    read_row = """SELECT version, token, status, missing_upstream_at IS NOT NULL,
+                         (status, output_file_id, request_total, request_completed, request_failed,
+                          completed_at, expires_at)
+                         IS DISTINCT FROM
+                         (%(status)s, COALESCE(%(output_file_id)s, output_file_id), %(request_total)s,
+                          %(request_completed)s, %(request_failed)s,
+                          %(completed_at)s::timestamp, %(expires_at)s::timestamp)
+                  FROM batch_jobs WHERE id = %(id)s"""
+    conn = get_db_connection()
     c = conn.cursor()
-    if status:
-        c.execute("UPDATE batch_jobs SET status = %s WHERE id = %s", (status, batch_id))
-        logger.info(f"Updated status for batch job {batch_id}: {status}")
-    if output_file_id:
-        c.execute("UPDATE batch_jobs SET output_file_id = %s WHERE id = %s", (output_file_id, batch_id))
-        logger.info(f"Updated output_file_id for batch job {batch_id}: {output_file_id}")
+    c.execute(read_row, snapshot)
+    result = c.fetchone()
+    if result is not None and (result[3] or result[4]):
+        # Token lock first, as everywhere else, then the row lock; the re-read under it is what
+        # this write replaces, even when another refresh of the batch committed in between
+        lock_token_changes(c, result[1])
+        c.execute(read_row + " FOR UPDATE", snapshot)
+        result = c.fetchone()
+    if result is None:
+        conn.close()
+        return None, None
+    version, token, previous_status, missing_upstream, changed = result
+    # OpenAI just answered for the batch, so it is no longer missing upstream
+    bump_token_stats(c, token, **batch_stats_deltas((previous_status, missing_upstream), (snapshot['status'], False)))
+    if changed:
+        c.execute("""UPDATE batch_jobs SET
+                         version = version + 1, change_seq = nextval('batch_jobs_change_seq'),
+                         status = %(status)s, output_file_id = COALESCE(%(output_file_id)s, output_file_id),
+                         request_total = %(request_total)s, request_completed = %(request_completed)s,
+                         request_failed = %(request_failed)s, completed_at = %(completed_at)s,
+                         expires_at = %(expires_at)s, last_refreshed_at = %(refreshed_at)s,
+                         missing_upstream_at = NULL
+                     WHERE id = %(id)s
+                     RETURNING version""", snapshot)
+        version = c.fetchone()[0]
+    else:
+        c.execute("""UPDATE batch_jobs SET last_refreshed_at = %(refreshed_at)s, missing_upstream_at = NULL
+                     WHERE id = %(id)s""", snapshot)
     conn.commit()
     conn.close()
-    logger.info(f"Batch job updated successfully: {batch_id}")
+    return version, previous_status
+
+def db_reconcile_batch_jobs(snapshots, missing_ids):
+    # Applies many batch progress snapshots in one transaction, with the same versioning as
+    # db_update_batch_progress, and flags missing_ids as gone upstream. Returns
+    # (changed, flagged): changed as (id, token, previous status) of rows whose snapshot moved,
+    # flagged as the ids newly marked missing.
+    from psycopg2.extras import execute_values
+    conn = get_db_connection()
+    c = conn.cursor()
+    now = datetime.now()
+    c.execute("""CREATE TEMP TABLE reconcile_snapshots
+                 (id TEXT PRIMARY KEY, status TEXT, output_file_id TEXT, request_total INTEGER,
+                  request_completed INTEGER, request_failed INTEGER, completed_at TIMESTAMP,
+                  expires_at TIMESTAMP) ON COMMIT DROP""")
+    execute_values(c, "INSERT INTO reconcile_snapshots VALUES %s",
+                   [(s['id'], s['status'], s['output_file_id'], s['request_total'], s['request_completed'],
+                     s['request_failed'], s['completed_at'], s['expires_at']) for s in snapshots])
+    changed_condition = """(b.status, b.output_file_id, b.request_total, b.request_completed, b.request_failed,
+                            b.completed_at, b.expires_at)
+                           IS DISTINCT FROM
+                           (s.status, COALESCE(s.output_file_id, b.output_file_id), s.request_total,
+                            s.request_completed, s.request_failed, s.completed_at, s.expires_at)"""
+    # Token locks first, in a fixed order, so the change_seq drawn below commits in order per
+    # token. Then the rows: statuses read under their locks are the ones the update replaces,
+    # even when a status request refreshed one of the batches since the sweep started.
+    c.execute("""SELECT token FROM tokens WHERE token IN (
+                     SELECT b.token FROM batch_jobs b JOIN reconcile_snapshots s ON s.id = b.id
+                     UNION
+                     SELECT token FROM batch_jobs WHERE id = ANY(%s) AND missing_upstream_at IS NULL)
+                 ORDER BY token FOR UPDATE""", (list(missing_ids),))
+    c.execute("""SELECT b.id, b.token, b.status, b.missing_upstream_at IS NOT NULL
+                 FROM batch_jobs b JOIN reconcile_snapshots s ON s.id = b.id
+                 ORDER BY b.id FOR UPDATE OF b""")
+    previous = {batch_id: (token, status, missing_upstream) for batch_id, token, status, missing_upstream in c.fetchall()}
+    c.execute(f"""UPDATE batch_jobs b SET
+                      version = b.version + 1, change_seq = nextval('batch_jobs_change_seq'),
+                      status = s.status, output_file_id = COALESCE(s.output_file_id, b.output_file_id),
+                      request_total = s.request_total, request_completed = s.request_completed,
+                      request_failed = s.request_failed, completed_at = s.completed_at,
+                      expires_at = s.expires_at, last_refreshed_at = %s, missing_upstream_at = NULL
+                  FROM reconcile_snapshots s
+                  WHERE s.id = b.id AND {changed_condition}
+                  RETURNING b.id, b.token, s.status""", (now,))
+    statuses = {batch_id: status for batch_id, _, status in c.fetchall()}
+    changed = [(batch_id, previous[batch_id][0], previous[batch_id][1]) for batch_id in statuses]
+    for token in sorted({token for _, token, _ in changed}):
+        lock_token_changes(c, token)
+    # Unchanged rows only need their refresh time; the changed ones already carry it
+    c.execute("""UPDATE batch_jobs b SET last_refreshed_at = %s, missing_upstream_at = NULL
+                 FROM reconcile_snapshots s WHERE s.id = b.id AND b.last_refreshed_at IS DISTINCT FROM %s""",
+              (now, now))
+    c.execute("""UPDATE batch_jobs SET missing_upstream_at = %s
+                 WHERE id = ANY(%s) AND missing_upstream_at IS NULL RETURNING id, token, status""",
+              (now, list(missing_ids)))
+    flagged = c.fetchall()
+    # Every listed batch is now known upstream; flagged ones count as failed from here on
+    deltas = {}
+    transitions = [(token, (status, missing_upstream), (statuses.get(batch_id, status), False))
+                   for batch_id, (token, status, missing_upstream) in previous.items()]
+    transitions += [(token, (status, False), (status, True)) for _, token, status in flagged]
+    for token, before, after in transitions:
+        for column, delta in batch_stats_deltas(before, after).items():
+            deltas.setdefault(token, {}).setdefault(column, 0)
+            deltas[token][column] += delta
+    for token in sorted(deltas):
+        bump_token_stats(c, token, **deltas[token])
+    flagged = [batch_id for batch_id, _, _ in flagged]
+    conn.commit()
+    conn.close()
+    return changed, flagged
+
+def db_get_unfinished_batch_jobs():
+    # Rows already flagged as missing upstream are left out, or every sweep would page back to them
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id, token, status, api_key_id, created_at FROM batch_jobs
+                 WHERE status <> ALL(%s) AND missing_upstream_at IS NULL""", (list(TERMINAL_STATUSES),))
+    results = c.fetchall()
+    conn.close()
+    return [{'id': r[0], 'token': r[1], 'status': r[2], 'api_key_id': r[3], 'created_at': r[4]} for r in results]
+
+def db_archive_batch_jobs(cutoff, limit):
+    # Moves up to limit terminal batch jobs that ended before cutoff into batch_jobs_archive,
+    # in one short transaction; returns how many moved. Only rows nothing will write again
+    # qualify: no budget held, and completed batches already ingested. Rows locked by a
+    # concurrent writer are skipped until the next chunk.
+    columns = ', '.join(ARCHIVED_BATCH_JOB_COLUMNS)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(f"""WITH moved AS (
+                     DELETE FROM batch_jobs WHERE id IN (
+                         SELECT id FROM batch_jobs
+                         WHERE status = ANY(%s) AND enqueued_tokens = 0
+                           AND COALESCE(completed_at, last_refreshed_at, created_at) < %s
+                           AND (status <> 'completed' OR results_ingested_at IS NOT NULL)
+                         LIMIT %s FOR UPDATE SKIP LOCKED)
+                     RETURNING {columns})
+                 INSERT INTO batch_jobs_archive ({columns}, archived_at) SELECT {columns}, %s FROM moved""",
+              (list(TERMINAL_STATUSES), cutoff, limit, datetime.now()))
+    moved = c.rowcount
+    conn.commit()
+    conn.close()
+    return moved
 
 def db_delete_batch_job(batch_id):
     logger.info(f"Deleting batch job: {batch_id}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("DELETE FROM batch_jobs WHERE id = %s", (batch_id,))
+    c.execute("SELECT token, status, missing_upstream_at IS NOT NULL FROM batch_jobs_all WHERE id = %s", (batch_id,))
+    for token, status, missing_upstream in c.fetchall():
+        lock_token_changes(c, token)
+        c.execute("DELETE FROM batch_jobs WHERE id = %s", (batch_id,))
+        c.execute("DELETE FROM batch_jobs_archive WHERE id = %s", (batch_id,))
+        if batch_stats_column(status, missing_upstream) == 'active_batches':
+            bump_token_stats(c, token, active_batches=-1)
+        c.execute("""INSERT INTO batch_job_deletions (batch_id, token, deleted_at) VALUES (%s, %s, %s)
+                     ON CONFLICT (batch_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at,
+                         change_seq = nextval('batch_jobs_change_seq')""",
+                  (batch_id, token, datetime.now()))
+    c.execute("DELETE FROM batch_results WHERE batch_id = %s", (batch_id,))
     conn.commit()
     conn.close()
     logger.info(f"Batch job deleted successfully: {batch_id}")
 
-def db_get_user_batch_jobs(user_token):
-    logger.info(f"Retrieving user batch jobs for token: {user_token}")
-    conn = psycopg2.connect(DATABASE_URL)
+def db_get_user_batch_jobs(user_token, since=None):
+    # Returns (jobs, deleted_ids, cursor). Without since, every job of the token; with a change
+    # cursor, only the jobs inserted or changed after it plus the IDs of jobs deleted after it.
+    # The returned cursor covers everything read, so it is what the client sends next time.
+    logger.info(f"Retrieving user batch jobs for token: {user_token} (since: {since})")
+    conn = get_db_connection()
+    c = conn.cursor()
+    # One snapshot for both reads, so a delete cannot land between them. Only columns whose
+    # changes draw a new change_seq (and bump jobs_version) are returned, so the list ETag and
+    # delta cursor stay exact; last_refreshed_at moves on every unchanged poll and is left out.
+    c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    c.execute("""SELECT id, status, created_at, output_file_id, request_total, request_completed,
+                        request_failed, completed_at, expires_at, change_seq
+                 FROM batch_jobs_all WHERE token = %s AND change_seq > %s
+                 ORDER BY """ + ('created_at' if since is None else 'change_seq'), (user_token, since or 0))
+    results = c.fetchall()
+    c.execute("""SELECT batch_id, change_seq FROM batch_job_deletions
+                 WHERE token = %s AND change_seq > %s ORDER BY change_seq""", (user_token, since or 0))
+    deletions = c.fetchall()
+    conn.close()
+    cursor = max([since or 0] + [r[9] for r in results] + [d[1] for d in deletions])
+    logger.info(f"Retrieved {len(results)} batch jobs and {len(deletions)} deletions for user token: {user_token}")
+    jobs = [{'id': r[0], 'status': r[1], 'created_at': r[2], 'output_file_id': r[3],
+             'request_counts': {'total': r[4], 'completed': r[5], 'failed': r[6]},
+             'completed_at': r[7], 'expires_at': r[8]} for r in results]
+    deleted = [d[0] for d in deletions] if since is not None else []
+    return jobs, deleted, cursor
+
+def db_release_batch_budget(batch_id):
+    # Zeroes the batch's enqueued tokens, returning (token, tokens) the first time only, so
+    # concurrent refreshes that both see it finish cannot release its budget twice
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""UPDATE batch_jobs b SET enqueued_tokens = 0
+                 FROM (SELECT id, enqueued_tokens FROM batch_jobs WHERE id = %s FOR UPDATE) old
+                 WHERE b.id = old.id AND old.enqueued_tokens > 0
+                 RETURNING b.token, old.enqueued_tokens, b.api_key_id""", (batch_id,))
+    result = c.fetchone()
+    conn.commit()
+    conn.close()
+    return result
+
+def db_get_enqueued_budgets():
+    # Per token and key: (batches, estimated tokens) still held against enqueued-token limits
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT token, api_key_id, COUNT(*), SUM(enqueued_tokens) FROM batch_jobs
+                 WHERE enqueued_tokens > 0 GROUP BY token, api_key_id""")
+    results = c.fetchall()
+    conn.close()
+    return results
+
+def db_create_submission(submission_id, token, filename, path, num_requests, estimated_tokens):
+    conn = get_db_connection()
+    c = conn.cursor()
+    now = datetime.now()
+    c.execute("""INSERT INTO batch_submissions
+                 (id, token, filename, path, num_requests, estimated_tokens, status, created_at, updated_at)
+                 VALUES (%s, %s, %s, %s, %s, %s, 'queued', %s, %s)""",
+              (submission_id, token, filename, path, num_requests, estimated_tokens, now, now))
+    conn.commit()
+    conn.close()
+
+def db_update_submission(submission_id, status, batch_id=None, error=None, api_key_id=None):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""UPDATE batch_submissions SET status = %s, batch_id = %s, error = %s,
+                 api_key_id = COALESCE(%s, api_key_id), updated_at = %s WHERE id = %s""",
+              (status, batch_id, error, api_key_id, datetime.now(), submission_id))
+    conn.commit()
+    conn.close()
+
+def db_get_submission(submission_id):
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT id, status, created_at FROM batch_jobs WHERE token = %s", (user_token,))
+    c.execute("""SELECT id, token, filename, num_requests, estimated_tokens, status, batch_id, error, created_at
+                 FROM batch_submissions WHERE id = %s""", (submission_id,))
+    result = c.fetchone()
+    conn.close()
+    if result:
+        return {'id': result[0], 'token': result[1], 'filename': result[2], 'num_requests': result[3],
+                'estimated_tokens': result[4], 'status': result[5], 'batch_id': result[6],
+                'error': result[7], 'created_at': result[8]}
+    return None
+
+def db_get_waiting_submissions():
+    # Submissions a stopped server never started
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id, token, filename, path, num_requests, estimated_tokens FROM batch_submissions
+                 WHERE status = 'queued' ORDER BY created_at""")
     results = c.fetchall()
     conn.close()
-    logger.info(f"Retrieved {len(results)} batch jobs for user token: {user_token}")
-    return [{'id': r[0], 'status': r[1], 'created_at': r[2]} for r in results]
+    return results
+
+def db_mark_submissions_reconciling():
+    # Submissions a stopped server was sending may or may not have created a batch upstream,
+    # so they wait for reconcile_submissions instead of being sent again
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE batch_submissions SET status = 'reconciling', updated_at = %s WHERE status = 'submitting'",
+              (datetime.now(),))
+    marked = c.rowcount
+    conn.commit()
+    conn.close()
+    return marked
+
+def db_get_reconciling_submissions():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id, token, filename, path, num_requests, estimated_tokens, api_key_id, created_at
+                 FROM batch_submissions WHERE status = 'reconciling' ORDER BY created_at""")
+    results = c.fetchall()
+    conn.close()
+    return [{'id': r[0], 'token': r[1], 'filename': r[2], 'path': r[3], 'num_requests': r[4],
+             'estimated_tokens': r[5], 'api_key_id': r[6], 'created_at': r[7]} for r in results]
 
 def db_get_user_file_ids(user_token):
     logger.info(f"Retrieving user file IDs for token: {user_token}")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT openai_file_id FROM batch_jobs WHERE token = %s", (user_token,))
+    # Files the garbage collector already deleted are no longer the user's to clean up
+    c.execute("""SELECT b.openai_file_id FROM batch_jobs_all b
+                 WHERE b.token = %s
+                   AND NOT EXISTS (SELECT 1 FROM file_deletions d
+                                   WHERE d.file_id = b.openai_file_id AND d.status = 'deleted')""", (user_token,))
     results = c.fetchall()
     conn.close()
     logger.info(f"Retrieved {len(results)} file IDs for user token: {user_token}")
     return [r[0] for r in results]
 
+def db_schedule_file_deletions(batch_id, token, file_ids, api_key_id=None, reason=None):
+    logger.info(f"Scheduling deletion of {len(file_ids)} files for batch {batch_id}")
+    conn = get_db_connection()
+    c = conn.cursor()
+    scheduled = []
+    for file_id in file_ids:
+        # Files already pending are left alone; failed ones are re-armed, and so are 'deleted'
+        # ones the garbage collector still found upstream
+        c.execute("""INSERT INTO file_deletions (file_id, batch_id, token, status, attempts, updated_at, api_key_id, reason)
+                     VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s)
+                     ON CONFLICT (file_id) DO UPDATE SET status = 'pending', attempts = 0, updated_at = EXCLUDED.updated_at,
+                         api_key_id = EXCLUDED.api_key_id, reason = EXCLUDED.reason
+                     WHERE file_deletions.status <> 'pending'
+                     RETURNING file_id""",
+                  (file_id, batch_id, token, datetime.now(), api_key_id, reason))
+        if c.fetchone():
+            scheduled.append(file_id)
+    conn.commit()
+    conn.close()
+    logger.info(f"Scheduled {len(scheduled)} file deletions for batch {batch_id}")
+    return scheduled
+
+def db_update_file_deletion(file_id, status, attempts, last_error=None):
+    logger.info(f"Updating file deletion {file_id}: {status} after {attempts} attempts")
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE file_deletions SET status = %s, attempts = %s, last_error = %s, updated_at = %s WHERE file_id = %s",
+              (status, attempts, last_error, datetime.now(), file_id))
+    conn.commit()
+    conn.close()
+
+def db_create_webhook(webhook_id, token, batch_id, url, secret):
+    logger.info(f"Creating webhook {webhook_id} for token {token}")
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("INSERT INTO webhooks (id, token, batch_id, url, secret, created_at) VALUES (%s, %s, %s, %s, %s, %s)",
+              (webhook_id, token, batch_id, url, secret, datetime.now()))
+    conn.commit()
+    conn.close()
+
+def db_get_user_webhooks(token):
+    logger.info(f"Retrieving webhooks for token: {token}")
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, batch_id, url, created_at FROM webhooks WHERE token = %s ORDER BY created_at", (token,))
+    results = c.fetchall()
+    conn.close()
+    return [{'id': r[0], 'batch_id': r[1], 'url': r[2], 'created_at': r[3]} for r in results]
+
+def db_delete_webhook(webhook_id, token):
+    logger.info(f"Deleting webhook {webhook_id} for token {token}")
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM webhooks WHERE id = %s AND token = %s", (webhook_id, token))
+    deleted = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return deleted
+
+def db_set_api_key(token, key_id, secret):
+    # Replaces the token's own key: earlier ones are revoked, not deleted, so their batches still resolve
+    conn = get_db_connection()
+    c = conn.cursor()
+    now = datetime.now()
+    c.execute("UPDATE api_keys SET revoked_at = %s WHERE token = %s AND revoked_at IS NULL AND id <> %s",
+              (now, token, key_id))
+    c.execute("""INSERT INTO api_keys (id, token, secret, created_at) VALUES (%s, %s, %s, %s)
+                 ON CONFLICT (id) DO UPDATE SET token = EXCLUDED.token, secret = EXCLUDED.secret, revoked_at = NULL""",
+              (key_id, token, encrypt_secret(API_KEY_ENCRYPTION_KEY, secret), now))
+    conn.commit()
+    conn.close()
+
+def db_revoke_api_keys(token):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("UPDATE api_keys SET revoked_at = %s WHERE token = %s AND revoked_at IS NULL", (datetime.now(), token))
+    revoked = c.rowcount
+    conn.commit()
+    conn.close()
+    return revoked
+
+def db_get_api_key(key_id=None, token=None):
+    # By id (revoked or not, for routing a batch) or the token's active key
+    conn = get_db_connection()
+    c = conn.cursor()
+    if key_id:
+        c.execute("SELECT id, token, secret, revoked_at FROM api_keys WHERE id = %s", (key_id,))
+    else:
+        c.execute("SELECT id, token, secret, revoked_at FROM api_keys WHERE token = %s AND revoked_at IS NULL",
+                  (token,))
+    result = c.fetchone()
+    conn.close()
+    if result:
+        return {'id': result[0], 'token': result[1], 'secret': decrypt_secret(API_KEY_ENCRYPTION_KEY, result[2]),
+                'revoked_at': result[3]}
+    return None
+
+def db_encrypt_api_keys():
+    # Encrypts keys stored before API_KEY_ENCRYPTION_KEY was set
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT id, secret FROM api_keys WHERE secret NOT LIKE %s FOR UPDATE", (ENCRYPTED_SECRET_PREFIX + '%',))
+    rows = c.fetchall()
+    for key_id, secret in rows:
+        c.execute("UPDATE api_keys SET secret = %s WHERE id = %s", (encrypt_secret(API_KEY_ENCRYPTION_KEY, secret), key_id))
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+def db_get_file_references():
+    # Every file a batch row still points at, with what decides whether it may be collected
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id, token, status, api_key_id, openai_file_id, output_file_id, created_at, completed_at,
+                        last_refreshed_at, results_ingested_at
+                 FROM batch_jobs_all""")
+    results = c.fetchall()
+    conn.close()
+    references = {}
+    for r in results:
+        batch = {'batch_id': r[0], 'token': r[1], 'status': r[2], 'api_key_id': r[3], 'created_at': r[6],
+                 'completed_at': r[7], 'last_refreshed_at': r[8], 'results_ingested_at': r[9]}
+        for file_id in (r[4], r[5]):
+            if file_id:
+                references[file_id] = batch
+    return references
+
+def db_get_file_deletion_states():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT file_id, status FROM file_deletions")
+    results = dict(c.fetchall())
+    conn.close()
+    return results
+
+def db_get_file_api_key_id(file_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT api_key_id FROM batch_jobs_all WHERE openai_file_id = %s OR output_file_id = %s LIMIT 1",
+              (file_id, file_id))
+    result = c.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+def db_file_belongs_to_token(file_id, token):
+    # Whether the file is the input or output of one of the token's batches, archived or not
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT 1 FROM batch_jobs_all WHERE token = %s AND (openai_file_id = %s OR output_file_id = %s)
+                 LIMIT 1""", (token, file_id, file_id))
+    result = c.fetchone()
+    conn.close()
+    return result is not None
+
+def db_get_watched_batch_jobs(limit, include_enqueued=False):
+    # Unfinished batch jobs that some webhook is waiting on, plus, with include_enqueued,
+    # those holding enqueued-token budget that queued submissions are waiting for
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT b.id, b.status, b.token, b.api_key_id FROM batch_jobs b
+                 WHERE b.status <> ALL(%s)
+                   AND ((%s AND b.enqueued_tokens > 0)
+                        OR EXISTS (SELECT 1 FROM webhooks w
+                                   WHERE w.token = b.token AND (w.batch_id IS NULL OR w.batch_id = b.id)))
+                 ORDER BY b.last_refreshed_at NULLS FIRST LIMIT %s""",
+              (list(TERMINAL_STATUSES), include_enqueued, limit))
+    results = c.fetchall()
+    conn.close()
+    return [{'id': r[0], 'status': r[1], 'token': r[2], 'api_key_id': r[3]} for r in results]
+
+def db_get_batch_results(batch_id, after, limit):
+    # Keyset pagination on the primary key: each page is an index range scan
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT custom_id, decision, prompt_tokens, completion_tokens, total_tokens, error
+                 FROM batch_results WHERE batch_id = %s AND custom_id > %s
+                 ORDER BY custom_id LIMIT %s""", (batch_id, after, limit))
+    results = c.fetchall()
+    conn.close()
+    return [{'custom_id': r[0], 'decision': r[1],
+             'usage': {'prompt_tokens': r[2], 'completion_tokens': r[3], 'total_tokens': r[4]},
+             'error': r[5]} for r in results]
+
 # Helper functions
-def generate_token():
+def generate_token(expiry):
     token = secrets.token_urlsafe(16)
+    if TOKEN_SIGNING_KEY:
+        token = issue_token(TOKEN_SIGNING_KEY, token, expiry)
     logger.info(f"Generated new token: {token}")
     return token
 
-def create_token(amount):
-    user_token = generate_token()
-    db_create_token(user_token, amount)
+def create_token(amount, tier='default'):
+    # Whole seconds, so the stored expiry matches the one embedded in a signed token
+    expiry = (datetime.now() + TOKEN_LIFETIME).replace(microsecond=0)
+    user_token = generate_token(expiry)
+    db_create_token(user_token, amount, expiry, tier)
+    remember_token_tier(user_token, tier)
     logger.info(f"Created token with amount {amount}: {user_token}")
     return user_token
 
+def remember_token_tier(token, tier):
+    with token_tiers_lock:
+        token_tiers[token] = tier
+        token_tiers.move_to_end(token)
+        while len(token_tiers) > TOKEN_TIER_CACHE_SIZE:
+            token_tiers.popitem(last=False)
+
+def get_tier_profile(token):
+    with token_tiers_lock:
+        tier = token_tiers.get(token)
+    if tier is None:
+        token_data = db_get_token(token)
+        tier = token_data['tier'] if token_data and token_data['tier'] else 'default'
+        remember_token_tier(token, tier)
+    return TIER_PROFILES.get(tier, TIER_PROFILES['default'])
+
 def validate_token(token):
     logger.info(f"Validating token: {token}")
+    # Signed tokens are checked from the signature and embedded expiry alone; the balance is
+    # left to the operations that spend it. Opaque tokens, and signed ones issued before the
+    # key was removed, are looked up in the database.
+    if TOKEN_SIGNING_KEY and is_signed_token(token):
+        if verify_token(TOKEN_SIGNING_KEY, token) is None:
+            logger.warning(f"Token validation failed (bad signature or expired): {token}")
+            return False
+        logger.info(f"Signed token validated: {token}")
+        return True
     token_data = db_get_token(token)
     if token_data:
         current_time = datetime.now()
@@ -211,34 +1081,132 @@ def get_token_balance(token):
     logger.info(f"Balance for token {token}: {balance}")
     return balance
 
-def update_token_balance(token, amount):
+def update_token_balance(token, amount, requests_submitted=0):
     logger.info(f"Updating balance for token {token} by {amount}")
-    token_data = db_get_token(token)
-    if token_data:
-        new_amount = token_data['amount'] + amount
-        db_update_token_amount(token, new_amount)
+    new_amount = db_adjust_token_amount(token, amount, requests_submitted)
+    if new_amount is not None:
         logger.info(f"New balance for token {token}: {new_amount}")
 
+def charge_tokens(token, cost, requests_submitted=0):
+    # Debits cost only if the balance covers it, checked and applied in one statement so two
+    # concurrent uploads can't both pass the check. Returns the new balance, or None.
+    new_amount = db_adjust_token_amount(token, -cost, requests_submitted, minimum=0)
+    if new_amount is not None:
+        logger.info(f"Charged {cost} tokens to {token}; new balance {new_amount}")
+    return new_amount
+
 def delete_token(token):
     logger.info(f"Deleting token: {token}")
     db_delete_token(token)
 
-def create_openai_batch(file_id, user_token):
+# Server keys plus keys users bring for their own tokens; each has one shared OpenAI client
+key_pool = KeyPool(ORG_ENQUEUED_TOKEN_LIMIT, OPENAI_KEY_REQUESTS_PER_MINUTE)
+for secret in OPENAI_API_KEYS:
+    key_pool.add_server_key(secret)
+logger.info(f"Key pool initialized with {len(OPENAI_API_KEYS)} server keys")
+
+# Tokens whose own key was looked up and found missing, so uploads don't query api_keys every
+# time: token -> when it was looked up, least recently used first
+tokens_without_own_key = OrderedDict()
+tokens_without_own_key_lock = Lock()
+
+def remember_without_own_key(token, without=True):
+    with tokens_without_own_key_lock:
+        if not without:
+            tokens_without_own_key.pop(token, None)
+            return
+        tokens_without_own_key[token] = time.time()
+        tokens_without_own_key.move_to_end(token)
+        while len(tokens_without_own_key) > OWN_KEY_LOOKUP_CACHE_SIZE:
+            tokens_without_own_key.popitem(last=False)
+
+def known_without_own_key(token):
+    with tokens_without_own_key_lock:
+        looked_up_at = tokens_without_own_key.get(token)
+        return looked_up_at is not None and time.time() - looked_up_at < OWN_KEY_LOOKUP_TTL_SECONDS
+
+def load_user_key(token):
+    # Returns the id of the token's own key, adding it to the pool on first use, or None
+    key_id = key_pool.user_key_id(token)
+    if key_id or known_without_own_key(token):
+        return key_id
+    api_key = db_get_api_key(token=token)
+    if api_key is None:
+        remember_without_own_key(token)
+        return None
+    return key_pool.add_user_key(token, api_key['secret'])
+
+def validate_openai_key(secret):
+    # One cheap authenticated call before a user's key is stored; False if OpenAI rejects it
+    from openai import OpenAI, AuthenticationError, PermissionDeniedError
+    client = OpenAI(api_key=secret, max_retries=0)
+    try:
+        upstream.call('models.list', key_id_for(secret, USER_KEY_PREFIX),
+                      lambda timeout: client.with_options(timeout=timeout).models.list(), retry=True)
+    except (AuthenticationError, PermissionDeniedError):
+        return False
+    return True
+
+def load_key(key_id):
+    # User keys that were revoked, or not yet loaded since a restart, are fetched so the
+    # batches they created stay reachable
+    if key_id and key_pool.get(key_id) is None:
+        api_key = db_get_api_key(key_id=key_id)
+        if api_key:
+            key_pool.add_user_key(api_key['token'], api_key['secret'], active=api_key['revoked_at'] is None)
+
+def get_api_key(key_id=None):
+    # The pool's key for key_id (None means the default server key); raises UnknownKeyError
+    load_key(key_id)
+    return key_pool.require(key_id)
+
+def get_openai_client(key_id=None):
+    # The client for the key that created a batch; None means the default server key
+    load_key(key_id)
+    return key_pool.client(key_id)
+
+# Chat completions for /classify, on a shared event loop with per-key RPM/TPM windows
+async_classifier = AsyncClassifier(CLASSIFY_CONCURRENCY, OPENAI_KEY_REQUESTS_PER_MINUTE, OPENAI_KEY_TOKENS_PER_MINUTE)
+
+# Timeouts, retries, hedging and a circuit breaker per key for everything sent to OpenAI
+upstream = Upstream(UPSTREAM_TIMEOUTS, max_attempts=UPSTREAM_MAX_ATTEMPTS,
+                    failure_threshold=UPSTREAM_BREAKER_FAILURES, reset_seconds=UPSTREAM_BREAKER_RESET_SECONDS,
+                    hedge_min_delay=UPSTREAM_HEDGE_MIN_SECONDS)
+
+def call_openai(operation, key_id, call, retry=False, hedge=False):
+    # Runs call(client) through the upstream layer with the operation's timeout. The SDK's own
+    # retries are off so upstream decides them; only pass retry/hedge for idempotent calls.
+    load_key(key_id)
+    key = key_pool.get(key_id)
+    key_id = key.id if key else key_id
+    return upstream.call(operation, key_id,
+                         lambda timeout: call(get_openai_client(key_id).with_options(timeout=timeout, max_retries=0)),
+                         retry=retry, hedge=hedge)
+
+def create_openai_batch(file_id, user_token, submission=None):
     logger.info(f"Creating OpenAI batch for file {file_id} and user token {user_token}")
-    client = OpenAI()
+    key_id = submission.key_id if submission else None
+    metadata = {"user_token": user_token}
+    if submission:
+        # Lets a client that was answered 'queued' match the batch back to its upload
+        metadata["submission_id"] = submission.id
     
     try:
-        batch = client.batches.create(
+        # Not retried: a create that timed out may still have made a batch upstream
+        batch = call_openai('batches.create', key_id, lambda client: client.batches.create(
             input_file_id=file_id,
             endpoint="/v1/chat/completions",
             completion_window="24h",
-            metadata={
-                "user_token": user_token
-            }
-        )
+            metadata=metadata
+        ))
         logger.info(f"OpenAI batch created successfully: {batch.id}")
         # Store the batch information in the database
-        db_create_batch_job(batch.id, batch.status, batch.created_at, user_token, file_id, batch.output_file_id)
+        # OpenAI reports created_at as a Unix timestamp; batch_jobs stores a TIMESTAMP
+        created_at = datetime.fromtimestamp(batch.created_at)
+        db_create_batch_job(batch.id, batch.status, created_at, user_token, file_id, batch.output_file_id,
+                            submission.estimated_tokens if submission else 0, get_api_key(key_id).id,
+                            submission.num_requests if submission else 0)
+        db_update_batch_progress(batch.id, batch)
         return batch
     except Exception as e:
         logger.error(f"Failed to create OpenAI batch: {str(e)}")
@@ -246,6 +1214,7 @@ def create_openai_batch(file_id, user_token):
 
 def rate_limited(token):
     logger.info(f"Checking rate limit for token: {token}")
+    requests_per_minute = get_tier_profile(token)['requests_per_minute']
     current_time = int(time.time())
     with rate_limit_lock:
         if token not in rate_limits:
@@ -253,9 +1222,9 @@ def rate_limited(token):
             logger.info(f"No rate limit for token: {token}")
             return False
         
-        # Allow 5 requests per minute per token
+        # Allow the tier's requests per minute per token
         rate_limits[token] = [t for t in rate_limits[token] if current_time - t < 60]
-        if len(rate_limits[token]) >= 5:
+        if len(rate_limits[token]) >= requests_per_minute:
             logger.warning(f"Rate limit exceeded for token: {token}")
             return True
         
@@ -263,22 +1232,39 @@ def rate_limited(token):
         logger.info(f"Rate limit not exceeded for token: {token}")
         return False
 
-def upload_file_to_openai(file):
+def upload_file_to_openai(file, key_id=None):
+    import requests
     logger.info(f"Uploading file to OpenAI: {file.filename}")
+    api_key = get_api_key(key_id)
     headers = {
-        "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"
+        "Authorization": f"Bearer {api_key.secret}"
     }
     files = {
         'file': (file.filename, file.stream, 'application/octet-stream'),
         'purpose': (None, 'batch')
     }
 
-    response = requests.post(
-        "https://api.openai.com/v1/files",
-        headers=headers,
-        files=files
-    )
+    def post(timeout):
+        key_pool.record_request(api_key.id)
+        return requests.post(
+            "https://api.openai.com/v1/files",
+            headers=headers,
+            files=files,
+            timeout=timeout
+        )
+
+    def check(response):
+        # Counted by the breaker as the failure it is, not as a successful call
+        if response.status_code >= 500 or response.status_code == 429:
+            raise UpstreamError(f'Failed to upload file to OpenAI API: {response.text}', response.status_code)
+        return response
 
+    # Not retried: the stream is consumed, and a retry could leave a duplicate file upstream
+    try:
+        response = upstream.call('files.create', api_key.id, lambda timeout: check(post(timeout)))
+    except UpstreamError as e:
+        logger.error(str(e))
+        raise
     if response.status_code != 200:
         logger.error(f"Failed to upload file to OpenAI API: {response.text}")
         raise Exception(f'Failed to upload file to OpenAI API: {response.text}')
@@ -287,13 +1273,16 @@ def upload_file_to_openai(file):
     return response.json()
 
 # Initialize the BatchLogger
-batch_logger = BatchLogger()
+# batch_logs is created by the migrations in init_db, so the logger never runs DDL itself
+batch_logger = BatchLogger(create_table=False)
 logger.info("BatchLogger initialized")
 
+webhook_dispatcher = WebhookDispatcher()
+
 # Add this function to check for admin access
 def is_admin():
-    admin_token = os.environ.get('ADMIN_TOKEN')
-    return request.headers.get('Admin-Token') == admin_token
+    # Shared with real_server and the profiler, so every admin route fails closed the same way
+    return request_profiler.is_admin_environ(request.environ)
 
 @app.route('/admin/batch_logs', methods=['GET'])
 def get_all_batch_logs():
@@ -304,7 +1293,8 @@ def get_all_batch_logs():
         return jsonify({'error': 'Unauthorized access'}), 403
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        from psycopg2.extras import RealDictCursor
+        conn = get_db_connection()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         logger.info("Retrieving all batch logs")
@@ -343,6 +1333,193 @@ def get_all_batch_logs():
         logger.error(f"Failed to retrieve batch logs: {str(e)}")
         return jsonify({'error': f"Failed to retrieve batch logs: {str(e)}"}), 500
 
+@app.route('/admin/export/<table>', methods=['GET'])
+def export_telemetry(table):
+    # Typed columnar export for notebooks: Parquet (zstd) or an Arrow IPC stream, streamed
+    # one row group at a time from a server-side cursor
+    logger.info(f"Admin telemetry export endpoint accessed for {table}")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin telemetry export")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    if table not in telemetry_export.EXPORT_TABLES:
+        return jsonify({'error': f"table must be one of {', '.join(sorted(telemetry_export.EXPORT_TABLES))}"}), 404
+    output_format = request.args.get('format', 'parquet')
+    if output_format not in telemetry_export.FORMATS:
+        return jsonify({'error': 'format must be parquet or arrow'}), 400
+    row_group_size = min(max(request.args.get('row_group_size', telemetry_export.DEFAULT_ROW_GROUP_SIZE, type=int),
+                             telemetry_export.MIN_ROW_GROUP_SIZE), telemetry_export.MAX_ROW_GROUP_SIZE)
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+        until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({'error': 'since and until must be ISO 8601 timestamps'}), 400
+
+    pa = telemetry_export.load_pyarrow()
+    if pa is None:
+        logger.error("Telemetry export requested but pyarrow is not installed")
+        return jsonify({'error': 'Columnar export is not available on this server'}), 501
+
+    mimetype, extension = telemetry_export.FORMATS[output_format]
+    chunks = telemetry_export.export_query(pa, get_db_connection, table, output_format, since, until, row_group_size)
+    return Response(chunks, mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment;filename={table}.{extension}"})
+
+@app.route('/admin/compact_batch_logs', methods=['POST'])
+def compact_batch_logs():
+    logger.info("Admin batch log compaction endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin batch log compaction")
+        return jsonify({'error': 'Unauthorized access'}), 403
+
+    older_than_days = request.args.get('older_than_days', BATCH_LOG_RETENTION_DAYS, type=int)
+    try:
+        deleted = batch_logger.compact(older_than_days)
+    except Exception as e:
+        logger.error(f"Failed to compact batch logs: {str(e)}")
+        return jsonify({'error': f"Failed to compact batch logs: {str(e)}"}), 500
+    return jsonify({'older_than_days': older_than_days, 'rows_deleted': deleted}), 200
+
+@app.route('/admin/reconcile_batches', methods=['POST'])
+def reconcile_batches_now():
+    logger.info("Admin reconcile batches endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to reconcile batches")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    return jsonify(reconcile_batch_jobs()), 200
+
+@app.route('/admin/file_gc', methods=['GET', 'POST'])
+def file_gc():
+    # GET reports orphaned OpenAI files; POST reports them and deletes them in the background
+    logger.info(f"Admin file GC endpoint accessed ({request.method})")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to file GC")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    try:
+        report = find_orphan_files()
+    except Exception as e:
+        logger.error(f"File GC failed: {str(e)}")
+        return jsonify({'error': f"File GC failed: {str(e)}"}), 500
+    if request.method == 'GET' or not report['orphans']:
+        return jsonify(report), 200
+    threading.Thread(target=delete_orphan_files, args=(report['orphans'],), daemon=True).start()
+    return jsonify(report), 202
+
+STATS_DEFAULT_BUCKETS = {'minute': 60, 'day': 30}
+STATS_MAX_BUCKETS = 1440
+
+@app.route('/admin/stats', methods=['GET'])
+def get_admin_stats():
+    logger.info("Admin stats endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin stats")
+        return jsonify({'error': 'Unauthorized access'}), 403
+
+    period = request.args.get('period', 'minute')
+    if period not in STATS_DEFAULT_BUCKETS:
+        return jsonify({'error': 'period must be minute or day'}), 400
+    user_token = request.args.get('user_token', ALL_USERS)
+    limit = min(request.args.get('limit', STATS_DEFAULT_BUCKETS[period], type=int), STATS_MAX_BUCKETS)
+
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Both reads are primary-key range scans over at most `limit` buckets,
+        # so the cost does not grow with the size of batch_logs
+        c.execute("""SELECT bucket, batches_created, batches_completed, requests_completed,
+                            requests_failed, tokens_debited
+                     FROM batch_stats WHERE period = %s AND user_token = %s
+                     ORDER BY bucket DESC LIMIT %s""", (period, user_token, limit))
+        rows = c.fetchall()
+        histograms = {}
+        if rows:
+            c.execute("""SELECT bucket, ttc_bucket, count FROM batch_stats_ttc
+                         WHERE period = %s AND user_token = %s AND bucket >= %s""",
+                      (period, user_token, rows[-1][0]))
+            for bucket, index, count in c.fetchall():
+                histograms.setdefault(bucket, {})[index] = count
+        conn.close()
+    except Exception as e:
+        logger.error(f"Failed to retrieve stats: {str(e)}")
+        return jsonify({'error': f"Failed to retrieve stats: {str(e)}"}), 500
+
+    buckets = []
+    totals = {'batches_created': 0, 'batches_completed': 0, 'requests_completed': 0,
+              'requests_failed': 0, 'tokens_debited': 0}
+    window_histogram = {}
+    for bucket, *counts in rows:
+        entry = dict(zip(totals, counts))
+        for key, value in entry.items():
+            totals[key] += value
+        histogram = histograms.get(bucket, {})
+        for index, count in histogram.items():
+            window_histogram[index] = window_histogram.get(index, 0) + count
+        entry['bucket'] = bucket.isoformat()
+        entry['p50_time_to_complete'] = ttc_percentile(histogram, 0.5)
+        entry['p95_time_to_complete'] = ttc_percentile(histogram, 0.95)
+        buckets.append(entry)
+
+    totals['p50_time_to_complete'] = ttc_percentile(window_histogram, 0.5)
+    totals['p95_time_to_complete'] = ttc_percentile(window_histogram, 0.95)
+    return jsonify({
+        'period': period,
+        'user_token': user_token,
+        'totals': totals,
+        'buckets': buckets,
+        'time_to_complete_bucket_bounds': TTC_BUCKET_BOUNDS
+    }), 200
+
+@app.route('/admin/startup', methods=['GET'])
+def get_startup_timings():
+    logger.info("Admin startup timings endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin startup timings")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    return jsonify({'startup_timings_ms': startup_timings, 'schema_version': SCHEMA_VERSION}), 200
+
+@app.route('/admin/scheduler', methods=['GET'])
+def get_scheduler_state():
+    logger.info("Admin scheduler endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin scheduler state")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    state = submission_scheduler.snapshot()
+    state['api_keys'] = key_pool.snapshot()
+    return jsonify(state), 200
+
+@app.route('/admin/upstream', methods=['GET'])
+def get_upstream_state():
+    logger.info("Admin upstream endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin upstream state")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    return jsonify(upstream.snapshot()), 200
+
+@app.route('/admin/db_stats', methods=['GET', 'DELETE'])
+def db_stats():
+    # Top statements by total time (or ?order=mean|max|calls); DELETE starts the counts over
+    logger.info("Admin DB stats endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin DB stats")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    if request.method == 'DELETE':
+        db_instrumentation.instrumentation.reset()
+        return jsonify({'message': 'DB stats reset'}), 200
+    limit = request.args.get('limit', DB_STATS_DEFAULT_LIMIT, type=int)
+    order = request.args.get('order', 'total')
+    if order not in db_instrumentation.SNAPSHOT_ORDERS:
+        return jsonify({'error': f"order must be one of {sorted(db_instrumentation.SNAPSHOT_ORDERS)}"}), 400
+    return jsonify(db_instrumentation.instrumentation.snapshot(max(limit, 1), order)), 200
+
+@app.before_request
+def record_first_request():
+    if 'time_to_first_request' not in startup_timings:
+        startup_timings['time_to_first_request'] = round((time.perf_counter() - STARTUP_STARTED_AT) * 1000, 2)
+        logger.info(f"Startup timings (ms): {startup_timings}")
+
+@app.after_request
+def compress_json_response(response):
+    return compress_response(response, request.accept_encodings)
+
 # Endpoints
 @app.route('/')
 def root():
@@ -373,37 +1550,57 @@ def check_balance():
         logger.warning(f"Rate limit exceeded for token: {user_token}")
         return jsonify({'error': 'Rate limit exceeded for this token'}), 429
 
-    token_data = db_get_token(user_token)
-    if token_data:
-        logger.info(f"Balance checked successfully for token {user_token}: {token_data['amount']}")
-        return jsonify({'balance': token_data['amount']}), 200
+    summary = db_get_account_summary(user_token)
+    if summary:
+        logger.info(f"Balance checked successfully for token {user_token}: {summary['balance']}")
+        tier = summary['tier']
+        return jsonify({'balance': summary['balance'], 'tier': tier,
+                        'limits': TIER_PROFILES.get(tier, TIER_PROFILES['default']),
+                        'expires_at': summary['expiry'].isoformat(),
+                        'batches': {'active': summary['active_batches'], 'completed': summary['completed_batches'],
+                                    'failed': summary['failed_batches']},
+                        'requests_submitted': summary['requests_submitted'],
+                        'tokens_spent': summary['tokens_spent']}), 200
     else:
         logger.warning(f"Invalid token: {user_token}")
         return jsonify({'error': 'Invalid token'}), 400
 
-@app.route('/upload_jsonl', methods=['POST'])
-def upload_jsonl():
-    logger.info("Upload JSONL endpoint accessed")
-    user_token = request.headers.get('User-Token')
-    if not user_token or not validate_token(user_token):
-        logger.warning(f"Invalid or expired token: {user_token}")
-        return jsonify({'error': 'Invalid or expired token'}), 400
-    if rate_limited(user_token):
-        logger.warning(f"Rate limit exceeded for token: {user_token}")
-        return jsonify({'error': 'Rate limit exceeded for this token'}), 429
-    
-    if 'file' not in request.files:
-        logger.warning("No file part in the request")
-        return jsonify({'error': 'No file part'}), 400
-    
-    file = request.files['file']
+def count_jsonl_requests(file):
+    # Count lines straight off the upload stream instead of decoding the whole file
+    file.seek(0)
+    num_requests = sum(1 for _ in file.stream)
+    file.seek(0)  # Reset file pointer to the beginning
+    return num_requests
+
+# Decode a '.jsonl.gz' / '.jsonl.zst' part into a plain JSONL part, streaming into a spooled temp file
+def decompress_upload_part(file):
+    encoding, filename = encoding_for_filename(file.filename)
+    if not encoding:
+        return file
+
+    logger.info(f"Decompressing {encoding} upload part {file.filename}")
+    # Stop one byte past the size limit so validation rejects oversized parts without inflating them fully
+    remaining = MAX_BATCH_SIZE_MB * 1024 * 1024 + 1
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    source = decompressing_stream(file.stream, encoding)
+    while remaining > 0:
+        chunk = source.read(min(64 * 1024, remaining))
+        if not chunk:
+            break
+        spooled.write(chunk)
+        remaining -= len(chunk)
+    spooled.seek(0)
+    return FileStorage(stream=spooled, filename=filename, content_type='application/jsonl')
+
+# Validate a single uploaded JSONL part, returning (num_requests, error)
+def validate_jsonl_file(file):
     if file.filename == '':
         logger.warning("No selected file")
-        return jsonify({'error': 'No selected file'}), 400
-    
+        return None, 'No selected file'
+
     if not file.filename.endswith('.jsonl'):
         logger.warning(f"Invalid file type: {file.filename}")
-        return jsonify({'error': 'File must be a JSONL file'}), 400
+        return None, 'File must be a JSONL file'
 
     # Check actual file size
     file.seek(0, os.SEEK_END)
@@ -412,60 +1609,450 @@ def upload_jsonl():
 
     if file_size > MAX_BATCH_SIZE_MB * 1024 * 1024:  # Convert MB to bytes
         logger.warning(f"File size exceeds maximum allowed: {file_size} bytes")
-        return jsonify({'error': f'File size exceeds maximum allowed ({MAX_BATCH_SIZE_MB} MB)'}), 400
+        return None, f'File size exceeds maximum allowed ({MAX_BATCH_SIZE_MB} MB)'
 
-    # Upload file to OpenAI API
-    try:
-        logger.info(f"Attempting to upload file {file.filename} to OpenAI")
-        openai_file_info = upload_file_to_openai(file)
-        logger.info(f"File {file.filename} successfully uploaded to OpenAI with ID: {openai_file_info['id']}")
-    except Exception as e:
-        logger.error(f"Failed to upload file to OpenAI: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+    num_requests = count_jsonl_requests(file)
+    logger.info(f"JSONL file {file.filename} contains {num_requests} requests")
 
-    # Create OpenAI batch
+    # Check if the number of requests exceeds the maximum allowed
+    if num_requests > MAX_BATCH_REQUESTS:
+        logger.warning(f"Number of requests ({num_requests}) exceeds maximum allowed ({MAX_BATCH_REQUESTS})")
+        return None, f'Number of requests exceeds maximum allowed ({MAX_BATCH_REQUESTS})'
+
+    return num_requests, None
+
+# Rough input tokens of one JSONL part, which is what counts against the org's enqueued-token limit
+def estimate_jsonl_tokens(file):
+    file.seek(0)
+    estimated_tokens = 0
+    for line in file.stream:
+        try:
+            estimated_tokens += estimate_message_tokens(json.loads(line)['body']['messages'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Unparseable lines are left for OpenAI to reject; count them by size
+            estimated_tokens += len(line) // ESTIMATED_CHARS_PER_TOKEN
+    file.seek(0)
+    return max(estimated_tokens, 1)
+
+def estimate_message_tokens(messages):
+    estimated_tokens = 0
+    for message in messages:
+        estimated_tokens += ESTIMATED_TOKENS_PER_MESSAGE
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            estimated_tokens += len(content) // ESTIMATED_CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part.get('type') == 'image_url':
+                detail = part.get('image_url', {}).get('detail')
+                estimated_tokens += ESTIMATED_TOKENS_PER_IMAGE['low' if detail == 'low' else 'high']
+            else:
+                estimated_tokens += len(part.get('text') or '') // ESTIMATED_CHARS_PER_TOKEN
+    return estimated_tokens
+
+# Upload one JSONL part to OpenAI and create its batch; runs on upload_executor
+def submit_jsonl_file(file, user_token, submission=None):
+    logger.info(f"Attempting to upload file {file.filename} to OpenAI")
+    openai_file_info = upload_file_to_openai(file, submission.key_id if submission else None)
+    logger.info(f"File {file.filename} successfully uploaded to OpenAI with ID: {openai_file_info['id']}")
+
+    logger.info(f"Creating OpenAI batch for file ID: {openai_file_info['id']}")
+    batch = create_openai_batch(openai_file_info['id'], user_token, submission)
+    logger.info(f"OpenAI batch created successfully with ID: {batch.id}")
+    return batch, openai_file_info
+
+# Spool a validated part to disk and queue it with the fair-share scheduler; returns the Submission
+def enqueue_submission(user_token, part_name, file, num_requests, estimated_tokens, profile, submission_id=None, path=None):
+    if submission_id is None:
+        submission_id = f"sub_{uuid.uuid4().hex}"
+        os.makedirs(SUBMISSION_SPOOL_DIR, exist_ok=True)
+        path = os.path.join(SUBMISSION_SPOOL_DIR, f"{submission_id}.jsonl")
+        try:
+            with open(path, 'wb') as spooled:
+                shutil.copyfileobj(file.stream, spooled)
+            db_create_submission(submission_id, user_token, part_name, path, num_requests, estimated_tokens)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+    # Users on their own key only compete with themselves, so only server-key users get a quota
+    quota_tokens = None if load_user_key(user_token) else key_pool.server_capacity() * USER_ENQUEUED_TOKEN_SHARE
+    submission = Submission(submission_id, user_token, num_requests, estimated_tokens,
+                            profile['weight'], profile['max_in_flight_batches'], quota_tokens,
+                            filename=part_name, path=path, priority=profile['priority'])
+    submission_scheduler.enqueue(submission)
+    return submission
+
+def place_submission(submission):
+    # Called by the scheduler: the least-loaded key with room for the submission, or None to wait
+    return key_pool.place(submission.token, submission.estimated_tokens)
+
+def start_submission(submission):
+    # Called by the scheduler once the submission fits; higher tiers still go first in the upload pool
+    return upload_executor.submit(submission.priority, run_submission, submission)
+
+def run_submission(submission):
+    # Outlives the upload request when the part was queued, so it settles the submission itself:
+    # the balance charged at upload time is refunded if no batch was created
     try:
-        logger.info(f"Creating OpenAI batch for file ID: {openai_file_info['id']}")
-        batch = create_openai_batch(openai_file_info['id'], user_token)
-        logger.info(f"OpenAI batch created successfully with ID: {batch.id}")
+        db_update_submission(submission.id, 'submitting', api_key_id=submission.key_id)
+        with open(submission.path, 'rb') as spooled:
+            file = FileStorage(stream=spooled, filename=submission.filename, content_type='application/jsonl')
+            batch, openai_file_info = submit_jsonl_file(file, submission.token, submission)
     except Exception as e:
-        logger.error(f"Failed to create OpenAI batch: {str(e)}")
-        return jsonify({'error': str(e)}), 500
-
-    # Process the JSONL file
-    file.seek(0)  # Reset file pointer to the beginning
-    file_content = file.read().decode('utf-8').splitlines()
-    num_requests = len(file_content)
+        logger.error(f"Failed to submit {submission.id} ({submission.filename}): {str(e)}")
+        db_update_submission(submission.id, 'failed', error=str(e))
+        update_token_balance(submission.token, submission.num_requests)
+        key_pool.release(submission.key_id, submission.estimated_tokens)
+        raise
+    finally:
+        if os.path.exists(submission.path):
+            os.remove(submission.path)
+
+    db_update_submission(submission.id, 'submitted', batch_id=batch.id)
+    batch_logger.log_batch_created(batch.id, submission.token, submission.num_requests)
+    return batch, openai_file_info
+
+# Admits OpenAI batch creation fairly across users sharing the key pool
+submission_scheduler = FairScheduler(start_submission, place_submission)
+
+def release_batch_budget(batch_id):
+    released = db_release_batch_budget(batch_id)
+    if released:
+        token, enqueued_tokens, api_key_id = released
+        logger.info(f"Batch {batch_id} released {enqueued_tokens} enqueued tokens on key {api_key_id}")
+        # Key first: the scheduler's release wakes the dispatcher, which must see the key's room
+        key_pool.release(api_key_id, enqueued_tokens)
+        submission_scheduler.release(token, enqueued_tokens)
+
+def resume_submissions():
+    # Restores the scheduler after a restart: budget held by running batches, then waiting parts in order
+    if 'DYNO' in os.environ and 'SUBMISSION_SPOOL_DIR' not in os.environ:
+        logger.warning("SUBMISSION_SPOOL_DIR is on the dyno's ephemeral filesystem; "
+                       "parts queued before a restart are refunded instead of resumed")
+    for token, api_key_id, batches, enqueued_tokens in db_get_enqueued_budgets():
+        submission_scheduler.load_in_flight(token, batches, enqueued_tokens)
+        load_key(api_key_id)
+        key_pool.load_in_flight(api_key_id, batches, enqueued_tokens)
+    reconciling = db_mark_submissions_reconciling()
+    if reconciling:
+        logger.warning(f"{reconciling} submissions were cut off while being sent; looking for their batches upstream")
+    waiting = db_get_waiting_submissions()
+    for submission_id, token, filename, path, num_requests, estimated_tokens in waiting:
+        requeue_submission(submission_id, token, filename, path, num_requests, estimated_tokens)
+    logger.info(f"Resumed {len(waiting)} waiting submissions")
+
+def requeue_submission(submission_id, token, filename, path, num_requests, estimated_tokens):
+    if not os.path.exists(path):
+        logger.error(f"Spooled file for submission {submission_id} is gone; refunding {num_requests}")
+        db_update_submission(submission_id, 'failed', error='Spooled file lost on restart')
+        update_token_balance(token, num_requests)
+        return
+    db_update_submission(submission_id, 'queued')
+    enqueue_submission(token, filename, None, num_requests, estimated_tokens, get_tier_profile(token),
+                       submission_id=submission_id, path=path)
+
+def adopt_submission_batch(submission, openai_batch):
+    # The batch a cut-off submission did create: recorded as run_submission would have
+    if db_get_batch_job(openai_batch.id) is None:
+        key_id = submission['api_key_id']
+        db_create_batch_job(openai_batch.id, 'validating', datetime.fromtimestamp(openai_batch.created_at),
+                            submission['token'], openai_batch.input_file_id, openai_batch.output_file_id,
+                            submission['estimated_tokens'], get_api_key(key_id).id, submission['num_requests'])
+        submission_scheduler.load_in_flight(submission['token'], 1, submission['estimated_tokens'])
+        key_pool.load_in_flight(key_id, 1, submission['estimated_tokens'])
+        batch_logger.log_batch_created(openai_batch.id, submission['token'], submission['num_requests'])
+        _, previous_status = db_update_batch_progress(openai_batch.id, openai_batch)
+        response = {k: v for k, v in openai_batch.model_dump().items() if v is not None}
+        on_batch_refreshed(openai_batch.id, submission['token'], previous_status, response)
+    db_update_submission(submission['id'], 'submitted', batch_id=openai_batch.id)
+    if submission['path'] and os.path.exists(submission['path']):
+        os.remove(submission['path'])
+
+def reconcile_submissions():
+    # Settles submissions cut off while being sent by matching batches.list on the
+    # metadata.submission_id every batch is created with: found ones are adopted, and ones
+    # the listing proves never arrived are queued again (or refunded if their file is gone)
+    submissions = db_get_reconciling_submissions()
+    by_key = {}
+    for submission in submissions:
+        by_key.setdefault(submission['api_key_id'], []).append(submission)
+
+    settled = 0
+    for key_id, key_submissions in by_key.items():
+        wanted = {submission['id']: submission for submission in key_submissions}
+        try:
+            seen, _, covered_from = list_key_batches(key_id, wanted, min(s['created_at'] for s in key_submissions),
+                                                     batch_key=submission_id_of)
+        except Exception as e:
+            logger.error(f"Failed to list batches for key {key_id} to reconcile submissions: {str(e)}")
+            continue
+        for submission_id, submission in wanted.items():
+            if submission_id in seen:
+                logger.info(f"Submission {submission_id} had created batch {seen[submission_id].id}")
+                adopt_submission_batch(submission, seen[submission_id])
+            elif covered_from is None or covered_from < submission['created_at']:
+                logger.info(f"Submission {submission_id} never created a batch; sending it again")
+                requeue_submission(submission_id, submission['token'], submission['filename'], submission['path'],
+                                   submission['num_requests'], submission['estimated_tokens'])
+            else:
+                continue
+            settled += 1
+    return settled
 
-    logger.info(f"JSONL file contains {num_requests} requests")
+@app.route('/upload_jsonl', methods=['POST'])
+def upload_jsonl():
+    logger.info("Upload JSONL endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+    if rate_limited(user_token):
+        logger.warning(f"Rate limit exceeded for token: {user_token}")
+        return jsonify({'error': 'Rate limit exceeded for this token'}), 429
+    
+    if 'file' not in request.files:
+        logger.warning("No file part in the request")
+        return jsonify({'error': 'No file part'}), 400
 
-    # Check if the number of requests exceeds the maximum allowed
-    if num_requests > MAX_BATCH_REQUESTS:
-        logger.warning(f"Number of requests ({num_requests}) exceeds maximum allowed ({MAX_BATCH_REQUESTS})")
-        return jsonify({'error': f'Number of requests exceeds maximum allowed ({MAX_BATCH_REQUESTS})'}), 400
+    # Several shards may be sent as repeated 'file' parts in one multipart request
+    files = request.files.getlist('file')
+    if len(files) > MAX_FILES_PER_UPLOAD:
+        logger.warning(f"Too many files in one upload: {len(files)}")
+        return jsonify({'error': f'Too many files in one upload (maximum {MAX_FILES_PER_UPLOAD})'}), 400
 
-    # Deduct initial cost
-    initial_cost = num_requests
-    current_balance = get_token_balance(user_token)
-    if current_balance < initial_cost:
-        logger.warning(f"Insufficient balance for batch creation. Required: {initial_cost}, Available: {current_balance}")
+    # Compressed parts are decoded first; responses report the names the client sent
+    part_names = [file.filename for file in files]
+    try:
+        files = [decompress_upload_part(file) for file in files]
+    except Exception as e:
+        logger.warning(f"Failed to decompress upload: {str(e)}")
+        return jsonify({'error': f'Failed to decompress upload: {str(e)}'}), 400
+
+    # Validate every part before anything is sent to OpenAI
+    request_counts = []
+    estimated_tokens = []
+    for part_name, file in zip(part_names, files):
+        num_requests, error = validate_jsonl_file(file)
+        if error:
+            if len(files) > 1:
+                error = f'{part_name}: {error}'
+            return jsonify({'error': error}), 400
+        request_counts.append(num_requests)
+        estimated_tokens.append(estimate_jsonl_tokens(file))
+
+    # Parts may wait in the scheduler past this request, so every part is paid for up front;
+    # run_submission refunds any part whose batch could not be created. No row at all means a
+    # signed token whose account no longer exists, which is refused the same way.
+    total_cost = sum(request_counts)
+    logger.info(f"Deducting cost of {total_cost} tokens from user balance for {len(files)} parts")
+    if charge_tokens(user_token, total_cost) is None:
+        logger.warning(f"Insufficient balance for batch creation. Required: {total_cost}")
         return jsonify({'error': 'Insufficient balance for batch creation'}), 400
-    
-    logger.info(f"Deducting initial cost of {initial_cost} tokens from user balance")
-    update_token_balance(user_token, -initial_cost)
+
+    # Queue the parts with the fair-share scheduler, which starts them as the org's
+    # enqueued-token budget, the user's share of it and the tier's in-flight limit allow
+    # A part that could not be queued is refunded here, since run_submission never sees it
+    profile = get_tier_profile(user_token)
+    submissions = []
+    errors = []
+    for part_name, file, num_requests, tokens in zip(part_names, files, request_counts, estimated_tokens):
+        try:
+            submissions.append((part_name, enqueue_submission(user_token, part_name, file, num_requests, tokens, profile)))
+        except Exception as e:
+            logger.error(f"Failed to queue {part_name}; refunding {num_requests}: {str(e)}")
+            update_token_balance(user_token, num_requests)
+            errors.append({'filename': part_name, 'error': f"Failed to queue file: {str(e)}"})
+    wait([submission.future for _, submission in submissions], timeout=SUBMISSION_WAIT_SECONDS)
+
+    created = []
+    queued = []
+    for part_name, submission in submissions:
+        if not submission.future.done():
+            queued.append({
+                'filename': part_name,
+                'submission_id': submission.id,
+                'status': 'queued',
+                'total_requests': submission.num_requests,
+                'estimated_tokens': submission.estimated_tokens,
+                'position': submission_scheduler.position(submission.id)
+            })
+            continue
+        try:
+            batch, openai_file_info = submission.future.result()
+        except Exception as e:
+            errors.append({'filename': part_name, 'error': str(e)})
+            continue
+        created.append({
+            'filename': part_name,
+            'batch_id': batch.id,
+            'submission_id': submission.id,
+            'status': batch.status,
+            'total_requests': submission.num_requests,
+            'openai_file_id': openai_file_info['id']
+        })
 
     remaining_balance = get_token_balance(user_token)
-    logger.info(f"Batch created successfully. Remaining balance: {remaining_balance}")
 
+    if len(files) == 1:
+        if errors:
+            return jsonify({'error': errors[0]['error']}), 500
+        if queued:
+            result = queued[0]
+            logger.info(f"Submission {result['submission_id']} queued at position {result['position']}")
+            return jsonify({
+                'submission_id': result['submission_id'],
+                'status': 'queued',
+                'remaining_balance': remaining_balance,
+                'total_requests': result['total_requests'],
+                'position': result['position'],
+                'message': (f"Queued {result['total_requests']} requests; the batch will be created "
+                            f"when capacity frees up. Check /submissions/{result['submission_id']}.")
+            }), 202
+        result = created[0]
+        logger.info(f"Batch created successfully. Remaining balance: {remaining_balance}")
+        return jsonify({
+            'batch_id': result['batch_id'],
+            'submission_id': result['submission_id'],
+            'status': result['status'],
+            'remaining_balance': remaining_balance,
+            'total_requests': result['total_requests'],
+            'openai_file_id': result['openai_file_id'],
+            'message': f"Successfully created batch to process {result['total_requests']} requests."
+        }), 202
+
+    if not created and not queued:
+        logger.error(f"All {len(files)} files failed to submit")
+        return jsonify({'error': 'Failed to create any batches', 'errors': errors}), 500
+
+    total_requests = sum(b['total_requests'] for b in created)
+    logger.info(f"Created {len(created)} and queued {len(queued)} of {len(files)} batches. "
+                f"Remaining balance: {remaining_balance}")
     return jsonify({
-        'batch_id': batch.id,
-        'status': batch.status,
+        'batches': created,
+        'queued': queued,
+        'errors': errors,
         'remaining_balance': remaining_balance,
-        'total_requests': num_requests,
-        'openai_file_id': openai_file_info['id'],
-        'message': f'Successfully created batch to process {num_requests} requests.'
+        'total_requests': total_requests,
+        'message': (f'Successfully created {len(created)} batches to process {total_requests} requests'
+                    + (f'; {len(queued)} more are queued.' if queued else '.'))
     }), 202
 
+@app.route('/submissions/<submission_id>', methods=['GET'])
+def get_submission_status(submission_id):
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+
+    submission = db_get_submission(submission_id)
+    if not submission:
+        logger.warning(f"Submission not found: {submission_id}")
+        return jsonify({'error': 'Submission not found'}), 404
+
+    if submission['token'] != user_token:
+        logger.warning(f"Unauthorized access to submission {submission_id} by token {user_token}")
+        return jsonify({'error': 'Unauthorized access to submission'}), 403
+
+    response = {k: v for k, v in submission.items() if k != 'token' and v is not None}
+    if submission['status'] == 'queued':
+        response['position'] = submission_scheduler.position(submission_id)
+    return jsonify(response), 200
+
+# Parse a /classify body: JSONL lines in the batch format, returning (requests, error)
+def parse_classify_requests(file):
+    classify_requests = []
+    for number, line in enumerate(file.stream, start=1):
+        if not line.strip():
+            continue
+        if len(classify_requests) >= CLASSIFY_MAX_REQUESTS:
+            return None, f'Too many requests for /classify (maximum {CLASSIFY_MAX_REQUESTS}); use /upload_jsonl'
+        try:
+            item = json.loads(line)
+            custom_id, body = item['custom_id'], item['body']
+            estimated_tokens = estimate_message_tokens(body['messages'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None, f'Line {number} is not a chat completions request with custom_id and body.messages'
+        if item.get('url', '/v1/chat/completions') != '/v1/chat/completions':
+            return None, f'Line {number}: only /v1/chat/completions requests are supported'
+        estimated_tokens += body.get('max_tokens') or CLASSIFY_OUTPUT_TOKEN_ESTIMATE
+        classify_requests.append((custom_id, body, estimated_tokens))
+    if not classify_requests:
+        return None, 'No requests in body'
+    return classify_requests, None
+
+@app.route('/classify', methods=['POST'])
+def classify():
+    # Synchronous path for small jobs: the requests go straight to chat.completions and their
+    # results stream back as NDJSON, one batch-style output line each, in completion order
+    logger.info("Classify endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+    if rate_limited(user_token):
+        logger.warning(f"Rate limit exceeded for token: {user_token}")
+        return jsonify({'error': 'Rate limit exceeded for this token'}), 429
+
+    # Either a 'file' part like /upload_jsonl takes, or the JSONL as the raw request body
+    file = request.files.get('file') or FileStorage(stream=io.BytesIO(request.get_data()), filename='classify.jsonl')
+    try:
+        file = decompress_upload_part(file)
+    except Exception as e:
+        logger.warning(f"Failed to decompress classify body: {str(e)}")
+        return jsonify({'error': f'Failed to decompress upload: {str(e)}'}), 400
+    classify_requests, error = parse_classify_requests(file)
+    if error:
+        logger.warning(f"Rejected classify request: {error}")
+        return jsonify({'error': error}), 400
+
+    load_user_key(user_token)
+    key_id = key_pool.pick(user_token)
+    if key_id is None:
+        logger.error("No OpenAI API key available for classify")
+        return jsonify({'error': 'No OpenAI API key available'}), 503
+    api_key = key_pool.require(key_id)
+    # Checked before charging; each request is still admitted by the breaker as it goes out
+    breaker = upstream.breaker(key_id)
+    retry_after = breaker.retry_after()
+    if retry_after > 0:
+        logger.warning(f"Circuit for key {key_id} is open; refusing classify")
+        response = jsonify({'error': f"OpenAI is unavailable for key {key_id}; retry in {retry_after:.0f} seconds"})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 503
+
+    # Billed like a batch: one unit per request, charged up front
+    total_cost = len(classify_requests)
+    if charge_tokens(user_token, total_cost, requests_submitted=total_cost) is None:
+        logger.warning(f"Insufficient balance for classify. Required: {total_cost}")
+        return jsonify({'error': 'Insufficient balance for classify'}), 400
+    # Not logged as a batch: the batch rollups count batches, and unsent requests are refunded below
+    classify_id = f"classify_{uuid.uuid4().hex}"
+
+    results = queue.Queue()
+    sent = []
+    def on_sent(key_id):
+        sent.append(key_id)
+        key_pool.record_request(key_id)
+    future = async_classifier.classify(key_id, api_key.secret, classify_requests, results.put, on_sent, breaker)
+    logger.info(f"Classify {classify_id}: {total_cost} requests on key {key_id}")
+
+    def generate():
+        try:
+            for _ in range(total_cost):
+                yield json.dumps(results.get(timeout=CLASSIFY_RESULT_TIMEOUT_SECONDS)) + '\n'
+        except queue.Empty:
+            logger.error(f"Classify {classify_id} timed out waiting for results")
+        finally:
+            # A client that disconnects early stops the rest; requests never sent are refunded
+            future.cancel()
+            unsent = total_cost - len(sent)
+            if unsent > 0:
+                logger.info(f"Refunding {unsent} unsent requests of {classify_id}")
+                update_token_balance(user_token, unsent, requests_submitted=-unsent)
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Classify-Id': classify_id})
+
 @app.route('/batches/<batch_id>', methods=['GET'])
 def get_batch_status(batch_id):
     logger.info(f"Get batch status endpoint accessed for batch ID: {batch_id}")
@@ -483,19 +2070,97 @@ def get_batch_status(batch_id):
         logger.warning(f"Unauthorized access to batch {batch_id} by token {user_token}")
         return jsonify({'error': 'Unauthorized access to batch'}), 403
 
-    # Retrieve the batch directly from OpenAI
-    client = OpenAI()
+    if batch_job['archived']:
+        # Archived batches ended long ago and nothing about them changes upstream any more
+        response = jsonify(stored_batch_status(batch_job, user_token))
+        response.set_etag(batch_status_etag(batch_id, batch_job['version'], get_token_balance(user_token)), weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    # Terminal batches never change upstream, and one refreshed moments ago is unlikely to have:
+    # if the client already holds the current version, answer 304 without calling OpenAI
+    fresh = (batch_job['last_refreshed_at'] is not None
+             and datetime.now() - batch_job['last_refreshed_at'] < timedelta(seconds=STATUS_FRESH_SECONDS))
+    if request.if_none_match and (batch_job['status'] in TERMINAL_STATUSES or fresh):
+        etag = batch_status_etag(batch_id, batch_job['version'], get_token_balance(user_token))
+        if request.if_none_match.contains_weak(etag):
+            logger.info(f"Batch {batch_id} not modified (version {batch_job['version']})")
+            return not_modified(etag)
+
+    try:
+        response, version = refresh_batch_job(batch_job)
+    except Exception as e:
+        if is_transient(e):
+            # OpenAI is timing out or its breaker is open: answer from the last stored snapshot
+            # rather than failing, so clients keep polling instead of re-submitting
+            logger.warning(f"Serving stored status for batch {batch_id}: {str(e)}")
+            response = jsonify(stored_batch_status(batch_job, user_token, stale=True))
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return jsonify({'error': f'Failed to retrieve batch from OpenAI: {str(e)}'}), 500
+
+    response = jsonify(response)
+    response.set_etag(batch_status_etag(batch_id, version, get_token_balance(user_token)), weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def stored_batch_status(batch_job, user_token, stale=False):
+    # The status body as of the last successful refresh, in the shape OpenAI returns it
+    def timestamp(value):
+        return int(value.timestamp()) if value else None
+    response = {
+        'id': batch_job['id'],
+        'object': 'batch',
+        'status': batch_job['status'],
+        'input_file_id': batch_job['openai_file_id'],
+        'output_file_id': batch_job['output_file_id'],
+        'created_at': timestamp(batch_job['created_at']),
+        'completed_at': timestamp(batch_job['completed_at']),
+        'expires_at': timestamp(batch_job['expires_at']),
+        'request_counts': {'total': batch_job['request_total'], 'completed': batch_job['request_completed'],
+                           'failed': batch_job['request_failed']},
+        'remaining_balance': get_token_balance(user_token),
+    }
+    if stale:
+        response['stale'] = True
+        response['last_refreshed_at'] = timestamp(batch_job['last_refreshed_at'])
+    return {k: v for k, v in response.items() if v is not None}
+
+def batch_status_etag(batch_id, version, balance):
+    # The status body is the OpenAI batch plus the caller's balance, so both go in the validator
+    return f"{batch_id}-v{version}-b{balance}"
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def refresh_batch_job(batch_job):
+    # Shared by status requests and the webhook refresher: fetch the batch from OpenAI,
+    # store and log its status, and fire webhooks when it first reaches a terminal state.
+    # Returns the status dict and the batch job's version after the update.
+    batch_id = batch_job['id']
+    user_token = batch_job['token']
+
+    # Retrieve the batch directly from OpenAI, through the key that created it
     try:
         logger.info(f"Retrieving batch {batch_id} from OpenAI")
-        openai_batch = client.batches.retrieve(batch_id)
+        openai_batch = call_openai('batches.retrieve', batch_job.get('api_key_id'),
+                                   lambda client: client.batches.retrieve(batch_id), retry=True, hedge=True)
         logger.info(f"Successfully retrieved batch {batch_id} from OpenAI")
     except Exception as e:
         logger.error(f"Failed to retrieve batch {batch_id} from OpenAI: {str(e)}")
-        return jsonify({'error': f'Failed to retrieve batch from OpenAI: {str(e)}'}), 500
+        raise
 
-    # Update local batch job status and output_file_id
+    # Update local batch job status, output_file_id and progress snapshot
     logger.info(f"Updating local batch job {batch_id} status to {openai_batch.status}")
-    db_update_batch_job(batch_id, status=openai_batch.status, output_file_id=openai_batch.output_file_id)
+    version, previous_status = db_update_batch_progress(batch_id, openai_batch)
 
     # Convert the OpenAI response to a dictionary
     response = {k: v for k, v in openai_batch.model_dump().items() if v is not None}
@@ -505,11 +2170,219 @@ def get_batch_status(batch_id):
     response['remaining_balance'] = remaining_balance
     logger.info(f"User {user_token} remaining balance: {remaining_balance}")
 
-    # Log the batch status with enhanced data
+    # The status the stored row actually moved from, not the copy read before calling OpenAI,
+    # so when refreshes race only one of them sees the batch finish
+    if version is None:
+        previous_status = batch_job['status']
+    on_batch_refreshed(batch_id, user_token, previous_status, response)
+    return response, version
+
+def on_batch_refreshed(batch_id, user_token, previous_status, response):
+    # Follow-up to a freshly read upstream status, from status requests and the reconciler alike:
+    # log it, and when the batch has just finished, free its budget, fire webhooks and ingest results
     logger.info(f"Logging batch status for batch {batch_id}")
-    batch_logger.log_batch_status(batch_id, response, user_token)
+    batch_logger.log_batch_status(batch_id, response, user_token, previous_status=previous_status)
+
+    status = response['status']
+    if status in TERMINAL_STATUSES:
+        release_batch_budget(batch_id)
+    if status in TERMINAL_STATUSES and previous_status not in TERMINAL_STATUSES:
+        logger.info(f"Batch {batch_id} reached terminal status {status}; notifying webhooks")
+        webhook_dispatcher.notify(user_token, response)
+        if status == 'completed':
+            ingestion_executor.submit(ingest_batch_results_in_background, batch_id)
+
+def submission_id_of(openai_batch):
+    return (openai_batch.metadata or {}).get('submission_id')
+
+def list_key_batches(key_id, wanted_ids, oldest_created_at, batch_key=lambda openai_batch: openai_batch.id):
+    # Pages through the key's batches.list (newest first) until every wanted batch was seen or
+    # the pages reach back past the oldest one. Returns (batches by batch_key, pages read,
+    # covered_from): any wanted batch created at or after covered_from that was not listed is
+    # gone upstream.
+    seen = {}
+    pages = 0
+    after = None
+    while True:
+        params = {'limit': BATCH_LIST_PAGE_SIZE}
+        if after:
+            params['after'] = after
+        page = call_openai('batches.list', key_id, lambda client: client.batches.list(**params), retry=True)
+        pages += 1
+        for openai_batch in page.data:
+            if batch_key(openai_batch) in wanted_ids:
+                seen[batch_key(openai_batch)] = openai_batch
+        if not page.data or not page.has_next_page():
+            return seen, pages, None
+        last = page.data[-1]
+        covered_from = datetime.fromtimestamp(last.created_at)
+        if len(seen) == len(wanted_ids) or covered_from < oldest_created_at:
+            return seen, pages, covered_from
+        after = last.id
+
+def reconcile_batch_jobs():
+    # Refreshes every unfinished batch with one batches.list walk per key instead of one
+    # retrieve per batch, then writes all the changes in a single transaction
+    settled_submissions = reconcile_submissions()
+    unfinished = db_get_unfinished_batch_jobs()
+    by_key = {}
+    for batch_job in unfinished:
+        by_key.setdefault(batch_job['api_key_id'], []).append(batch_job)
+
+    listed = {}
+    missing = []
+    pages = 0
+    for key_id, batch_jobs in by_key.items():
+        wanted = {batch_job['id']: batch_job for batch_job in batch_jobs}
+        try:
+            seen, key_pages, covered_from = list_key_batches(key_id, wanted, min(b['created_at'] for b in batch_jobs))
+        except Exception as e:
+            logger.error(f"Failed to list batches for key {key_id}: {str(e)}")
+            continue
+        pages += key_pages
+        listed.update(seen)
+        # Only batches inside the listed window can be called missing; strictly newer, so a
+        # batch sharing the last listed second is not flagged while it may sit on the next page
+        missing.extend(batch_id for batch_id, batch_job in wanted.items() if batch_id not in seen
+                       and (covered_from is None or batch_job['created_at'] > covered_from))
+
+    changed, flagged = [], []
+    if listed or missing:
+        changed, flagged = db_reconcile_batch_jobs([batch_progress_snapshot(b) for b in listed.values()], missing)
+    for batch_id, user_token, previous_status in changed:
+        response = {k: v for k, v in listed[batch_id].model_dump().items() if v is not None}
+        on_batch_refreshed(batch_id, user_token, previous_status, response)
+    if flagged:
+        logger.warning(f"{len(flagged)} unfinished batches are no longer known upstream: {flagged}")
+    for batch_id in flagged:
+        # They will never finish, so they must not keep queued submissions waiting
+        release_batch_budget(batch_id)
+    logger.info(f"Reconciled {len(unfinished)} unfinished batches with {pages} list calls: "
+                f"{len(changed)} changed, {len(flagged)} missing upstream")
+    return {'unfinished': len(unfinished), 'list_calls': pages, 'changed': len(changed), 'missing_upstream': flagged,
+            'settled_submissions': settled_submissions}
+
+def refresh_watched_batch_jobs():
+    # Webhook users stop polling, so the server polls their unfinished batches instead, along
+    # with every batch holding enqueued-token budget while submissions are waiting for it
+    batch_jobs = db_get_watched_batch_jobs(WEBHOOK_REFRESH_BATCH_LIMIT, include_enqueued=submission_scheduler.waiting() > 0)
+    for batch_job in batch_jobs:
+        try:
+            refresh_batch_job(batch_job)
+        except Exception as e:
+            logger.error(f"Failed to refresh batch {batch_job['id']}: {str(e)}")
+    if batch_jobs:
+        logger.info(f"Refreshed {len(batch_jobs)} batches watched by webhooks")
+
+@app.route('/webhooks', methods=['POST'])
+def create_webhook():
+    logger.info("Create webhook endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
 
-    return jsonify(response), 200
+    data = request.get_json(silent=True) or {}
+    url = data.get('url', '')
+    batch_id = data.get('batch_id')
+    try:
+        resolve_webhook_url(url)
+    except UnsafeWebhookURL as e:
+        logger.warning(f"Rejected webhook URL {url!r} for token {user_token}: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+    if batch_id:
+        batch_job = db_get_batch_job(batch_id)
+        if not batch_job:
+            return jsonify({'error': 'Batch not found'}), 404
+        if batch_job['token'] != user_token:
+            logger.warning(f"Unauthorized webhook registration for batch {batch_id} by token {user_token}")
+            return jsonify({'error': 'Unauthorized access to batch'}), 403
+
+    if len(db_get_user_webhooks(user_token)) >= MAX_WEBHOOKS_PER_TOKEN:
+        return jsonify({'error': f'At most {MAX_WEBHOOKS_PER_TOKEN} webhooks per token'}), 400
+
+    webhook_id = f"wh_{uuid.uuid4().hex}"
+    secret = secrets.token_hex(32)
+    db_create_webhook(webhook_id, user_token, batch_id, url, secret)
+    logger.info(f"Webhook {webhook_id} registered for token {user_token} (batch: {batch_id or 'all'})")
+    # The secret is only ever returned here; receivers use it to verify X-Webhook-Signature
+    return jsonify({'webhook_id': webhook_id, 'url': url, 'batch_id': batch_id, 'secret': secret}), 201
+
+@app.route('/webhooks', methods=['GET'])
+def list_webhooks():
+    logger.info("List webhooks endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+
+    return jsonify({'webhooks': db_get_user_webhooks(user_token)}), 200
+
+@app.route('/webhooks/<webhook_id>', methods=['DELETE'])
+def delete_webhook(webhook_id):
+    logger.info(f"Delete webhook endpoint accessed for webhook ID: {webhook_id}")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+
+    if not db_delete_webhook(webhook_id, user_token):
+        return jsonify({'error': 'Webhook not found'}), 404
+    return jsonify({'message': 'Webhook deleted', 'webhook_id': webhook_id}), 200
+
+@app.route('/user/api_key', methods=['POST'])
+def set_user_api_key():
+    logger.info("Set user API key endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+    if rate_limited(user_token):
+        logger.warning(f"Rate limit exceeded for token: {user_token}")
+        return jsonify({'error': 'Rate limit exceeded for this token'}), 429
+
+    data = request.get_json(silent=True) or {}
+    secret = data.get('api_key')
+    if not isinstance(secret, str) or not secret.startswith('sk-'):
+        return jsonify({'error': 'api_key must be an OpenAI API key (sk-...)'}), 400
+    if not API_KEY_ENCRYPTION_KEY:
+        logger.error("API_KEY_ENCRYPTION_KEY is not set; refusing to store a user API key")
+        return jsonify({'error': 'User API keys are not enabled on this server'}), 501
+
+    try:
+        valid = validate_openai_key(secret)
+    except Exception as e:
+        logger.error(f"Failed to validate API key for token {user_token}: {str(e)}")
+        return jsonify({'error': 'Could not validate api_key with OpenAI, try again later'}), 502
+    if not valid:
+        logger.warning(f"OpenAI rejected the API key set for token {user_token}")
+        return jsonify({'error': 'api_key was rejected by OpenAI'}), 400
+
+    # New batches for this token are created with its own key from now on
+    key_id = key_id_for(secret, USER_KEY_PREFIX)
+    db_set_api_key(user_token, key_id, secret)
+    key_pool.add_user_key(user_token, secret)
+    remember_without_own_key(user_token, without=False)
+    logger.info(f"Token {user_token} now uses its own API key {key_id}")
+    return jsonify({'api_key_id': key_id, 'message': 'New batches will be created with this key'}), 200
+
+@app.route('/user/api_key', methods=['DELETE'])
+def delete_user_api_key():
+    logger.info("Delete user API key endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+
+    # Batches already created with the key keep using it until they are cleaned up
+    revoked = db_revoke_api_keys(user_token)
+    key_pool.remove_user_key(user_token)
+    remember_without_own_key(user_token)
+    if not revoked:
+        return jsonify({'error': 'No API key set for this token'}), 404
+    logger.info(f"Token {user_token} is back on the server's API keys")
+    return jsonify({'message': 'New batches will be created with the server keys'}), 200
 
 @app.route('/purchase_tier', methods=['POST'])
 def purchase_tier():
@@ -527,7 +2400,7 @@ def purchase_tier():
         return jsonify({'error': 'Invalid tier'}), 400
     
     amount = tier_pricing[tier]
-    user_token = create_token(amount)
+    user_token = create_token(amount, tier)
     logger.info(f"Tier {tier} purchased successfully. Token created: {user_token}")
     return jsonify({'user_token': user_token, 'tier': tier}), 200
 
@@ -539,11 +2412,35 @@ def get_user_batch_jobs_route():
         logger.warning(f"Invalid or expired token: {user_token}")
         return jsonify({'error': 'Invalid or expired token'}), 400
 
-    user_jobs = db_get_user_batch_jobs(user_token)
+    # ?since=<cursor> returns only what changed after a previous response's cursor
+    since = request.args.get('since')
+    if since is not None:
+        if not since.isdigit():
+            return jsonify({'error': 'since must be a cursor from a previous response'}), 400
+        user_jobs, deleted, cursor = db_get_user_batch_jobs(user_token, int(since))
+        logger.info(f"Returning {len(user_jobs)} changed and {len(deleted)} deleted batch jobs for user {user_token}")
+        return jsonify({'batch_jobs': user_jobs, 'deleted': deleted, 'cursor': str(cursor)}), 200
+
+    # jobs_version moves whenever one of the token's jobs is created, changed or deleted
+    token_data = db_get_token(user_token)
+    if not token_data:
+        logger.warning(f"Invalid token: {user_token}")
+        return jsonify({'error': 'Invalid token'}), 400
+    etag = f"jobs-v{token_data['jobs_version']}"
+    if request.if_none_match.contains_weak(etag):
+        logger.info(f"Batch jobs for user {user_token} not modified")
+        return not_modified(etag)
+
+    user_jobs, _, cursor = db_get_user_batch_jobs(user_token)
     logger.info(f"Retrieved {len(user_jobs)} batch jobs for user {user_token}")
-    return jsonify({
-        'batch_jobs': user_jobs
-    }), 200
+    response = jsonify({
+        'batch_jobs': user_jobs,
+        'cursor': str(cursor)
+    })
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/user/file_ids', methods=['GET'])
 def get_user_file_ids_route():
@@ -557,17 +2454,56 @@ def get_user_file_ids_route():
     logger.info(f"Retrieved {len(file_ids)} file IDs for user {user_token}")
     return jsonify({'file_ids': file_ids}), 200
 
-def delete_file(file_id):
+def delete_file(file_id, key_id=None):
+    from openai import NotFoundError
     logger.info(f"Attempting to delete file with ID: {file_id}")
-    client = OpenAI()
+    key_id = key_id or db_get_file_api_key_id(file_id)
     try:
-        response = client.files.delete(file_id)
+        response = call_openai('files.delete', key_id, lambda client: client.files.delete(file_id), retry=True)
         logger.info(f"File {file_id} deleted successfully")
         return response
+    except NotFoundError:
+        logger.warning(f"File {file_id} not found on OpenAI")
+        raise
     except Exception as e:
         logger.error(f"Failed to delete file {file_id}: {str(e)}")
         raise Exception(f"Failed to delete file {file_id}: {str(e)}")
 
+def delete_file_in_background(file_id, attempt=1, key_id=None):
+    from openai import NotFoundError
+    try:
+        delete_file(file_id, key_id)
+    except NotFoundError:
+        # Already gone upstream, which is the outcome we wanted
+        logger.info(f"File {file_id} no longer exists on OpenAI")
+    except Exception as e:
+        if attempt >= DELETION_MAX_ATTEMPTS:
+            logger.error(f"Giving up on deleting file {file_id} after {attempt} attempts")
+            db_update_file_deletion(file_id, 'failed', attempt, str(e))
+            return
+        delay = DELETION_RETRY_BASE_SECONDS * (2 ** (attempt - 1))
+        logger.warning(f"Retrying deletion of file {file_id} in {delay} seconds")
+        db_update_file_deletion(file_id, 'pending', attempt, str(e))
+        # Wait on a timer rather than a pool thread so other deletions keep moving
+        retry = threading.Timer(delay, deletion_executor.submit,
+                                args=(delete_file_in_background, file_id, attempt + 1, key_id))
+        retry.daemon = True
+        retry.start()
+        return
+    db_update_file_deletion(file_id, 'deleted', attempt)
+
+def schedule_batch_file_deletion(batch_job):
+    file_ids = [file_id for file_id in (batch_job.get('output_file_id'), batch_job['openai_file_id']) if file_id]
+    key_id = get_api_key(batch_job.get('api_key_id')).id
+    scheduled = db_schedule_file_deletions(batch_job['id'], batch_job['token'], file_ids, key_id, 'batch_deleted')
+    for file_id in scheduled:
+        deletion_executor.submit(delete_file_in_background, file_id, 1, key_id)
+
+    # Outcomes are tracked in file_deletions, so the job row can go right away
+    logger.info(f"Deleting batch job {batch_job['id']} from database")
+    db_delete_batch_job(batch_job['id'])
+    return file_ids
+
 @app.route('/delete_batch_files/<batch_id>', methods=['DELETE'])
 def delete_batch_files(batch_id):
     logger.info(f"Delete batch files endpoint accessed for batch ID: {batch_id}")
@@ -582,34 +2518,152 @@ def delete_batch_files(batch_id):
         return jsonify({'error': 'Batch not found or unauthorized'}), 404
 
     try:
-        output_file_id = batch_job.get('output_file_id')
-        input_file_id = batch_job['openai_file_id']
-
-        deletion_results = {}
+        file_ids = schedule_batch_file_deletion(batch_job)
+    except UnknownKeyError as e:
+        logger.warning(f"Cannot delete files of batch {batch_id}: {str(e)}")
+        return jsonify({'error': 'The API key that created this batch is no longer available'}), 409
+    except Exception as e:
+        logger.error(f"Failed to schedule batch files deletion for batch {batch_id}: {str(e)}")
+        return jsonify({'error': f"Failed to delete batch files: {str(e)}"}), 500
 
-        if output_file_id:
-            logger.info(f"Attempting to delete output file: {output_file_id}")
-            output_delete_response = delete_file(output_file_id)
-            deletion_results['output_file'] = output_delete_response.deleted
-            logger.info(f"Output file {output_file_id} deletion result: {output_delete_response.deleted}")
+    logger.info(f"Batch files deletion scheduled for batch {batch_id}")
+    return jsonify({
+        'message': 'Batch files deletion scheduled',
+        'batch_id': batch_id,
+        'file_ids': file_ids
+    }), 202
 
-        logger.info(f"Attempting to delete input file: {input_file_id}")
-        input_delete_response = delete_file(input_file_id)
-        deletion_results['input_file'] = input_delete_response.deleted
-        logger.info(f"Input file {input_file_id} deletion result: {input_delete_response.deleted}")
+@app.route('/batches/files', methods=['DELETE'])
+def delete_many_batch_files():
+    logger.info("Bulk delete batch files endpoint accessed")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
 
-        logger.info(f"Deleting batch job {batch_id} from database")
-        db_delete_batch_job(batch_id)
+    data = request.json or {}
+    batch_ids = data.get('batch_ids')
+    if not isinstance(batch_ids, list) or not batch_ids:
+        logger.warning("No batch IDs supplied for bulk deletion")
+        return jsonify({'error': 'batch_ids must be a non-empty list'}), 400
+
+    scheduled = {}
+    not_found = []
+    unavailable = []  # Batches whose API key is gone, so their files can't be reached
+    for batch_id in batch_ids:
+        batch_job = db_get_batch_job(batch_id)
+        if not batch_job or batch_job['token'] != user_token:
+            not_found.append(batch_id)
+            continue
+        try:
+            scheduled[batch_id] = schedule_batch_file_deletion(batch_job)
+        except UnknownKeyError as e:
+            logger.warning(f"Cannot delete files of batch {batch_id}: {str(e)}")
+            unavailable.append(batch_id)
+            continue
+        except Exception as e:
+            logger.error(f"Failed to schedule batch files deletion for batch {batch_id}: {str(e)}")
+            return jsonify({'error': f"Failed to delete batch files: {str(e)}"}), 500
+
+    logger.info(f"Bulk deletion scheduled for {len(scheduled)} batches, {len(not_found)} not found")
+    return jsonify({
+        'message': 'Batch files deletion scheduled',
+        'scheduled': scheduled,
+        'not_found': not_found,
+        'key_unavailable': unavailable
+    }), 202
 
-        logger.info(f"Batch files deletion completed for batch {batch_id}")
-        return jsonify({
-            'message': 'Batch files deletion attempted',
-            'deletion_results': deletion_results
-        }), 200
-
-    except Exception as e:
-        logger.error(f"Failed to delete batch files for batch {batch_id}: {str(e)}")
-        return jsonify({'error': f"Failed to delete batch files: {str(e)}"}), 500
+def orphan_reason(openai_file, reference, deletion_status, server_key, now):
+    # Why an OpenAI file may be garbage collected, or None to keep it
+    if deletion_status == 'pending':
+        return None  # A deletion is already on its way
+    if deletion_status == 'deleted':
+        return 'deletion_incomplete'
+    if reference is None:
+        # A user's own org may hold batch files from outside this service, so only server
+        # keys have unreferenced files collected
+        if not server_key or now - datetime.fromtimestamp(openai_file.created_at) < FILE_GC_MIN_AGE:
+            return None
+        return 'unreferenced'
+    if reference['status'] not in TERMINAL_STATUSES:
+        return None
+    if reference['status'] == 'completed' and reference['results_ingested_at'] is None:
+        return None  # The output file is still the only copy of the results
+    ended_at = reference['completed_at'] or reference['last_refreshed_at'] or reference['created_at']
+    if now - ended_at < FILE_GC_RETENTION:
+        return None
+    return f"batch_{reference['status']}"
+
+def find_orphan_files():
+    # Dry run of the garbage collector: lists every key's batch files and reports the ones
+    # no client is going to clean up, without deleting anything
+    references = db_get_file_references()
+    deletion_states = db_get_file_deletion_states()
+    server_keys = set(key_pool.server_key_ids())
+    key_ids = server_keys | {r['api_key_id'] for r in references.values() if r['api_key_id']}
+    now = datetime.now()
+    report = {'files_listed': 0, 'orphans': [], 'bytes': 0, 'by_reason': {}, 'errors': {}}
+    for key_id in sorted(key_ids):
+        load_key(key_id)
+        try:
+            for openai_file in call_openai('files.list', key_id, lambda client: client.files.list(), retry=True):
+                if openai_file.purpose not in ('batch', 'batch_output'):
+                    continue
+                report['files_listed'] += 1
+                reference = references.get(openai_file.id)
+                reason = orphan_reason(openai_file, reference, deletion_states.get(openai_file.id),
+                                       key_id in server_keys, now)
+                if reason is None:
+                    continue
+                report['orphans'].append({
+                    'file_id': openai_file.id,
+                    'api_key_id': key_id,
+                    'reason': reason,
+                    'bytes': openai_file.bytes,
+                    'created_at': openai_file.created_at,
+                    'batch_id': reference['batch_id'] if reference else None,
+                    'token': reference['token'] if reference else None,
+                })
+                report['bytes'] += openai_file.bytes or 0
+                report['by_reason'][reason] = report['by_reason'].get(reason, 0) + 1
+        except Exception as e:
+            logger.error(f"Failed to list files for key {key_id}: {str(e)}")
+            report['errors'][key_id] = str(e)
+    logger.info(f"File GC found {len(report['orphans'])} orphaned files ({report['bytes']} bytes) "
+                f"among {report['files_listed']} listed: {report['by_reason']}")
+    return report
+
+def delete_orphan_files(orphans):
+    # At most DELETION_WORKERS deletions in flight, and none while a key is short of request
+    # headroom, so collecting a backlog never crowds out the users' own calls
+    slots = threading.BoundedSemaphore(DELETION_WORKERS)
+    for orphan in orphans:
+        file_id, key_id = orphan['file_id'], orphan['api_key_id']
+        while key_pool.request_headroom(key_id) < FILE_GC_RATE_SHARE:
+            time.sleep(1)
+        if not db_schedule_file_deletions(orphan['batch_id'], orphan['token'], [file_id], key_id, orphan['reason']):
+            continue
+        slots.acquire()
+        future = deletion_executor.submit(delete_file_in_background, file_id, 1, key_id)
+        future.add_done_callback(lambda _: slots.release())
+    logger.info(f"File GC scheduled deletion of {len(orphans)} orphaned files")
+
+def collect_orphan_files(delete=False):
+    report = find_orphan_files()
+    if delete and report['orphans']:
+        delete_orphan_files(report['orphans'])
+    return report
+
+def fetch_file_content(file_id):
+    logger.info(f"Retrieving content for file {file_id} from OpenAI")
+    with ExitStack() as stack:
+        # Retried only until the response starts; a body cut off midway fails the download
+        response = call_openai('files.content', db_get_file_api_key_id(file_id),
+                               lambda client: stack.enter_context(client.files.with_streaming_response.content(file_id)),
+                               retry=True)
+        for chunk in response.iter_bytes():
+            yield chunk
+    logger.info(f"Content retrieved successfully for file {file_id}")
 
 @app.route('/retrieve_file_content/<file_id>', methods=['GET'])
 def retrieve_file_content(file_id):
@@ -618,39 +2672,255 @@ def retrieve_file_content(file_id):
     if not user_token or not validate_token(user_token):
         logger.warning(f"Invalid or expired token: {user_token}")
         return jsonify({'error': 'Invalid or expired token'}), 400
+    if not db_file_belongs_to_token(file_id, user_token):
+        logger.warning(f"File not found or unauthorized access: {file_id} by token {user_token}")
+        return jsonify({'error': 'File not found or unauthorized'}), 404
+
+    # File contents are immutable, so the file ID itself is a strong ETag
+    gzip_etag = f"{file_id}-gzip"
+    for etag in (file_id, gzip_etag):
+        if request.if_none_match.contains(etag):
+            logger.info(f"File {file_id} not modified")
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
 
-    client = OpenAI()
     try:
-        logger.info(f"Retrieving content for file {file_id}")
-        response = client.files.content(file_id)
-        
-        # Determine the content type and decode if necessary
-        if isinstance(response, bytes):
-            file_content = response.decode('utf-8')
-        elif hasattr(response, 'text'):
-            file_content = response.text
-        else:
-            file_content = response.read().decode('utf-8')
-
-        logger.info(f"Content retrieved successfully for file {file_id}")
+        path = file_cache.get_or_fetch(file_id, fetch_file_content)
+    except ValueError as e:
+        logger.warning(str(e))
+        return jsonify({'error': str(e)}), 400
+    except CircuitOpenError as e:
+        logger.warning(str(e))
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+        return response, 503
+    except Exception as e:
+        logger.error(f"Failed to retrieve file content for file {file_id}: {str(e)}")
+        return jsonify({'error': f"Failed to retrieve file content: {str(e)}"}), 500
 
-        # Update the output_file_id in the database if necessary
-        conn = psycopg2.connect(DATABASE_URL)
+    # Full downloads get a cached gzip copy; ranged (resumed) downloads use the plain file
+    if not request.range and request.accept_encodings['gzip']:
+        try:
+            gzip_path = file_cache.get_or_fetch(f"{file_id}.gz", lambda key: gzip_chunks(path))
+        except Exception as e:
+            logger.error(f"Failed to compress file {file_id}: {str(e)}")
+        else:
+            response = send_file(gzip_path, mimetype='text/plain', conditional=True, etag=gzip_etag,
+                                 max_age=FILE_CACHE_MAX_AGE_SECONDS)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+            return response
+
+    # send_file answers If-None-Match and Range requests from the cached copy
+    response = send_file(path, mimetype='text/plain', conditional=True, etag=file_id,
+                         max_age=FILE_CACHE_MAX_AGE_SECONDS)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def parse_result_line(line):
+    # Keep only what clients use from an output line: the decision text, token usage and any error
+    item = json.loads(line)
+    response = item.get('response') or {}
+    body = response.get('body') or {}
+    usage = body.get('usage') or {}
+    choices = body.get('choices') or [{}]
+    content = (choices[0].get('message') or {}).get('content')
+    error = item.get('error')
+    if response.get('status_code', 200) != 200:
+        error = error or body.get('error') or f"HTTP {response.get('status_code')}"
+    if isinstance(error, dict):
+        error = error.get('message') or json.dumps(error)
+    return (item['custom_id'], content.strip() if content else None, usage.get('prompt_tokens'),
+            usage.get('completion_tokens'), usage.get('total_tokens'), error)
+
+def iter_result_rows(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield parse_result_line(line)
+
+def db_get_results_ingestion(batch_id):
+    # (output_file_id, results_ingested_at) of a batch job, or None
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT output_file_id, results_ingested_at FROM batch_jobs WHERE id = %s", (batch_id,))
+    result = c.fetchone()
+    conn.close()
+    return result
+
+def ingest_batch_results(batch_id):
+    # Streams the batch's output file (through the file cache) into batch_results, once. The
+    # file is downloaded before the transaction opens, so no connection or lock is held while
+    # OpenAI is slow; concurrent callers then wait on an advisory lock and find the batch ingested.
+    from psycopg2.extras import execute_values
+    row = db_get_results_ingestion(batch_id)
+    if row is None or row[1] is not None:
+        return
+    output_file_id = row[0]
+    path = file_cache.get_or_fetch(output_file_id, fetch_file_content) if output_file_id else None
+
+    conn = get_db_connection()
+    try:
         c = conn.cursor()
-        c.execute("UPDATE batch_jobs SET output_file_id = %s WHERE token = %s AND output_file_id = %s", 
-                  (file_id, user_token, file_id))
+        c.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"batch_results:{batch_id}",))
+        c.execute("SELECT results_ingested_at FROM batch_jobs WHERE id = %s", (batch_id,))
+        row = c.fetchone()
+        if row is None or row[0] is not None:
+            conn.rollback()
+            return
+
+        count = 0
+        if path:
+            page = []
+            for result in iter_result_rows(path):
+                page.append((batch_id,) + result)
+                if len(page) >= RESULTS_INSERT_PAGE_SIZE:
+                    count += len(page)
+                    execute_values(c, """INSERT INTO batch_results (batch_id, custom_id, decision, prompt_tokens,
+                                          completion_tokens, total_tokens, error) VALUES %s
+                                          ON CONFLICT DO NOTHING""", page)
+                    page = []
+            if page:
+                count += len(page)
+                execute_values(c, """INSERT INTO batch_results (batch_id, custom_id, decision, prompt_tokens,
+                                      completion_tokens, total_tokens, error) VALUES %s
+                                      ON CONFLICT DO NOTHING""", page)
+
+        c.execute("UPDATE batch_jobs SET results_ingested_at = %s WHERE id = %s", (datetime.now(), batch_id))
         conn.commit()
+        logger.info(f"Ingested {count} results for batch {batch_id}")
+    finally:
         conn.close()
-        logger.info(f"Updated output_file_id in database for file {file_id}")
 
-        return file_content, 200, {'Content-Type': 'text/plain'}
+def ingest_batch_results_in_background(batch_id):
+    try:
+        ingest_batch_results(batch_id)
+    except Exception as e:
+        # The decisions endpoint retries ingestion on its next request
+        logger.error(f"Failed to ingest results for batch {batch_id}: {str(e)}")
+
+@app.route('/batches/<batch_id>/decisions', methods=['GET'])
+def get_batch_decisions(batch_id):
+    logger.info(f"Get batch decisions endpoint accessed for batch ID: {batch_id}")
+    user_token = request.headers.get('User-Token')
+    if not user_token or not validate_token(user_token):
+        logger.warning(f"Invalid or expired token: {user_token}")
+        return jsonify({'error': 'Invalid or expired token'}), 400
+
+    batch_job = db_get_batch_job(batch_id)
+    if not batch_job:
+        logger.warning(f"Batch not found: {batch_id}")
+        return jsonify({'error': 'Batch not found'}), 404
+
+    if batch_job['token'] != user_token:
+        logger.warning(f"Unauthorized access to batch {batch_id} by token {user_token}")
+        return jsonify({'error': 'Unauthorized access to batch'}), 403
+
+    if batch_job['status'] != 'completed':
+        return jsonify({'error': 'Batch is not completed', 'status': batch_job['status']}), 409
+
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'csv', 'ndjson'):
+        return jsonify({'error': 'format must be json, csv or ndjson'}), 400
+    limit = min(max(request.args.get('limit', DECISIONS_DEFAULT_LIMIT, type=int), 1), DECISIONS_MAX_LIMIT)
+    after = request.args.get('after', '')
 
+    try:
+        # Normally done in the background when the batch completed; retried here if that failed
+        if batch_job['results_ingested_at'] is None:
+            ingest_batch_results(batch_id)
+        decisions = db_get_batch_results(batch_id, after, limit + 1)
     except Exception as e:
-        logger.error(f"Failed to retrieve file content for file {file_id}: {str(e)}")
-        return jsonify({'error': f"Failed to retrieve file content: {str(e)}"}), 500
+        logger.error(f"Failed to retrieve decisions for batch {batch_id}: {str(e)}")
+        return jsonify({'error': f"Failed to retrieve decisions: {str(e)}"}), 500
+
+    next_after = decisions[limit - 1]['custom_id'] if len(decisions) > limit else None
+    decisions = decisions[:limit]
+    logger.info(f"Returning {len(decisions)} decisions for batch {batch_id}")
+
+    if output_format == 'json':
+        response = jsonify({'batch_id': batch_id, 'decisions': decisions, 'next_after': next_after})
+    elif output_format == 'ndjson':
+        body = ''.join(json.dumps(decision, separators=(',', ':')) + '\n' for decision in decisions)
+        response = Response(body, mimetype='application/x-ndjson')
+    else:
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['custom_id', 'decision', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'error'])
+        for decision in decisions:
+            usage = decision['usage']
+            writer.writerow([decision['custom_id'], decision['decision'], usage['prompt_tokens'],
+                             usage['completion_tokens'], usage['total_tokens'], decision['error']])
+        response = Response(output.getvalue(), mimetype='text/csv')
+
+    if next_after:
+        response.headers['X-Next-After'] = next_after
+    # Ingested results never change, so a page is identified by its query; weak because
+    # the body may be compressed on the way out
+    response.set_etag(f"{batch_id}:{output_format}:{after}:{limit}", weak=True)
+    return response.make_conditional(request)
+
+def run_periodically(name, interval_seconds, job):
+    # Runs job() every interval on a daemon thread; a failed run is logged and retried next interval
+    def loop():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                job()
+            except Exception as e:
+                logger.error(f"Periodic job {name} failed: {str(e)}")
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    logger.info(f"Scheduled periodic job {name} every {interval_seconds}s")
+
+def archive_batch_jobs():
+    # Drains everything eligible, one small transaction per chunk
+    cutoff = datetime.now() - timedelta(days=BATCH_JOB_ARCHIVE_DAYS)
+    total = 0
+    while True:
+        moved = db_archive_batch_jobs(cutoff, BATCH_JOB_ARCHIVE_CHUNK)
+        total += moved
+        if moved < BATCH_JOB_ARCHIVE_CHUNK:
+            break
+    if total:
+        logger.info(f"Archived {total} batch jobs that ended before {cutoff}")
+    return total
+
+def start_background_jobs():
+    run_periodically('compact_batch_logs', BATCH_LOG_COMPACTION_INTERVAL_SECONDS,
+                     lambda: batch_logger.compact(BATCH_LOG_RETENTION_DAYS))
+    run_periodically('refresh_watched_batch_jobs', WEBHOOK_REFRESH_INTERVAL_SECONDS, refresh_watched_batch_jobs)
+    run_periodically('reconcile_batch_jobs', BATCH_RECONCILE_INTERVAL_SECONDS, reconcile_batch_jobs)
+    run_periodically('collect_orphan_files', FILE_GC_INTERVAL_SECONDS, lambda: collect_orphan_files(FILE_GC_DELETE))
+    run_periodically('archive_batch_jobs', BATCH_JOB_ARCHIVE_INTERVAL_SECONDS, archive_batch_jobs)
+    run_periodically('ensure_batch_log_partitions', BATCH_LOGS_MAINTENANCE_INTERVAL_SECONDS, batch_logger.ensure_partitions)
+    try:
+        batch_logger.ensure_partitions()
+    except Exception as e:
+        logger.error(f"Failed to create batch_logs partitions: {str(e)}")
+    try:
+        webhook_dispatcher.resume_pending()
+    except Exception as e:
+        logger.error(f"Failed to resume pending webhook deliveries: {str(e)}")
+    try:
+        resume_submissions()
+        reconcile_submissions()
+    except Exception as e:
+        logger.error(f"Failed to resume waiting submissions: {str(e)}")
+    if API_KEY_ENCRYPTION_KEY:
+        try:
+            encrypted = db_encrypt_api_keys()
+            if encrypted:
+                logger.info(f"Encrypted {encrypted} user API keys stored in plain text")
+        except Exception as e:
+            logger.error(f"Failed to encrypt stored user API keys: {str(e)}")
+
+record_startup_phase('app_setup')
 
 if __name__ == '__main__':
     init_db()
+    record_startup_phase('init_db')
+    start_background_jobs()
     # Local development
     # app.run(debug=True)
     
@@ -0,0 +1,216 @@
+import time
+import hashlib
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+API_KEYS_DDL = [
+    # Keys users bring for their own token; a revoked key is no longer chosen for new
+    # batches but still serves the batches it created
+    '''CREATE TABLE IF NOT EXISTS api_keys (
+        id TEXT PRIMARY KEY,
+        token TEXT,
+        secret TEXT,
+        created_at TIMESTAMP,
+        revoked_at TIMESTAMP
+    )''',
+    'CREATE INDEX IF NOT EXISTS api_keys_token_idx ON api_keys (token)',
+]
+
+ENCRYPTED_SECRET_PREFIX = 'fernet:'
+
+SERVER_KEY_PREFIX = 'srv'
+USER_KEY_PREFIX = 'usr'
+
+def encrypt_secret(encryption_key, secret):
+    # api_keys.secret holds users' keys encrypted with the server's Fernet key
+    from cryptography.fernet import Fernet  # Deferred: only needed once users bring keys
+    return ENCRYPTED_SECRET_PREFIX + Fernet(encryption_key).encrypt(secret.encode()).decode()
+
+def decrypt_secret(encryption_key, stored):
+    # Rows stored before encryption are plain keys and are returned as they are
+    if not stored.startswith(ENCRYPTED_SECRET_PREFIX):
+        return stored
+    if not encryption_key:
+        raise ValueError("Stored API key is encrypted and no encryption key is configured")
+    from cryptography.fernet import Fernet
+    return Fernet(encryption_key).decrypt(stored[len(ENCRYPTED_SECRET_PREFIX):].encode()).decode()
+
+class UnknownKeyError(KeyError):
+    # The key a batch was created with is not in the pool, e.g. a user key whose row is gone
+    pass
+
+def key_id_for(secret, prefix):
+    # Stable across restarts, so batch_jobs.api_key_id keeps routing to the same key
+    return f"{prefix}-{hashlib.sha256(secret.encode()).hexdigest()[:12]}"
+
+class ApiKey:
+    def __init__(self, key_id, secret, owner, enqueued_token_limit, requests_per_minute):
+        self.id = key_id
+        self.secret = secret
+        self.owner = owner  # Token that brought the key, None for server keys
+        self.enqueued_token_limit = enqueued_token_limit
+        self.requests_per_minute = requests_per_minute
+        self.enqueued_tokens = 0
+        self.in_flight_batches = 0
+        self.requests = deque()  # Timestamps of calls made in the last minute
+        self.client = None
+
+    def recent_requests(self, now):
+        while self.requests and now - self.requests[0] >= 60:
+            self.requests.popleft()
+        return len(self.requests)
+
+    def load(self, now):
+        return max(self.enqueued_tokens / self.enqueued_token_limit,
+                   self.recent_requests(now) / self.requests_per_minute)
+
+    def fits(self, estimated_tokens, now):
+        # An empty key takes any batch, however large, so oversized parts still run eventually
+        if self.recent_requests(now) >= self.requests_per_minute:
+            return False
+        return not self.enqueued_tokens or self.enqueued_tokens + estimated_tokens <= self.enqueued_token_limit
+
+    def snapshot(self, now):
+        return {
+            'owner': 'user' if self.owner else 'server',
+            'enqueued_tokens': self.enqueued_tokens,
+            'enqueued_token_limit': self.enqueued_token_limit,
+            'in_flight_batches': self.in_flight_batches,
+            'requests_last_minute': self.recent_requests(now),
+            'requests_per_minute': self.requests_per_minute,
+        }
+
+class KeyPool:
+    # OpenAI API keys with live request-rate and enqueued-token accounting. New batches go
+    # to the least-loaded key that can take them: the token's own key if it brought one,
+    # otherwise one of the server's keys. Every later call for a batch should go through
+    # client(key_id) with the key that created it, since batches and files are per-org.
+    def __init__(self, enqueued_token_limit, requests_per_minute):
+        self.enqueued_token_limit = enqueued_token_limit
+        self.requests_per_minute = requests_per_minute
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.user_keys = {}  # token -> id of the key it brought
+        self.default_key_id = None  # Serves batches stored before keys were recorded
+
+    def add_server_key(self, secret):
+        key_id = key_id_for(secret, SERVER_KEY_PREFIX)
+        with self.lock:
+            self.keys.setdefault(key_id, ApiKey(key_id, secret, None, self.enqueued_token_limit,
+                                                self.requests_per_minute))
+            if self.default_key_id is None:
+                self.default_key_id = key_id
+        return key_id
+
+    def add_user_key(self, token, secret, active=True):
+        key_id = key_id_for(secret, USER_KEY_PREFIX)
+        with self.lock:
+            self.keys.setdefault(key_id, ApiKey(key_id, secret, token, self.enqueued_token_limit,
+                                                self.requests_per_minute))
+            if active:
+                self.user_keys[token] = key_id
+        return key_id
+
+    def remove_user_key(self, token):
+        # Stops choosing the key; it stays in the pool for the batches it already created
+        with self.lock:
+            return self.user_keys.pop(token, None)
+
+    def user_key_id(self, token):
+        with self.lock:
+            return self.user_keys.get(token)
+
+    def get(self, key_id):
+        with self.lock:
+            return self.keys.get(key_id or self.default_key_id)
+
+    def require(self, key_id):
+        # Like get(), but raises UnknownKeyError instead of returning None
+        key = self.get(key_id)
+        if key is None:
+            raise UnknownKeyError(f"Unknown OpenAI API key {key_id}")
+        return key
+
+    def server_capacity(self):
+        with self.lock:
+            return sum(key.enqueued_token_limit for key in self.keys.values() if key.owner is None)
+
+    def place(self, token, estimated_tokens):
+        # Reserves estimated_tokens on the least-loaded eligible key and returns its id,
+        # or None when no eligible key has room right now
+        now = time.time()
+        with self.lock:
+            if token in self.user_keys:
+                candidates = [self.keys[self.user_keys[token]]]
+            else:
+                candidates = [key for key in self.keys.values() if key.owner is None]
+            candidates = [key for key in candidates if key.fits(estimated_tokens, now)]
+            if not candidates:
+                return None
+            key = min(candidates, key=lambda k: k.load(now))
+            key.enqueued_tokens += estimated_tokens
+            key.in_flight_batches += 1
+            return key.id
+
+    def pick(self, token):
+        # Least-loaded key for direct (non-batch) calls, which enqueue nothing: the token's
+        # own key if it brought one, otherwise a server key
+        now = time.time()
+        with self.lock:
+            if token in self.user_keys:
+                return self.user_keys[token]
+            candidates = [key for key in self.keys.values() if key.owner is None]
+            if not candidates:
+                return None
+            return min(candidates, key=lambda k: k.load(now)).id
+
+    def load_in_flight(self, key_id, batches, estimated_tokens):
+        with self.lock:
+            key = self.keys.get(key_id or self.default_key_id)
+            if key:
+                key.enqueued_tokens += estimated_tokens
+                key.in_flight_batches += batches
+
+    def release(self, key_id, estimated_tokens):
+        with self.lock:
+            key = self.keys.get(key_id or self.default_key_id)
+            if key:
+                key.enqueued_tokens = max(key.enqueued_tokens - estimated_tokens, 0)
+                key.in_flight_batches = max(key.in_flight_batches - 1, 0)
+
+    def request_headroom(self, key_id):
+        # Share of the key's per-minute request rate still unused, from 0 to 1
+        now = time.time()
+        with self.lock:
+            key = self.keys.get(key_id or self.default_key_id)
+            if key is None:
+                return 0
+            return max(1 - key.recent_requests(now) / key.requests_per_minute, 0)
+
+    def server_key_ids(self):
+        with self.lock:
+            return [key.id for key in self.keys.values() if key.owner is None]
+
+    def record_request(self, key_id):
+        with self.lock:
+            key = self.keys.get(key_id or self.default_key_id)
+            if key:
+                key.requests.append(time.time())
+
+    def client(self, key_id=None):
+        # Shared OpenAI client for the key; each call through it counts toward the key's rate
+        key = self.require(key_id)
+        self.record_request(key.id)
+        with self.lock:
+            if key.client is None:
+                from openai import OpenAI  # Deferred: the openai package is the slowest import by far
+                key.client = OpenAI(api_key=key.secret)
+            return key.client
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            return {key_id: key.snapshot(now) for key_id, key in self.keys.items()}
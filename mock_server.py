@@ -6,8 +6,11 @@ from datetime import datetime, timedelta
 import uuid
 from threading import Lock
 import math
+import request_profiler
 
 app = Flask(__name__)
+# Requests sent with X-Profile and the admin token are profiled; see /admin/profiles
+request_profiler.install(app)
 
 # In-memory storage for tokens and usage
 tokens = {}
@@ -0,0 +1,80 @@
+import os
+import uuid
+import unittest
+from unittest.mock import patch
+
+# Tests that need Postgres create a throwaway database on this server, e.g.
+# TEST_DATABASE_URL=postgresql://postgres@localhost/postgres, and are skipped without it
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+requires_postgres = unittest.skipUnless(TEST_DATABASE_URL, 'TEST_DATABASE_URL is not set')
+
+def _admin_connection():
+    import psycopg2
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    return conn
+
+def create_scratch_database():
+    # Returns the URL of a new empty database on the TEST_DATABASE_URL server
+    import psycopg2.extensions
+    name = f"crazygpt_test_{uuid.uuid4().hex[:12]}"
+    conn = _admin_connection()
+    conn.cursor().execute(f'CREATE DATABASE "{name}"')
+    conn.close()
+    params = psycopg2.extensions.parse_dsn(TEST_DATABASE_URL)
+    params['dbname'] = name
+    return psycopg2.extensions.make_dsn(**params)
+
+def drop_scratch_database(url):
+    import psycopg2.extensions
+    name = psycopg2.extensions.parse_dsn(url)['dbname']
+    conn = _admin_connection()
+    conn.cursor().execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    conn.close()
+
+def assert_admin_only(test, client, method, path):
+    # The route must answer 403 to a wrong Admin-Token, and to anyone while ADMIN_TOKEN is unset
+    send = getattr(client, method)
+    test.assertEqual(send(path, headers={'Admin-Token': 'wrong'}).status_code, 403)
+    with patch.dict(os.environ):
+        os.environ.pop('ADMIN_TOKEN', None)
+        test.assertEqual(send(path).status_code, 403)
+        test.assertEqual(send(path, headers={'Admin-Token': ''}).status_code, 403)
+
+class HerokuServerTestCase(unittest.TestCase):
+    # Points herokuserver at a scratch database for the class. Set migrate = False to
+    # run the migrations from the test instead.
+    migrate = True
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        cls.server = herokuserver
+        cls.database_url = create_scratch_database()
+        cls.previous_urls = (herokuserver.DATABASE_URL, herokuserver.batch_logger.DATABASE_URL,
+                             herokuserver.webhook_dispatcher.DATABASE_URL)
+        herokuserver.DATABASE_URL = cls.database_url
+        herokuserver.batch_logger.DATABASE_URL = cls.database_url
+        herokuserver.webhook_dispatcher.DATABASE_URL = cls.database_url
+        if cls.migrate:
+            herokuserver.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        herokuserver = cls.server
+        (herokuserver.DATABASE_URL, herokuserver.batch_logger.DATABASE_URL,
+         herokuserver.webhook_dispatcher.DATABASE_URL) = cls.previous_urls
+        drop_scratch_database(cls.database_url)
+
+    def query(self, sql, params=None):
+        conn = self.server.get_db_connection()
+        try:
+            c = conn.cursor()
+            c.execute(sql, params)
+            rows = c.fetchall() if c.description else None
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
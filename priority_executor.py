@@ -0,0 +1,43 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+class PriorityThreadPool:
+    # Like ThreadPoolExecutor, but queued work runs lowest priority number first
+    # (FIFO within a priority). Threads are started lazily, up to max_workers: whenever
+    # more tasks are queued than there are idle workers to take them. Both counts change
+    # under one lock, so a burst of submits can't all count the same idle worker.
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.tasks = []  # Heap of (priority, sequence, future, fn, args, kwargs)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.idle = 0
+
+    def submit(self, priority, fn, *args, **kwargs):
+        future = Future()
+        with self.cond:
+            heapq.heappush(self.tasks, (priority, next(self.sequence), future, fn, args, kwargs))
+            if len(self.tasks) > self.idle and len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                self.idle += 1
+                while not self.tasks:
+                    self.cond.wait()
+                self.idle -= 1
+                _, _, future, fn, args, kwargs = heapq.heappop(self.tasks)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
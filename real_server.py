@@ -12,6 +12,8 @@ import csv
 import json
 import sqlite3
 from batch_logger import BatchLogger  # Import the BatchLogger class
+import db_instrumentation
+import request_profiler
 from dotenv import load_dotenv
 import logging
 import sys
@@ -33,6 +35,8 @@ os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY')
 logger.info("OpenAI API key set from environment variable")
 
 app = Flask(__name__)
+# Requests sent with X-Profile and the admin token are profiled; see /admin/profiles
+request_profiler.install(app)
 logger.info("Flask app initialized")
 
 # All locks declared at the top
@@ -47,12 +51,19 @@ rate_limits = {}
 MAX_BATCH_REQUESTS = 50000
 MAX_BATCH_SIZE_MB = 100
 DB_NAME = 'app_database.sqlite'
+DB_INSTRUMENTATION = os.environ.get('DB_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+DB_SLOW_QUERY_MS = int(os.environ.get('DB_SLOW_QUERY_MS', 200))
 logger.info(f"Configuration set: MAX_BATCH_REQUESTS={MAX_BATCH_REQUESTS}, MAX_BATCH_SIZE_MB={MAX_BATCH_SIZE_MB}, DB_NAME={DB_NAME}")
 
+db_instrumentation.instrumentation.configure(enabled=DB_INSTRUMENTATION, slow_query_ms=DB_SLOW_QUERY_MS)
+
+def get_db_connection():
+    return db_instrumentation.connect(sqlite3.connect, DB_NAME, dialect='sqlite')
+
 # Initialize database
 def init_db():
     logger.info("Initializing database")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS tokens
                  (token TEXT PRIMARY KEY, amount INTEGER, used INTEGER, expiry TEXT)''')
@@ -65,7 +76,7 @@ def init_db():
 # Database operations
 def db_create_token(token, amount):
     logger.info(f"Creating token: {token} with amount: {amount}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     expiry = (datetime.now() + timedelta(hours=24)).isoformat()
     c.execute("INSERT INTO tokens VALUES (?, ?, ?, ?)", (token, amount, 0, expiry))
@@ -75,7 +86,7 @@ def db_create_token(token, amount):
 
 def db_get_token(token):
     logger.info(f"Retrieving token: {token}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM tokens WHERE token = ?", (token,))
     result = c.fetchone()
@@ -88,7 +99,7 @@ def db_get_token(token):
 
 def db_update_token_amount(token, new_amount):
     logger.info(f"Updating token amount: {token} to {new_amount}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("UPDATE tokens SET amount = ? WHERE token = ?", (new_amount, token))
     conn.commit()
@@ -97,7 +108,7 @@ def db_update_token_amount(token, new_amount):
 
 def db_delete_token(token):
     logger.info(f"Deleting token: {token}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM tokens WHERE token = ?", (token,))
     conn.commit()
@@ -106,7 +117,7 @@ def db_delete_token(token):
 
 def db_create_batch_job(batch_id, status, created_at, token, openai_file_id, output_file_id=None):
     logger.info(f"Creating batch job: {batch_id}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("INSERT INTO batch_jobs VALUES (?, ?, ?, ?, ?, ?)", 
               (batch_id, status, created_at, token, openai_file_id, output_file_id))
@@ -116,7 +127,7 @@ def db_create_batch_job(batch_id, status, created_at, token, openai_file_id, out
 
 def db_get_batch_job(batch_id):
     logger.info(f"Retrieving batch job: {batch_id}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT * FROM batch_jobs WHERE id = ?", (batch_id,))
     result = c.fetchone()
@@ -130,7 +141,7 @@ def db_get_batch_job(batch_id):
 
 def db_update_batch_job(batch_id, status=None, output_file_id=None):
     logger.info(f"Updating batch job: {batch_id}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     if status:
         c.execute("UPDATE batch_jobs SET status = ? WHERE id = ?", (status, batch_id))
@@ -144,7 +155,7 @@ def db_update_batch_job(batch_id, status=None, output_file_id=None):
 
 def db_delete_batch_job(batch_id):
     logger.info(f"Deleting batch job: {batch_id}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM batch_jobs WHERE id = ?", (batch_id,))
     conn.commit()
@@ -153,7 +164,7 @@ def db_delete_batch_job(batch_id):
 
 def db_get_user_batch_jobs(user_token):
     logger.info(f"Retrieving user batch jobs for token: {user_token}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT id, status, created_at FROM batch_jobs WHERE token = ?", (user_token,))
     results = c.fetchall()
@@ -163,7 +174,7 @@ def db_get_user_batch_jobs(user_token):
 
 def db_get_user_file_ids(user_token):
     logger.info(f"Retrieving user file IDs for token: {user_token}")
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT openai_file_id FROM batch_jobs WHERE token = ?", (user_token,))
     results = c.fetchall()
@@ -575,7 +586,7 @@ def retrieve_file_content(file_id):
         logger.info(f"Content retrieved successfully for file {file_id}")
 
         # Update the output_file_id in the database if necessary
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("UPDATE batch_jobs SET output_file_id = ? WHERE token = ? AND output_file_id = ?", 
                   (file_id, user_token, file_id))
@@ -589,6 +600,24 @@ def retrieve_file_content(file_id):
         logger.error(f"Failed to retrieve file content for file {file_id}: {str(e)}")
         return jsonify({'error': f"Failed to retrieve file content: {str(e)}"}), 500
 
+def is_admin():
+    return request_profiler.is_admin_environ(request.environ)
+
+@app.route('/admin/db_stats', methods=['GET', 'DELETE'])
+def db_stats():
+    logger.info("Admin DB stats endpoint accessed")
+    if not is_admin():
+        logger.warning("Unauthorized access attempt to admin DB stats")
+        return jsonify({'error': 'Unauthorized access'}), 403
+    if request.method == 'DELETE':
+        db_instrumentation.instrumentation.reset()
+        return jsonify({'message': 'DB stats reset'}), 200
+    limit = request.args.get('limit', 20, type=int)
+    order = request.args.get('order', 'total')
+    if order not in db_instrumentation.SNAPSHOT_ORDERS:
+        return jsonify({'error': f"order must be one of {sorted(db_instrumentation.SNAPSHOT_ORDERS)}"}), 400
+    return jsonify(db_instrumentation.instrumentation.snapshot(max(limit, 1), order)), 200
+
 if __name__ == '__main__':
     init_db()
     # Local development
@@ -0,0 +1,258 @@
+import io
+import os
+import sys
+import hmac
+import time
+import uuid
+import marshal
+import threading
+import logging
+from collections import OrderedDict, Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+MAX_PROFILES = 50  # Kept in memory, oldest dropped first
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_SAMPLE_SECONDS = 10 * 60  # The sampler gives up on a response that is never closed
+PSTATS_TEXT_LIMIT = 60  # Functions listed by ?format=text
+
+# X-Profile value -> mode; anything else gets the deterministic profiler
+MODES = {'sample': 'sample', 'cprofile': 'cprofile', '1': 'cprofile'}
+FORMATS = {
+    'cprofile': ('pstats', 'text'),
+    'sample': ('collapsed',),
+}
+
+def is_admin_environ(environ):
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    return hmac.compare_digest(environ.get('HTTP_ADMIN_TOKEN', ''), admin_token)
+
+def collapse(frame):
+    # One line of Brendan Gregg's collapsed format, root first: "a (f.py:1);b (g.py:7)"
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class CProfileSession:
+    # Deterministic: every call while the request's code runs. cProfile can't nest, so only
+    # one of these runs at a time (see RequestProfiler.cprofile_lock).
+    mode = 'cprofile'
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def resume(self):
+        self.profile.enable()
+
+    def pause(self):
+        self.profile.disable()
+
+    def finish(self):
+        self.profile.create_stats()
+
+class SamplingSession:
+    # Samples the request thread's stack every interval while it runs the request, from a
+    # helper thread, so the request itself pays nothing per call
+    mode = 'sample'
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.active = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='request_profiler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        deadline = time.monotonic() + MAX_SAMPLE_SECONDS
+        while not self.stopped.wait(self.interval) and time.monotonic() < deadline:
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+
+    def resume(self):
+        self.active = True
+
+    def pause(self):
+        self.active = False
+
+    def finish(self):
+        self.stopped.set()
+        self.thread.join()
+
+class Profile:
+    def __init__(self, profile_id, environ, session):
+        self.id = profile_id
+        self.method = environ.get('REQUEST_METHOD')
+        self.path = environ.get('PATH_INFO')
+        self.session = session
+        self.status = None
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.duration_ms = None
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'mode': self.session.mode,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': self.duration_ms,
+            'formats': list(FORMATS[self.session.mode]),
+        }
+
+    def render(self, output_format):
+        # (bytes, mimetype, file extension) of the profile in output_format
+        if output_format == 'collapsed':
+            lines = [f"{stack} {count}" for stack, count in self.session.counts.most_common()]
+            return '\n'.join(lines).encode() + b'\n', 'text/plain', 'folded'
+        if output_format == 'pstats':
+            # What pstats.Stats(path) and snakeviz load
+            return marshal.dumps(self.session.profile.stats), 'application/octet-stream', 'pstats'
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(self.session.profile, stream=stream).sort_stats('cumulative').print_stats(PSTATS_TEXT_LIMIT)
+        return stream.getvalue().encode(), 'text/plain', 'txt'
+
+class ProfiledBody:
+    # Keeps profiling while the response body is produced, since streamed responses do
+    # most of their work there, and finishes the profile when the server closes it
+    def __init__(self, body, session, finish):
+        self.body = body
+        self.session = session
+        self.finish = finish
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            self.session.resume()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.session.pause()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish()
+
+class RequestProfiler:
+    # WSGI middleware that profiles single requests on demand. A request carrying X-Profile
+    # and a valid Admin-Token runs under cProfile (X-Profile: 1) or the stack sampler
+    # (X-Profile: sample); its response gets an X-Profile-Id header for fetching the result
+    # from /admin/profiles/<id>. Requests without the header go straight through.
+    def __init__(self, wsgi_app, max_profiles=MAX_PROFILES, sample_interval=SAMPLE_INTERVAL_SECONDS):
+        self.wsgi_app = wsgi_app
+        self.max_profiles = max_profiles
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.cprofile_lock = threading.Lock()
+        self.profiles = OrderedDict()  # id -> Profile, oldest first
+
+    def __call__(self, environ, start_response):
+        if 'HTTP_X_PROFILE' not in environ:
+            return self.wsgi_app(environ, start_response)
+        if not is_admin_environ(environ):
+            logger.warning("Ignored X-Profile on a request without a valid Admin-Token")
+            return self.wsgi_app(environ, start_response)
+        return self._profiled(environ, start_response)
+
+    def _session(self, mode):
+        if mode == 'cprofile':
+            if self.cprofile_lock.acquire(blocking=False):
+                return CProfileSession()
+            logger.info("Another request is under cProfile; sampling this one instead")
+        return SamplingSession(threading.get_ident(), self.sample_interval)
+
+    def _profiled(self, environ, start_response):
+        session = self._session(MODES.get(environ['HTTP_X_PROFILE'].strip().lower(), 'cprofile'))
+        profile = Profile(uuid.uuid4().hex, environ, session)
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            session.finish()
+            if session.mode == 'cprofile':
+                self.cprofile_lock.release()
+            profile.duration_ms = round((time.perf_counter() - profile.started) * 1000, 2)
+            with self.lock:
+                self.profiles[profile.id] = profile
+                while len(self.profiles) > self.max_profiles:
+                    self.profiles.popitem(last=False)
+            logger.info(f"Profiled {profile.method} {profile.path} as {profile.id} "
+                        f"({session.mode}, {profile.duration_ms} ms)")
+
+        def profiled_start_response(status, headers, exc_info=None):
+            profile.status = int(status.split(' ', 1)[0])
+            return start_response(status, list(headers) + [('X-Profile-Id', profile.id)], exc_info)
+
+        session.resume()
+        try:
+            body = self.wsgi_app(environ, profiled_start_response)
+        except Exception:
+            session.pause()
+            finish()
+            raise
+        session.pause()
+        return ProfiledBody(body, session, finish)
+
+    def get(self, profile_id):
+        with self.lock:
+            return self.profiles.get(profile_id)
+
+    def summaries(self):
+        with self.lock:
+            return [profile.summary() for profile in reversed(self.profiles.values())]
+
+def install(app, **kwargs):
+    # Wraps a Flask app's WSGI callable with the profiler and adds the admin routes that
+    # serve its results; returns the profiler
+    from flask import request, jsonify, Response
+
+    profiler = RequestProfiler(app.wsgi_app, **kwargs)
+    app.wsgi_app = profiler
+
+    def list_profiles():
+        if not is_admin_environ(request.environ):
+            logger.warning("Unauthorized access attempt to admin profiles")
+            return jsonify({'error': 'Unauthorized access'}), 403
+        return jsonify({'profiles': profiler.summaries()}), 200
+
+    def get_profile(profile_id):
+        if not is_admin_environ(request.environ):
+            logger.warning("Unauthorized access attempt to admin profiles")
+            return jsonify({'error': 'Unauthorized access'}), 403
+        profile = profiler.get(profile_id)
+        if profile is None:
+            return jsonify({'error': 'Profile not found'}), 404
+        formats = FORMATS[profile.session.mode]
+        output_format = request.args.get('format', formats[0])
+        if output_format not in formats:
+            return jsonify({'error': f"format must be one of {list(formats)} for a {profile.session.mode} profile"}), 400
+        data, mimetype, extension = profile.render(output_format)
+        return Response(data, mimetype=mimetype, headers={
+            'Content-Disposition': f'attachment;filename={profile_id}.{extension}'})
+
+    app.add_url_rule('/admin/profiles', 'list_profiles', list_profiles, methods=['GET'])
+    app.add_url_rule('/admin/profiles/<profile_id>', 'get_profile', get_profile, methods=['GET'])
+    return profiler
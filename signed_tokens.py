@@ -0,0 +1,34 @@
+import hmac
+import time
+import base64
+import hashlib
+from datetime import datetime
+
+# Signed user tokens: "v1.<token_id>.<expiry unix time>.<signature>", where the signature is
+# HMAC-SHA256 of everything before it under the server's signing key. Opaque tokens from
+# secrets.token_urlsafe never contain '.', so the two formats cannot be confused.
+TOKEN_VERSION = 'v1'
+
+def _signature(key, payload):
+    digest = hmac.new(key.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def issue_token(key, token_id, expiry):
+    payload = f"{TOKEN_VERSION}.{token_id}.{int(expiry.timestamp())}"
+    return f"{payload}.{_signature(key, payload)}"
+
+def is_signed_token(token):
+    return token.startswith(TOKEN_VERSION + '.')
+
+def verify_token(key, token, now=None):
+    # Returns (token_id, expiry) for a well-formed, correctly signed, unexpired token, else None
+    parts = token.split('.')
+    if len(parts) != 4 or parts[0] != TOKEN_VERSION or not parts[2].isdigit():
+        return None
+    payload = '.'.join(parts[:3])
+    if not hmac.compare_digest(_signature(key, payload), parts[3]):
+        return None
+    expires_at = int(parts[2])
+    if (now or time.time()) >= expires_at:
+        return None
+    return parts[1], datetime.fromtimestamp(expires_at)
@@ -0,0 +1,150 @@
+import threading
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class Submission:
+    # One JSONL part waiting for, or going through, OpenAI batch creation
+    def __init__(self, submission_id, token, num_requests, estimated_tokens, weight, max_in_flight,
+                 quota_tokens=None, filename=None, path=None, priority=0):
+        self.id = submission_id
+        self.token = token
+        self.quota_tokens = quota_tokens  # Most estimated tokens the user may hold in flight; None for no cap
+        self.key_id = None  # API key chosen by place() when the submission starts
+        self.filename = filename
+        self.path = path  # Where the part is spooled until it is submitted
+        self.priority = priority
+        self.num_requests = num_requests
+        self.estimated_tokens = estimated_tokens
+        self.weight = weight
+        self.max_in_flight = max_in_flight
+        self.future = Future()  # Resolves to the start callback's result, or its exception
+
+class FairScheduler:
+    # Admission control for OpenAI batch creation when users share the server's keys.
+    # Each user has a FIFO queue and users are served weighted round-robin. A submission
+    # only starts when it fits the user's quota and in-flight batch limit and place() finds
+    # an API key with room for it; otherwise it waits. Budget comes back through release()
+    # once a batch reaches a terminal state upstream, and waiting submissions are retried
+    # every retry_seconds anyway, since a key's request rate frees up without any release.
+    def __init__(self, start, place, retry_seconds=1.0):
+        self.start = start  # start(submission) creates the batch; returns a Future and must not block
+        self.place = place  # place(submission) reserves room on an API key and returns its id, or None
+        self.retry_seconds = retry_seconds
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # token -> deque of waiting Submissions, in round-robin order
+        self.credits = {}  # token -> picks left in its current round-robin turn
+        self.enqueued_tokens = 0
+        self.user_tokens = {}  # token -> estimated tokens of its batches in flight
+        self.user_batches = {}  # token -> number of its batches in flight
+        self.thread = None
+
+    def load_in_flight(self, token, batches, estimated_tokens):
+        # Seeds the accounting with batches already running upstream, e.g. after a restart
+        with self.cond:
+            self._reserve(token, estimated_tokens, batches)
+
+    def enqueue(self, submission):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+                self.thread.start()
+            self.queues.setdefault(submission.token, deque()).append(submission)
+            self.credits.setdefault(submission.token, submission.weight)
+            self.cond.notify()
+        return submission.future
+
+    def release(self, token, estimated_tokens):
+        with self.cond:
+            self._reserve(token, -estimated_tokens, -1)
+            self.cond.notify()
+
+    def waiting(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def position(self, submission_id):
+        # Number of waiting submissions ahead of this one across all users, or None
+        with self.cond:
+            ahead = 0
+            for queue in self.queues.values():
+                for index, submission in enumerate(queue):
+                    if submission.id == submission_id:
+                        return ahead + index
+                ahead += len(queue)
+        return None
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                'enqueued_tokens': self.enqueued_tokens,
+                'waiting': {token: len(queue) for token, queue in self.queues.items()},
+                'in_flight_batches': dict(self.user_batches),
+                'in_flight_tokens': dict(self.user_tokens),
+            }
+
+    def _reserve(self, token, estimated_tokens, batches):
+        # Caller holds self.cond
+        self.enqueued_tokens = max(self.enqueued_tokens + estimated_tokens, 0)
+        self.user_tokens[token] = max(self.user_tokens.get(token, 0) + estimated_tokens, 0)
+        self.user_batches[token] = max(self.user_batches.get(token, 0) + batches, 0)
+        if not self.user_batches[token]:
+            self.user_tokens.pop(token, None)
+            self.user_batches.pop(token, None)
+
+    def _fits(self, submission):
+        # A submission larger than the whole quota still runs once the user has nothing in flight
+        token = submission.token
+        if self.user_batches.get(token, 0) >= submission.max_in_flight:
+            return False
+        user_tokens = self.user_tokens.get(token, 0)
+        if (submission.quota_tokens is not None and user_tokens
+                and user_tokens + submission.estimated_tokens > submission.quota_tokens):
+            return False
+        submission.key_id = self.place(submission)
+        return submission.key_id is not None
+
+    def _next(self):
+        # Weighted round-robin: the user at the front keeps its turn for `weight` picks,
+        # and users whose next submission does not fit are skipped for this pass
+        for _ in range(len(self.queues)):
+            token, queue = next(iter(self.queues.items()))
+            if self._fits(queue[0]):
+                submission = queue.popleft()
+                self.credits[token] -= 1
+                if not queue:
+                    del self.queues[token]
+                    del self.credits[token]
+                elif self.credits[token] <= 0:
+                    self.credits[token] = queue[0].weight
+                    self.queues.move_to_end(token)
+                return submission
+            self.credits[token] = queue[0].weight
+            self.queues.move_to_end(token)
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                submission = self._next()
+                while submission is None:
+                    self.cond.wait(self.retry_seconds if self.queues else None)
+                    submission = self._next()
+                self._reserve(submission.token, submission.estimated_tokens, 1)
+            logger.info(f"Starting submission {submission.id} for token {submission.token} "
+                        f"(~{submission.estimated_tokens} tokens, {self.enqueued_tokens} enqueued)")
+            try:
+                self.start(submission).add_done_callback(lambda future, s=submission: self._finished(s, future))
+            except Exception as e:
+                self._finished(submission, None, e)
+
+    def _finished(self, submission, future, error=None):
+        error = error or future.exception()
+        if error is not None:
+            # Nothing was created upstream, so the reservation goes straight back
+            self.release(submission.token, submission.estimated_tokens)
+            submission.future.set_exception(error)
+        else:
+            submission.future.set_result(future.result())
@@ -0,0 +1,259 @@
+import io
+import csv
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Column names and types of each exportable table. Types are names rather than pyarrow
+# types so importing this module doesn't import pyarrow, which is optional and slow to load.
+BATCH_LOGS_COLUMNS = [
+    ('id', 'int64'),
+    ('timestamp', 'timestamp'),
+    ('batch_id', 'string'),
+    ('status', 'string'),
+    ('user_token', 'string'),
+    ('total_requests', 'int32'),
+    ('completed_requests', 'int32'),
+    ('failed_requests', 'int32'),
+    ('created_at', 'timestamp'),
+    ('completed_at', 'timestamp'),
+    ('input_file_id', 'string'),
+    ('output_file_id', 'string'),
+    ('remaining_balance', 'int32'),
+    ('completion_window', 'string'),
+    ('endpoint', 'string'),
+    ('metadata', 'string'),
+    ('processing_rate', 'float64'),
+    ('overall_processing_rate', 'float64'),
+    ('estimated_remaining_time', 'float64'),
+    ('total_elapsed_time', 'float64'),
+    ('sample_count', 'int32'),
+]
+
+BATCH_STATS_COLUMNS = [
+    ('period', 'string'),
+    ('user_token', 'string'),
+    ('bucket', 'timestamp'),
+    ('batches_created', 'int32'),
+    ('batches_completed', 'int32'),
+    ('requests_completed', 'int32'),
+    ('requests_failed', 'int32'),
+    ('tokens_debited', 'int32'),
+]
+
+BATCH_STATS_TTC_COLUMNS = [
+    ('period', 'string'),
+    ('user_token', 'string'),
+    ('bucket', 'timestamp'),
+    ('ttc_bucket', 'int32'),
+    ('count', 'int32'),
+]
+
+# The local status log written by the desktop client's polling
+BATCH_STATUS_LOG_COLUMNS = [
+    ('timestamp', 'timestamp'),
+    ('batch_id', 'string'),
+    ('status', 'string'),
+    ('user_token', 'string'),
+    ('total_requests', 'int32'),
+    ('completed_requests', 'int32'),
+    ('failed_requests', 'int32'),
+    ('created_at', 'timestamp'),
+    ('completed_at', 'timestamp'),
+    ('input_file_id', 'string'),
+    ('output_file_id', 'string'),
+    ('remaining_balance', 'int32'),
+    ('completion_window', 'string'),
+    ('endpoint', 'string'),
+    ('metadata', 'string'),
+    ('time_since_last_log', 'float64'),
+    ('completed_increment', 'int32'),
+    ('failed_increment', 'int32'),
+    ('time_per_request', 'float64'),
+    ('processing_rate', 'float64'),
+    ('overall_processing_rate', 'float64'),
+    ('estimated_remaining_time', 'float64'),
+    ('total_elapsed_time', 'float64'),
+]
+
+# table -> (columns, time column used for since/until)
+EXPORT_TABLES = {
+    'batch_logs': (BATCH_LOGS_COLUMNS, 'timestamp'),
+    'batch_stats': (BATCH_STATS_COLUMNS, 'bucket'),
+    'batch_stats_ttc': (BATCH_STATS_TTC_COLUMNS, 'bucket'),
+}
+
+FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+DEFAULT_ROW_GROUP_SIZE = 100000
+MIN_ROW_GROUP_SIZE = 1000
+MAX_ROW_GROUP_SIZE = 1000000
+
+def load_pyarrow():
+    # Returns the pyarrow module, or None when it isn't installed
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+def arrow_schema(pa, columns):
+    types = {
+        'int32': pa.int32(),
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'string': pa.string(),
+        'timestamp': pa.timestamp('us'),
+    }
+    return pa.schema([(name, types[type_name]) for name, type_name in columns])
+
+class StreamSink(io.RawIOBase):
+    # Write end for the pyarrow writers that keeps what they wrote until drain() takes it,
+    # so a generator can send each row group as soon as it is encoded
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def open_writer(pa, sink, schema, output_format):
+    if output_format == 'parquet':
+        return pa.parquet.ParquetWriter(sink, schema, compression='zstd')
+    return pa.ipc.new_stream(sink, schema)
+
+def write_record_batches(pa, rows, columns, sink, output_format, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    # Encodes rows (tuples in column order) as one record batch, and for Parquet one row
+    # group, per row_group_size rows. Yields after each batch is written to sink.
+    schema = arrow_schema(pa, columns)
+    writer = open_writer(pa, sink, schema, output_format)
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_batch(record_batch(pa, schema, batch))
+                batch = []
+                yield
+        if batch:
+            writer.write_batch(record_batch(pa, schema, batch))
+    finally:
+        writer.close()
+    yield
+
+def record_batch(pa, schema, rows):
+    arrays = [pa.array([row[index] for row in rows], type=field.type) for index, field in enumerate(schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def export_query(pa, connect, table, output_format, since=None, until=None, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    # Streams the table from a server-side cursor, so memory stays at one row group however
+    # big it is, and yields the encoded bytes as they are produced. The connection comes from
+    # connect() on the first chunk and is closed when the stream ends or is closed, so a
+    # response whose body is never read holds no connection.
+    columns, time_column = EXPORT_TABLES[table]
+    conditions = []
+    params = []
+    if since:
+        conditions.append(f"{time_column} >= %s")
+        params.append(since)
+    if until:
+        conditions.append(f"{time_column} < %s")
+        params.append(until)
+    query = f"SELECT {', '.join(name for name, _ in columns)} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # Left unordered, so rows stream as they are scanned instead of after a full sort
+
+    sink = StreamSink()
+    count = 0
+
+    def rows(cursor):
+        nonlocal count
+        for row in cursor:
+            count += 1
+            yield row
+
+    conn = connect()
+    try:
+        cursor = conn.cursor(name=f"export_{table}")
+        cursor.itersize = row_group_size
+        cursor.execute(query, params)
+        for _ in write_record_batches(pa, rows(cursor), columns, sink, output_format, row_group_size):
+            data = sink.drain()
+            if data:
+                yield data
+        logger.info(f"Exported {count} rows of {table} as {output_format}")
+    finally:
+        conn.close()
+
+def parse_csv_value(value, type_name):
+    if value == '':
+        return None
+    if type_name == 'timestamp':
+        return datetime.fromisoformat(value)
+    if type_name in ('int32', 'int64'):
+        return int(float(value))
+    if type_name == 'float64':
+        return float(value)
+    return value
+
+def convert_csv(pa, csv_path, output_path, output_format, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                columns=BATCH_STATUS_LOG_COLUMNS):
+    # Converts a CSV with a header row to Parquet or Arrow with typed columns; columns the
+    # schema doesn't know are dropped, and missing ones are left null. Returns the row count.
+    types = dict(columns)
+    count = 0
+    with open(csv_path, newline='') as source, open(output_path, 'wb') as sink:
+        reader = csv.DictReader(source)
+        unknown = [name for name in reader.fieldnames or [] if name not in types]
+        if unknown:
+            logger.warning(f"Ignoring columns not in the schema: {unknown}")
+
+        def rows():
+            nonlocal count
+            for record in reader:
+                count += 1
+                yield tuple(parse_csv_value(record.get(name) or '', type_name) for name, type_name in columns)
+
+        for _ in write_record_batches(pa, rows(), columns, sink, output_format, row_group_size):
+            pass
+    return count
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a batch status log CSV to Parquet or Arrow IPC')
+    parser.add_argument('csv_path', nargs='?', default='batch_status_log.csv')
+    parser.add_argument('output_path', nargs='?')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    parser.add_argument('--row-group-size', type=int, default=DEFAULT_ROW_GROUP_SIZE)
+    args = parser.parse_args()
+
+    pa = load_pyarrow()
+    if pa is None:
+        parser.exit(1, "pyarrow is required: pip install pyarrow\n")
+    output_path = args.output_path or f"{args.csv_path.rsplit('.', 1)[0]}.{FORMATS[args.format][1]}"
+    count = convert_csv(pa, args.csv_path, output_path, args.format, args.row_group_size)
+    print(f"Wrote {count} rows to {output_path}")
+
+if __name__ == '__main__':
+    main()
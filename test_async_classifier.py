@@ -0,0 +1,87 @@
+import io
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from async_classifier import AsyncClassifier
+from upstream import CircuitBreaker
+
+class FailingCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **body):
+        self.calls += 1
+        raise TimeoutError('upstream timed out')
+
+def classify_request(custom_id):
+    return (custom_id, {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': 'hi'}]}, 10)
+
+class ClassifierBreakerTest(unittest.TestCase):
+    def test_open_breaker_stops_requests_from_being_sent(self):
+        classifier = AsyncClassifier(max_concurrency=1, requests_per_minute=100, tokens_per_minute=100000)
+        completions = FailingCompletions()
+        client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        breaker = CircuitBreaker('srv-key', failure_threshold=2, reset_seconds=60)
+        results, sent = [], []
+        with patch.object(classifier, '_client', return_value=client):
+            classifier.classify('srv-key', 'sk-test', [classify_request(f'r{i}') for i in range(4)],
+                                results.append, sent.append, breaker).result(timeout=5)
+
+        self.assertEqual(completions.calls, 2)
+        self.assertEqual(len(sent), 2)
+        self.assertTrue(breaker.is_open())
+        self.assertEqual(sorted(result['response']['status_code'] for result in results if result['response']),
+                         [503, 503])
+
+class ClassifyRouteTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        cls.server = herokuserver
+        cls.client = herokuserver.app.test_client()
+        cls.key_id = herokuserver.key_pool.add_server_key('sk-classify-test')
+
+    def classify(self, on_classify=None):
+        body = b'{"custom_id": "a", "body": {"messages": [{"role": "user", "content": "hi"}]}}\n'
+        server = self.server
+        with patch.multiple(server, validate_token=lambda token: True, rate_limited=lambda token: False,
+                            load_user_key=lambda token: None), \
+                patch.object(server.key_pool, 'pick', return_value=self.key_id), \
+                patch.object(server, 'charge_tokens', return_value=99) as charge_tokens, \
+                patch.object(server, 'update_token_balance'), \
+                patch.object(server.async_classifier, 'classify', side_effect=on_classify), \
+                patch.object(server.batch_logger, 'log_batch_created') as log_batch_created:
+            response = self.client.post('/classify', data=io.BytesIO(body), headers={'User-Token': 'token_a'})
+            body = response.get_data()
+        return response, body, charge_tokens, log_batch_created
+
+    def test_open_circuit_is_503_before_charging(self):
+        breaker = self.server.upstream.breaker(self.key_id)
+        for _ in range(self.server.UPSTREAM_BREAKER_FAILURES):
+            breaker.record(TimeoutError())
+        try:
+            response, _, charge_tokens, _ = self.classify()
+        finally:
+            breaker.record()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        charge_tokens.assert_not_called()
+
+    def test_classify_is_not_logged_as_a_batch(self):
+        def on_classify(key_id, secret, requests, on_result, on_sent, breaker):
+            self.assertIs(breaker, self.server.upstream.breaker(self.key_id))
+            on_sent(key_id)
+            on_result({'custom_id': 'a', 'response': {'status_code': 200, 'body': {}}, 'error': None})
+            return SimpleNamespace(cancel=lambda: None)
+
+        response, body, charge_tokens, log_batch_created = self.classify(on_classify)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"custom_id": "a"', body)
+        charge_tokens.assert_called_once()
+        log_batch_created.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+from test_token_stats import openai_batch
+
+@requires_postgres
+class BatchJobsListEtagTest(HerokuServerTestCase):
+    def get_jobs(self, etag=None):
+        headers = {'User-Token': 'list_token'}
+        if etag:
+            headers['If-None-Match'] = etag
+        with patch.object(self.server, 'validate_token', return_value=True):
+            return self.server.app.test_client().get('/user/batch_jobs', headers=headers)
+
+    def test_body_only_changes_with_the_etag(self):
+        server = self.server
+        server.db_create_token('list_token', 100, datetime.now() + timedelta(days=1))
+        server.db_create_batch_job('batch_listed', 'in_progress', datetime.now(), 'list_token', 'file-input')
+        server.db_update_batch_progress('batch_listed', openai_batch('batch_listed', 'in_progress'))
+        self.query("UPDATE batch_jobs SET last_refreshed_at = last_refreshed_at - interval '1 hour'")
+        first = self.get_jobs()
+        etag = first.headers['ETag']
+
+        # A poll that finds nothing new only moves last_refreshed_at
+        server.db_update_batch_progress('batch_listed', openai_batch('batch_listed', 'in_progress'))
+        self.assertEqual(self.get_jobs(etag).status_code, 304)
+        unconditional = self.get_jobs()
+        self.assertEqual(unconditional.headers['ETag'], etag)
+        self.assertEqual(unconditional.get_json(), first.get_json())
+
+        server.db_update_batch_progress('batch_listed', openai_batch('batch_listed', 'completed'))
+        changed = self.get_jobs(etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.get_json()['batch_jobs'][0]['status'], 'completed')
+
+@requires_postgres
+class BatchJobsSnapshotTest(HerokuServerTestCase):
+    def test_list_serves_the_stored_progress_without_openai(self):
+        server = self.server
+        server.db_create_token('snapshot_token', 100, datetime.now() + timedelta(days=1))
+        server.db_create_batch_job('batch_snapshot', 'validating', datetime.now(), 'snapshot_token', 'file-input')
+        finished = openai_batch('batch_snapshot', 'completed')
+        server.db_update_batch_progress('batch_snapshot', finished)
+
+        with patch.object(server, 'validate_token', return_value=True), \
+                patch.object(server, 'get_openai_client', side_effect=AssertionError('OpenAI was called')):
+            response = server.app.test_client().get('/user/batch_jobs', headers={'User-Token': 'snapshot_token'})
+
+        self.assertEqual(response.status_code, 200)
+        job = response.get_json()['batch_jobs'][0]
+        self.assertEqual((job['status'], job['output_file_id']), ('completed', 'file-output'))
+        self.assertEqual(job['request_counts'], {'total': 4, 'completed': 4, 'failed': 0})
+        self.assertIsNotNone(job['completed_at'])
+        self.assertIsNotNone(job['expires_at'])
+
+@requires_postgres
+class BatchJobsDeltaSyncTest(HerokuServerTestCase):
+    def setUp(self):
+        self.token = f"delta_{self.id().rsplit('.', 1)[-1]}"
+        self.server.db_create_token(self.token, 100, datetime.now() + timedelta(days=1))
+
+    def sync(self, since):
+        with patch.object(self.server, 'validate_token', return_value=True):
+            response = self.server.app.test_client().get(f'/user/batch_jobs?since={since}',
+                                                         headers={'User-Token': self.token})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_deltas_cover_inserts_changes_and_deletes(self):
+        server = self.server
+        for batch_id in ('batch_kept', 'batch_changed', 'batch_deleted'):
+            server.db_create_batch_job(batch_id, 'in_progress', datetime.now(), self.token, f'file-{batch_id}')
+        everything = self.sync(0)
+        self.assertEqual(len(everything['batch_jobs']), 3)
+        cursor = everything['cursor']
+
+        # An unchanged poll moves nothing
+        server.db_update_batch_progress('batch_kept', openai_batch('batch_kept', 'in_progress'))
+        server.db_update_batch_progress('batch_kept', openai_batch('batch_kept', 'in_progress'))
+        cursor = self.sync(cursor)['cursor']
+        self.assertEqual(self.sync(cursor), {'batch_jobs': [], 'deleted': [], 'cursor': cursor})
+
+        server.db_update_batch_progress('batch_changed', openai_batch('batch_changed', 'completed'))
+        server.db_delete_batch_job('batch_deleted')
+        delta = self.sync(cursor)
+        self.assertEqual([(job['id'], job['status']) for job in delta['batch_jobs']], [('batch_changed', 'completed')])
+        self.assertEqual(delta['deleted'], ['batch_deleted'])
+        self.assertGreater(int(delta['cursor']), int(cursor))
+
+        with patch.object(server, 'validate_token', return_value=True):
+            response = server.app.test_client().get('/user/batch_jobs?since=-1', headers={'User-Token': self.token})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_cannot_skip_a_change_that_commits_late(self):
+        server = self.server
+        for batch_id in ('batch_held', 'batch_late'):
+            server.db_create_batch_job(batch_id, 'in_progress', datetime.now(), self.token, f'file-{batch_id}')
+        replica = {}
+
+        def apply(delta):
+            for job in delta['batch_jobs']:
+                replica[job['id']] = job['status']
+            return delta['cursor']
+
+        cursor = apply(self.sync(0))
+
+        # A change that has drawn its sequence value but not committed yet...
+        conn = server.get_db_connection()
+        c = conn.cursor()
+        server.lock_token_changes(c, self.token)
+        c.execute("""UPDATE batch_jobs SET status = 'cancelling', change_seq = nextval('batch_jobs_change_seq')
+                     WHERE id = 'batch_held'""")
+        # ...must hold back later changes of the same token until it commits
+        late = threading.Thread(target=server.db_update_batch_progress,
+                                args=('batch_late', openai_batch('batch_late', 'completed')))
+        late.start()
+        late.join(0.5)
+        cursor = apply(self.sync(cursor))
+        conn.commit()
+        conn.close()
+        late.join()
+        apply(self.sync(cursor))
+
+        self.assertEqual(replica, {'batch_held': 'cancelling', 'batch_late': 'completed'})
+
+if __name__ == '__main__':
+    unittest.main()
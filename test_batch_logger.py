@@ -0,0 +1,131 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import batch_logger
+from batch_logger import ALL_USERS, BatchLogger, ttc_percentile
+from pg_testing import HerokuServerTestCase, assert_admin_only, requires_postgres
+
+def batch_status(status, completed=0, failed=0, created_at=None, completed_at=None):
+    return {'status': status, 'request_counts': {'total': 4, 'completed': completed, 'failed': failed},
+            'created_at': created_at or int(time.time()), 'completed_at': completed_at,
+            'input_file_id': 'file-input', 'completion_window': '24h', 'endpoint': '/v1/chat/completions'}
+
+class TimeToCompleteTest(unittest.TestCase):
+    def test_percentiles_are_bucket_upper_bounds(self):
+        histogram = {batch_logger.ttc_bucket(45): 9, batch_logger.ttc_bucket(5000): 1}
+        self.assertEqual(ttc_percentile(histogram, 0.5), 60)
+        self.assertEqual(ttc_percentile(histogram, 0.95), 7200)
+        self.assertIsNone(ttc_percentile({}, 0.5))
+        self.assertEqual(ttc_percentile({batch_logger.ttc_bucket(10 ** 6): 1}, 0.5), batch_logger.TTC_BUCKET_BOUNDS[-1])
+
+@requires_postgres
+class BatchLoggerTestCase(HerokuServerTestCase):
+    def setUp(self):
+        self.batch_logger = BatchLogger(create_table=False)
+        self.batch_logger.DATABASE_URL = self.database_url
+
+    def log(self, batch_id, status, user_token, previous_status=None):
+        self.batch_logger.log_batch_status(batch_id, status, user_token, previous_status)
+        self.batch_logger.log_queue.join()
+
+class RollupTest(BatchLoggerTestCase):
+    def stats(self, user_token, period='day'):
+        # Summed over buckets, since creation and completion may land either side of a boundary
+        return self.query("""SELECT SUM(batches_created), SUM(batches_completed), SUM(requests_completed),
+                                    SUM(requests_failed), SUM(tokens_debited)
+                             FROM batch_stats WHERE period = %s AND user_token = %s""", (period, user_token))
+
+    def test_creation_and_terminal_transition_are_counted_once(self):
+        self.batch_logger.log_batch_created('batch_rolled', 'rollup_token', 4)
+        now = int(time.time())
+        finished = batch_status('completed', completed=3, failed=1, created_at=now - 100, completed_at=now)
+        self.log('batch_rolled', batch_status('in_progress', created_at=now - 100), 'rollup_token', 'validating')
+        self.log('batch_rolled', finished, 'rollup_token', 'in_progress')
+        # Later polls of the finished batch see it already terminal
+        self.log('batch_rolled', finished, 'rollup_token', 'completed')
+        self.log('batch_rolled', finished, 'rollup_token', None)
+
+        for user_token in ('rollup_token', ALL_USERS):
+            for period in ('minute', 'day'):
+                self.assertEqual(self.stats(user_token, period), [(1, 1, 3, 1, 4)])
+        self.assertEqual(self.query("""SELECT ttc_bucket, SUM(count) FROM batch_stats_ttc
+                                       WHERE period = 'day' AND user_token = 'rollup_token' GROUP BY 1"""),
+                         [(batch_logger.ttc_bucket(100), 1)])
+
+        client = self.server.app.test_client()
+        assert_admin_only(self, client, 'get', '/admin/stats?period=day')
+        response = client.get('/admin/stats?period=day&user_token=rollup_token',
+                              headers={'Admin-Token': 'test-admin-token'})
+        self.assertEqual(response.status_code, 200)
+        totals = response.get_json()['totals']
+        self.assertEqual((totals['batches_created'], totals['requests_completed'], totals['p50_time_to_complete']),
+                         (1, 3, 120))
+
+    def test_failed_batches_count_requests_but_not_completions(self):
+        now = int(time.time())
+        self.log('batch_failed', batch_status('failed', failed=4, created_at=now - 30), 'failing_token', 'in_progress')
+        self.assertEqual(self.stats('failing_token'), [(0, 0, 0, 4, 0)])
+        self.assertEqual(self.query("SELECT count(*) FROM batch_stats_ttc WHERE user_token = 'failing_token'"), [(0,)])
+
+class ChangeOnlyLoggingTest(BatchLoggerTestCase):
+    def logged(self, batch_id):
+        return self.query("SELECT status, completed_requests FROM batch_logs WHERE batch_id = %s ORDER BY id",
+                          (batch_id,))
+
+    def test_unchanged_polls_are_not_logged(self):
+        for completed in (0, 0, 2, 2, 2):
+            self.log('batch_polled', batch_status('in_progress', completed=completed), 'poll_token')
+        self.assertEqual(self.logged('batch_polled'), [('in_progress', 0), ('in_progress', 2)])
+
+        # A restarted server seeds the last state from the table instead of logging it again
+        self.batch_logger = BatchLogger(create_table=False)
+        self.batch_logger.DATABASE_URL = self.database_url
+        self.log('batch_polled', batch_status('in_progress', completed=2), 'poll_token')
+        self.log('batch_polled', batch_status('completed', completed=4), 'poll_token')
+        self.assertEqual(self.logged('batch_polled'), [('in_progress', 0), ('in_progress', 2), ('completed', 4)])
+
+    def test_unchanged_batches_still_log_a_heartbeat(self):
+        self.batch_logger.heartbeat_seconds = 0
+        for _ in range(3):
+            self.log('batch_heartbeat', batch_status('in_progress'), 'poll_token')
+        self.assertEqual(len(self.logged('batch_heartbeat')), 3)
+
+class CompactionTest(BatchLoggerTestCase):
+    def insert(self, batch_id, status, completed, age_days):
+        self.query("""INSERT INTO batch_logs (timestamp, batch_id, status, total_requests, completed_requests,
+                                              failed_requests)
+                      VALUES (%s, %s, %s, 4, %s, 0)""",
+                   (datetime.now() - timedelta(days=age_days), batch_id, status, completed))
+
+    def test_old_rows_collapse_to_one_per_state(self):
+        for age_days in (12, 11, 10):
+            self.insert('batch_old', 'in_progress', 0, age_days)
+        self.insert('batch_old', 'in_progress', 2, 9)
+        self.insert('batch_old', 'in_progress', 2, 8)
+        for age_days in (2, 1):
+            self.insert('batch_recent', 'in_progress', 0, age_days)
+
+        self.assertEqual(self.batch_logger.compact(7), 3)
+
+        self.assertEqual(self.query("""SELECT batch_id, completed_requests, COALESCE(sample_count, 1),
+                                              timestamp::date
+                                       FROM batch_logs ORDER BY batch_id, timestamp"""),
+                         [('batch_old', 0, 3, (datetime.now() - timedelta(days=10)).date()),
+                          ('batch_old', 2, 2, (datetime.now() - timedelta(days=8)).date()),
+                          ('batch_recent', 0, 1, (datetime.now() - timedelta(days=2)).date()),
+                          ('batch_recent', 0, 1, (datetime.now() - timedelta(days=1)).date())])
+        self.assertEqual(self.batch_logger.compact(7), 0)
+
+    def test_admin_route_requires_the_admin_token(self):
+        self.addCleanup(self.query, "DELETE FROM batch_logs WHERE batch_id = 'batch_route'")
+        self.insert('batch_route', 'in_progress', 0, 12)
+        self.insert('batch_route', 'in_progress', 0, 11)
+        client = self.server.app.test_client()
+        assert_admin_only(self, client, 'post', '/admin/compact_batch_logs?older_than_days=7')
+        self.assertEqual(self.query("SELECT count(*) FROM batch_logs WHERE batch_id = 'batch_route'"), [(2,)])
+        response = client.post('/admin/compact_batch_logs?older_than_days=7', headers={'Admin-Token': 'test-admin-token'})
+        self.assertEqual(response.get_json(), {'older_than_days': 7, 'rows_deleted': 1})
+
+if __name__ == '__main__':
+    unittest.main()
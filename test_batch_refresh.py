@@ -0,0 +1,46 @@
+import unittest
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+from test_token_stats import openai_batch
+
+REFRESHERS = 8
+
+@requires_postgres
+class ConcurrentRefreshTest(HerokuServerTestCase):
+    def test_batch_finishing_is_handled_once(self):
+        server = self.server
+        server.db_create_token('refresh_token', 100, datetime.now() + timedelta(days=1))
+        server.db_create_batch_job('batch_refreshed', 'in_progress', datetime.now(), 'refresh_token', 'file-input',
+                                   num_requests=4)
+        batch_job = server.db_get_batch_job('batch_refreshed')
+        completed = openai_batch('batch_refreshed', 'completed')
+        barrier = threading.Barrier(REFRESHERS)
+
+        def retrieve(operation, key_id, call, retry=False, hedge=False):
+            barrier.wait()
+            return completed
+
+        completed.model_dump = lambda: {'id': completed.id, 'status': completed.status,
+                                        'output_file_id': completed.output_file_id}
+        with patch.object(server, 'call_openai', retrieve), \
+                patch.object(server.batch_logger, 'log_batch_status') as log_batch_status, \
+                patch.object(server.webhook_dispatcher, 'notify') as notify, \
+                patch.object(server.ingestion_executor, 'submit') as submit, \
+                patch.object(server, 'release_batch_budget'):
+            threads = [threading.Thread(target=server.refresh_batch_job, args=(batch_job,)) for _ in range(REFRESHERS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(submit.call_count, 1)
+        previous_statuses = [call.kwargs['previous_status'] for call in log_batch_status.call_args_list]
+        self.assertEqual(previous_statuses.count('in_progress'), 1)
+        self.assertEqual(previous_statuses.count('completed'), REFRESHERS - 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import json
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+def result_line(custom_id, decision):
+    return json.dumps({'custom_id': custom_id, 'response': {'status_code': 200, 'body': {
+        'choices': [{'message': {'content': decision}}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 1, 'total_tokens': 11}}}}) + '\n'
+
+@requires_postgres
+class IngestBatchResultsTest(HerokuServerTestCase):
+    def setUp(self):
+        server = self.server
+        self.batch_id = f"batch_{self.id().rsplit('.', 1)[-1]}"
+        server.db_create_token('results_token', 100, datetime.now() + timedelta(days=1))
+        server.db_create_batch_job(self.batch_id, 'completed', datetime.now(), 'results_token', 'file-input',
+                                   f'file-output-{self.batch_id}')
+        output = tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        output.write(result_line('a', 'yes') + result_line('b', 'no'))
+        output.close()
+        self.output_path = output.name
+
+    def tearDown(self):
+        os.remove(self.output_path)
+        self.server.db_delete_token('results_token')
+
+    def test_output_file_is_fetched_outside_the_transaction(self):
+        lock_free_during_fetch = []
+
+        def get_or_fetch(file_id, fetch):
+            # Another session can take the ingestion lock, so the ingester holds nothing yet
+            lock_free_during_fetch.append(self.query("SELECT pg_try_advisory_xact_lock(hashtext(%s))",
+                                                     (f"batch_results:{self.batch_id}",))[0][0])
+            return self.output_path
+
+        with patch.object(self.server.file_cache, 'get_or_fetch', get_or_fetch):
+            self.server.ingest_batch_results(self.batch_id)
+            self.server.ingest_batch_results(self.batch_id)
+
+        self.assertEqual(lock_free_during_fetch, [True])
+        self.assertEqual(self.query("SELECT custom_id, decision FROM batch_results WHERE batch_id = %s ORDER BY 1",
+                                    (self.batch_id,)), [('a', 'yes'), ('b', 'no')])
+
+    def test_decision_pages_skip_ingestion_once_ingested(self):
+        client = self.server.app.test_client()
+        with patch.object(self.server, 'validate_token', return_value=True), \
+                patch.object(self.server.file_cache, 'get_or_fetch', return_value=self.output_path), \
+                patch.object(self.server, 'ingest_batch_results', wraps=self.server.ingest_batch_results) as ingest:
+            first = client.get(f'/batches/{self.batch_id}/decisions?limit=1', headers={'User-Token': 'results_token'})
+            second = client.get(f"/batches/{self.batch_id}/decisions?limit=1&after={first.get_json()['next_after']}",
+                                headers={'User-Token': 'results_token'})
+
+        self.assertEqual([d['custom_id'] for d in first.get_json()['decisions'] + second.get_json()['decisions']],
+                         ['a', 'b'])
+        self.assertEqual(ingest.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from flask import Flask, Response, jsonify, request
+
+import compression
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.wsgi_app = compression.DecompressRequestMiddleware(app.wsgi_app)
+
+        @app.route('/echo', methods=['POST'])
+        def echo():
+            return jsonify({'body': request.get_data(as_text=True), 'form': request.form.to_dict()})
+
+        @app.route('/json/<int:size>')
+        def json_of_size(size):
+            return jsonify({'data': 'x' * size})
+
+        @app.route('/stream')
+        def stream():
+            return Response((b'x' * 1024 for _ in range(4)), mimetype='text/plain')
+
+        @app.after_request
+        def compress(response):
+            return compression.compress_response(response, request.accept_encodings)
+
+        self.client = app.test_client()
+
+    def test_gzip_request_bodies_are_decoded(self):
+        response = self.client.post('/echo', data=gzip.compress(b'name=shard&count=3'),
+                                    headers={'Content-Encoding': 'gzip',
+                                             'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(response.get_json()['form'], {'name': 'shard', 'count': '3'})
+
+    def test_unsupported_request_encoding_is_refused(self):
+        response = self.client.post('/echo', data=b'...', headers={'Content-Encoding': 'br'})
+        self.assertEqual(response.status_code, 415)
+
+    def test_large_json_responses_are_compressed(self):
+        response = self.client.get('/json/4096', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertIn(b'x' * 4096, gzip.decompress(response.data))
+
+    def test_small_streamed_and_unaccepted_responses_are_left_alone(self):
+        small = self.client.get('/json/10', headers={'Accept-Encoding': 'gzip'})
+        streamed = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        unaccepted = self.client.get('/json/4096', headers={'Accept-Encoding': 'identity'})
+        for response in (small, streamed, unaccepted):
+            self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(streamed.data), 4096)
+
+    def test_gzip_chunks_round_trip(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(compression.CHUNK_SIZE) * 3)
+        self.addCleanup(os.remove, f.name)
+        with open(f.name, 'rb') as plain:
+            self.assertEqual(gzip.decompress(b''.join(compression.gzip_chunks(f.name))), plain.read())
+
+    def test_compressed_part_names(self):
+        self.assertEqual(compression.encoding_for_filename('shard.jsonl.gz'), ('gzip', 'shard.jsonl'))
+        self.assertEqual(compression.encoding_for_filename('shard.jsonl.zst'), ('zstd', 'shard.jsonl'))
+        self.assertEqual(compression.encoding_for_filename('shard.jsonl'), (None, 'shard.jsonl'))
+
+if __name__ == '__main__':
+    unittest.main()
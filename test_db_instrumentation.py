@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+import db_instrumentation
+from db_instrumentation import DbInstrumentation, fingerprint
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+class FingerprintTest(unittest.TestCase):
+    def test_literals_and_value_lists_are_folded(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE a = 'x''y' AND b = 42 AND c = %s"),
+                         'SELECT * FROM t WHERE a = ? AND b = ? AND c = ?')
+        self.assertEqual(fingerprint("INSERT INTO t VALUES (1, 'a', NULL), (2, 'b', TRUE)\n  RETURNING id"),
+                         'INSERT INTO t VALUES (...) RETURNING id')
+        self.assertEqual(fingerprint('SELECT %(id)s'), fingerprint('SELECT 7'))
+
+class DbInstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = DbInstrumentation(enabled=True, slow_query_ms=10 ** 6)
+
+    def connect(self):
+        conn = self.instrumentation.connect(sqlite3.connect, ':memory:', dialect='sqlite')
+        conn.execute('CREATE TABLE items (id INTEGER, name TEXT)')
+        return conn
+
+    def test_disabled_hands_back_the_driver_connection(self):
+        conn = DbInstrumentation(enabled=False).connect(sqlite3.connect, ':memory:')
+        self.assertIsInstance(conn, sqlite3.Connection)
+
+    def test_statements_are_attributed_to_the_db_helper(self):
+        conn = self.connect()
+
+        def db_add_items():
+            c = conn.cursor()
+            for index in range(3):
+                c.execute('INSERT INTO items VALUES (?, ?)', (index, f'item {index}'))
+            conn.commit()
+
+        def db_get_items():
+            c = conn.cursor()
+            c.execute("SELECT name FROM items WHERE id >= 0")
+            return c.fetchall()
+
+        db_add_items()
+        self.assertEqual(len(db_get_items()), 3)
+
+        snapshot = self.instrumentation.snapshot(order='calls')
+        entries = {(entry['caller'], entry['statement']): entry for entry in snapshot['statements']}
+        insert = entries[('db_add_items', 'INSERT INTO items VALUES (...)')]
+        self.assertEqual((insert['calls'], insert['rows']), (3, 3))
+        self.assertIn(('db_add_items', 'COMMIT'), entries)
+        self.assertEqual(entries[('db_get_items', 'SELECT name FROM items WHERE id >= ?')]['calls'], 1)
+        self.assertEqual(snapshot['connects'][0]['connects'], 1)
+
+    def test_slow_statements_are_logged_with_their_plan_once_per_interval(self):
+        self.instrumentation.configure(slow_query_ms=0)
+        conn = self.connect()
+        with self.assertLogs('db_instrumentation', 'WARNING') as logs:
+            for _ in range(2):
+                conn.execute('SELECT * FROM items WHERE id = ?', (1,))
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('SCAN items', logs.output[0])
+        self.assertNotIn('SCAN', logs.output[1])
+
+    def test_errors_are_counted_and_raised(self):
+        conn = self.connect()
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute('SELECT * FROM missing_table')
+        errors = {entry['statement']: entry['errors'] for entry in self.instrumentation.snapshot()['statements']}
+        self.assertEqual(errors['SELECT * FROM missing_table'], 1)
+
+    def test_fingerprints_beyond_the_limit_share_one_entry(self):
+        conn = self.connect()
+        with patch.object(db_instrumentation, 'MAX_FINGERPRINTS', 2):
+            for column in ('id', 'name', 'id, name', 'name, id'):
+                conn.execute(f'SELECT {column} FROM items')
+        statements = {entry['statement'] for entry in self.instrumentation.snapshot()['statements']}
+        self.assertIn(db_instrumentation.OTHER, statements)
+        self.assertEqual(len(statements), 3)
+
+@requires_postgres
+class PostgresExplainTest(HerokuServerTestCase):
+    def test_failed_explain_does_not_abort_the_transaction(self):
+        import psycopg2
+        instrumentation = DbInstrumentation(enabled=True, slow_query_ms=0)
+        conn = instrumentation.connect(psycopg2.connect, self.database_url)
+        c = conn.cursor()
+        c.execute('CREATE TABLE explained (id INTEGER)')
+        with patch.dict(db_instrumentation.EXPLAIN_PREFIXES, {'postgres': 'EXPLAIN NOT VALID '}):
+            c.execute('INSERT INTO explained VALUES (%s)', (1,))
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.query('SELECT id FROM explained'), [(1,)])
+
+    def test_admin_route_reports_server_statements(self):
+        instrumentation = db_instrumentation.instrumentation
+        with patch.object(instrumentation, 'enabled', True):
+            instrumentation.reset()
+            self.server.db_get_token('no_such_token')
+            client = self.server.app.test_client()
+            self.assertEqual(client.get('/admin/db_stats').status_code, 403)
+            response = client.get('/admin/db_stats', headers={'Admin-Token': 'test-admin-token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db_get_token', {entry['caller'] for entry in response.get_json()['statements']})
+
+    def test_admin_route_requires_the_admin_token(self):
+        client = self.server.app.test_client()
+        with patch.object(db_instrumentation.instrumentation, 'reset') as reset:
+            for method in (client.get, client.delete):
+                self.assertEqual(method('/admin/db_stats', headers={'Admin-Token': 'wrong'}).status_code, 403)
+                with patch.dict(os.environ):
+                    os.environ.pop('ADMIN_TOKEN')
+                    self.assertEqual(method('/admin/db_stats').status_code, 403)
+        reset.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
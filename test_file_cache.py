@@ -0,0 +1,136 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from file_cache import FileCache
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = FileCache(self.cache_dir, 1024)
+        fetches = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch(file_id):
+            fetches.append(file_id)
+            started.set()
+            release.wait(2)
+            yield b'content'
+
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(cache.get_or_fetch('file-a', fetch)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait(2)
+        release.set()
+        for thread in threads:
+            thread.join(2)
+
+        self.assertEqual(fetches, ['file-a'])
+        self.assertEqual(len(set(paths)), 1)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'content')
+
+    def test_least_recently_used_file_is_evicted(self):
+        cache = FileCache(self.cache_dir, 10)
+        cache.put('file-a', [b'aaaa'])
+        cache.put('file-b', [b'bbbb'])
+        cache.get('file-a')
+        cache.put('file-c', [b'cccc'])
+
+        self.assertIsNone(cache.get('file-b'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'file-b')))
+        self.assertIsNotNone(cache.get('file-a'))
+        self.assertEqual(cache.total_bytes, 8)
+
+    def test_failed_fetch_leaves_nothing_behind(self):
+        cache = FileCache(self.cache_dir, 1024)
+
+        def fetch(file_id):
+            yield b'partial'
+            raise ConnectionError('download interrupted')
+
+        with self.assertRaises(ConnectionError):
+            cache.get_or_fetch('file-a', fetch)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertIsNone(cache.get('file-a'))
+
+    def test_cached_files_survive_a_restart(self):
+        FileCache(self.cache_dir, 1024).put('file-a', [b'aaaa'])
+        cache = FileCache(self.cache_dir, 1024)
+        self.assertEqual(cache.get_or_fetch('file-a', lambda file_id: self.fail('refetched')),
+                         os.path.join(self.cache_dir, 'file-a'))
+        self.assertEqual(cache.total_bytes, 4)
+
+    def test_file_ids_cannot_escape_the_cache_dir(self):
+        cache = FileCache(self.cache_dir, 1024)
+        with self.assertRaises(ValueError):
+            cache.get('../secrets')
+
+@requires_postgres
+class CachedFileRouteTest(HerokuServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server.db_create_token('cache_token', 100, datetime.now() + timedelta(days=1))
+        cls.server.db_create_batch_job('batch_cached', 'completed', datetime.now(), 'cache_token', 'file-in', 'file-out')
+        cls.client = cls.server.app.test_client()
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.fetches = []
+        patcher = patch.object(self.server, 'file_cache', FileCache(cache_dir, 1024 * 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_file_content(self, file_id):
+        self.fetches.append(file_id)
+        yield b'0123456789\n'
+
+    def retrieve(self, **headers):
+        with patch.object(self.server, 'validate_token', return_value=True), \
+                patch.object(self.server, 'fetch_file_content', self.fetch_file_content):
+            return self.client.get('/retrieve_file_content/file-out',
+                                   headers={'User-Token': 'cache_token', 'Accept-Encoding': 'identity', **headers})
+
+    def test_repeat_downloads_come_from_the_cache(self):
+        first = self.retrieve()
+        second = self.retrieve()
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second.data, b'0123456789\n')
+        self.assertEqual(self.fetches, ['file-out'])
+
+    def test_matching_etag_gets_304_without_a_fetch(self):
+        response = self.retrieve(**{'If-None-Match': '"file-out"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.fetches, [])
+
+    def test_range_resumes_a_download(self):
+        response = self.retrieve(Range='bytes=4-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'456789\n')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 4-10/11')
+
+    def test_full_downloads_get_a_cached_gzip_copy(self):
+        for _ in range(2):
+            response = self.retrieve(**{'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.data), b'0123456789\n')
+        self.assertEqual(self.fetches, ['file-out'])
+        self.assertEqual(self.retrieve(**{'If-None-Match': '"file-out-gzip"'}).status_code, 304)
+        self.assertEqual(self.retrieve(**{'Accept-Encoding': 'gzip', 'Range': 'bytes=4-'}).data, b'456789\n')
+
+if __name__ == '__main__':
+    unittest.main()
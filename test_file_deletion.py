@@ -0,0 +1,68 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+@requires_postgres
+class FileDeletionTest(HerokuServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key_id = cls.server.key_pool.add_server_key('sk-deletion-test')
+        for token in ('delete_token', 'other_token'):
+            cls.server.db_create_token(token, 100, datetime.now() + timedelta(days=1))
+
+    def create_batch(self, batch_id, token='delete_token'):
+        self.server.db_create_batch_job(batch_id, 'completed', datetime.now(), token, f'file-in-{batch_id}',
+                                        f'file-out-{batch_id}', api_key_id=self.key_id)
+
+    def deletions(self, batch_id):
+        return dict(self.query("SELECT file_id, status FROM file_deletions WHERE batch_id = %s", (batch_id,)))
+
+    def delete_many(self, batch_ids):
+        with patch.object(self.server, 'validate_token', return_value=True), \
+                patch.object(self.server.deletion_executor, 'submit') as submit:
+            response = self.server.app.test_client().delete('/batches/files', json={'batch_ids': batch_ids},
+                                                            headers={'User-Token': 'delete_token'})
+        return response, submit
+
+    def test_bulk_delete_schedules_files_of_owned_batches_only(self):
+        self.create_batch('batch_mine')
+        self.create_batch('batch_theirs', token='other_token')
+        response, submit = self.delete_many(['batch_mine', 'batch_theirs', 'batch_unknown'])
+
+        self.assertEqual(response.status_code, 202)
+        body = response.get_json()
+        self.assertEqual(sorted(body['scheduled']['batch_mine']), ['file-in-batch_mine', 'file-out-batch_mine'])
+        self.assertEqual(sorted(body['not_found']), ['batch_theirs', 'batch_unknown'])
+        self.assertEqual(sorted(call.args[1] for call in submit.call_args_list),
+                         ['file-in-batch_mine', 'file-out-batch_mine'])
+        self.assertEqual(set(self.deletions('batch_mine').values()), {'pending'})
+        self.assertIsNone(self.server.db_get_batch_job('batch_mine'))
+        self.assertIsNotNone(self.server.db_get_batch_job('batch_theirs'))
+
+    def test_failed_deletion_is_retried_then_given_up(self):
+        self.create_batch('batch_retry')
+        self.delete_many(['batch_retry'])
+        file_id = 'file-out-batch_retry'
+
+        with patch.object(self.server, 'delete_file', side_effect=Exception('upstream error')), \
+                patch.object(self.server.threading, 'Timer') as timer:
+            self.server.delete_file_in_background(file_id, 1, self.key_id)
+            self.assertEqual(self.deletions('batch_retry')[file_id], 'pending')
+            delay = timer.call_args.args[0]
+            self.assertEqual(delay, self.server.DELETION_RETRY_BASE_SECONDS)
+            self.assertEqual(timer.call_args.kwargs['args'][1:], (file_id, 2, self.key_id))
+
+            timer.reset_mock()
+            self.server.delete_file_in_background(file_id, self.server.DELETION_MAX_ATTEMPTS, self.key_id)
+            timer.assert_not_called()
+        self.assertEqual(self.deletions('batch_retry')[file_id], 'failed')
+
+        with patch.object(self.server, 'delete_file'):
+            self.server.delete_file_in_background('file-in-batch_retry', 1, self.key_id)
+        self.assertEqual(self.deletions('batch_retry')['file-in-batch_retry'], 'deleted')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+def openai_file(file_id, age, purpose='batch'):
+    return SimpleNamespace(id=file_id, purpose=purpose, bytes=100,
+                           created_at=int((datetime.now() - age).timestamp()))
+
+def finished_future(*args):
+    future = Future()
+    future.set_result(None)
+    return future
+
+@requires_postgres
+class OrphanReasonTest(HerokuServerTestCase):
+    def reason(self, reference=None, deletion_status=None, server_key=True, file_age=timedelta(days=10)):
+        now = datetime.now()
+        return self.server.orphan_reason(openai_file('file-x', file_age), reference, deletion_status, server_key, now)
+
+    def reference(self, status, ended_ago, ingested=True):
+        ended_at = datetime.now() - ended_ago
+        return {'status': status, 'created_at': ended_at - timedelta(hours=1), 'completed_at': ended_at,
+                'last_refreshed_at': ended_at, 'results_ingested_at': ended_at if ingested else None}
+
+    def test_reasons(self):
+        retention = self.server.FILE_GC_RETENTION
+        self.assertEqual(self.reason(), 'unreferenced')
+        self.assertIsNone(self.reason(file_age=timedelta(hours=1)))
+        self.assertIsNone(self.reason(server_key=False))
+        self.assertIsNone(self.reason(deletion_status='pending'))
+        self.assertEqual(self.reason(self.reference('failed', timedelta(0)), deletion_status='deleted'),
+                         'deletion_incomplete')
+        self.assertIsNone(self.reason(self.reference('in_progress', retention * 2)))
+        self.assertIsNone(self.reason(self.reference('failed', retention / 2)))
+        self.assertEqual(self.reason(self.reference('failed', retention * 2)), 'batch_failed')
+        # A user key's batch files are collected like a server key's
+        self.assertEqual(self.reason(self.reference('expired', retention * 2), server_key=False), 'batch_expired')
+        self.assertIsNone(self.reason(self.reference('completed', retention * 2, ingested=False)))
+        self.assertEqual(self.reason(self.reference('completed', retention * 2)), 'batch_completed')
+
+@requires_postgres
+class FileGarbageCollectionTest(HerokuServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key_id = cls.server.key_pool.add_server_key('sk-file-gc-test')
+
+    def test_report_then_delete_orphans(self):
+        server = self.server
+        ended_at = datetime.now() - server.FILE_GC_RETENTION * 2
+        for batch_id, status, ingested in (('batch_done', 'completed', True), ('batch_uningested', 'completed', False),
+                                           ('batch_running', 'in_progress', None)):
+            server.db_create_batch_job(batch_id, status, ended_at, 'gc_token', f'file-in-{batch_id}',
+                                       f'file-out-{batch_id}', api_key_id=self.key_id)
+            self.query("UPDATE batch_jobs SET completed_at = %s, results_ingested_at = %s WHERE id = %s",
+                       (ended_at, ended_at if ingested else None, batch_id))
+        server.db_schedule_file_deletions(None, None, ['file-stale-delete'], self.key_id)
+        server.db_update_file_deletion('file-stale-delete', 'deleted', 1)
+        server.db_schedule_file_deletions(None, None, ['file-deleting'], self.key_id)
+
+        old = timedelta(days=5)
+        upstream = [openai_file(f'file-{kind}-{batch_id}', old, purpose)
+                    for batch_id in ('batch_done', 'batch_uningested', 'batch_running')
+                    for kind, purpose in (('in', 'batch'), ('out', 'batch_output'))]
+        upstream += [openai_file('file-unreferenced', old), openai_file('file-fresh-upload', timedelta(minutes=5)),
+                     openai_file('file-stale-delete', old), openai_file('file-deleting', old),
+                     openai_file('file-fine-tune', old, 'fine-tune')]
+
+        def call_openai(name, key_id, call, retry=False):
+            return call(SimpleNamespace(files=SimpleNamespace(list=lambda: upstream if key_id == self.key_id else [])))
+
+        with patch.object(server, 'call_openai', call_openai):
+            client = server.app.test_client()
+            self.assertEqual(client.get('/admin/file_gc').status_code, 403)
+            report = client.get('/admin/file_gc', headers={'Admin-Token': 'test-admin-token'}).get_json()
+
+        orphans = {orphan['file_id']: orphan['reason'] for orphan in report['orphans']}
+        self.assertEqual(orphans, {'file-in-batch_done': 'batch_completed', 'file-out-batch_done': 'batch_completed',
+                                   'file-unreferenced': 'unreferenced', 'file-stale-delete': 'deletion_incomplete'})
+        self.assertEqual(report['files_listed'], 10)
+        self.assertEqual(report['bytes'], 400)
+
+        with patch.object(server.deletion_executor, 'submit', side_effect=finished_future) as submit:
+            server.delete_orphan_files(report['orphans'])
+        self.assertEqual(sorted(call.args[1] for call in submit.call_args_list), sorted(orphans))
+        deletions = dict(self.query("SELECT file_id, reason FROM file_deletions WHERE status = 'pending'"))
+        self.assertEqual(deletions['file-unreferenced'], 'unreferenced')
+        self.assertEqual(deletions['file-stale-delete'], 'deletion_incomplete')
+
+        # Already pending now, so a second run does not delete them again
+        with patch.object(server.deletion_executor, 'submit', side_effect=finished_future) as submit:
+            server.delete_orphan_files(report['orphans'])
+        submit.assert_not_called()
+
+    def test_admin_token_is_required(self):
+        server = self.server
+        client = server.app.test_client()
+        with patch.object(server, 'find_orphan_files') as find, patch.object(server, 'delete_orphan_files') as delete:
+            for method in (client.get, client.post):
+                self.assertEqual(method('/admin/file_gc', headers={'Admin-Token': 'wrong'}).status_code, 403)
+                # With no ADMIN_TOKEN configured, a request without the header must not match it
+                with patch.dict(os.environ):
+                    os.environ.pop('ADMIN_TOKEN')
+                    self.assertEqual(method('/admin/file_gc').status_code, 403)
+                    self.assertEqual(method('/admin/file_gc', headers={'Admin-Token': ''}).status_code, 403)
+        find.assert_not_called()
+        delete.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import os
+import unittest
+from collections import OrderedDict
+from unittest.mock import patch
+
+from key_pool import KeyPool, UnknownKeyError, encrypt_secret, decrypt_secret
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+def encryption_key():
+    from cryptography.fernet import Fernet
+    return Fernet.generate_key().decode()
+
+class KeyPoolTest(unittest.TestCase):
+    def test_user_key_is_chosen_for_its_token_only(self):
+        pool = KeyPool(enqueued_token_limit=1000, requests_per_minute=10)
+        server_key = pool.add_server_key('sk-server')
+        user_key = pool.add_user_key('token_a', 'sk-user')
+        self.assertEqual(pool.place('token_a', 100), user_key)
+        self.assertEqual(pool.place('token_b', 100), server_key)
+        self.assertEqual(pool.pick('token_a'), user_key)
+
+        pool.remove_user_key('token_a')
+        self.assertEqual(pool.place('token_a', 100), server_key)
+        # Still reachable for the batches it created
+        self.assertEqual(pool.require(user_key).secret, 'sk-user')
+
+    def test_unknown_key_raises(self):
+        pool = KeyPool(enqueued_token_limit=1000, requests_per_minute=10)
+        self.assertIsNone(pool.pick('token_a'))
+        with self.assertRaises(UnknownKeyError):
+            pool.require(None)
+        with self.assertRaises(UnknownKeyError):
+            pool.client('usr-missing')
+
+    def test_secrets_are_encrypted_and_plain_rows_still_read(self):
+        key = encryption_key()
+        stored = encrypt_secret(key, 'sk-user')
+        self.assertNotIn('sk-user', stored)
+        self.assertEqual(decrypt_secret(key, stored), 'sk-user')
+        self.assertEqual(decrypt_secret(key, 'sk-legacy'), 'sk-legacy')
+        with self.assertRaises(ValueError):
+            decrypt_secret(None, stored)
+
+class RouteTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        cls.server = herokuserver
+        cls.client = herokuserver.app.test_client()
+
+    def valid_token(self):
+        return patch.multiple(self.server, validate_token=lambda token: True, rate_limited=lambda token: False)
+
+class MissingKeyRoutesTest(RouteTestCase):
+    def test_classify_without_any_key_is_503_and_charges_nothing(self):
+        body = b'{"custom_id": "a", "body": {"messages": [{"role": "user", "content": "hi"}]}}\n'
+        with self.valid_token(), \
+                patch.object(self.server, 'load_user_key', return_value=None), \
+                patch.object(self.server.key_pool, 'pick', return_value=None), \
+                patch.object(self.server, 'charge_tokens') as charge_tokens:
+            response = self.client.post('/classify', data=io.BytesIO(body), headers={'User-Token': 'token_a'})
+        self.assertEqual(response.status_code, 503)
+        charge_tokens.assert_not_called()
+
+    def test_deleting_files_of_a_batch_whose_key_is_gone_is_409(self):
+        batch_job = {'id': 'batch_a', 'token': 'token_a', 'api_key_id': 'usr-gone', 'output_file_id': None,
+                     'openai_file_id': 'file-input'}
+        with self.valid_token(), \
+                patch.object(self.server, 'db_get_batch_job', return_value=batch_job), \
+                patch.object(self.server, 'db_get_api_key', return_value=None), \
+                patch.object(self.server, 'db_delete_batch_job') as db_delete_batch_job:
+            response = self.client.delete('/delete_batch_files/batch_a', headers={'User-Token': 'token_a'})
+        self.assertEqual(response.status_code, 409)
+        db_delete_batch_job.assert_not_called()
+
+class UserApiKeyRouteTest(RouteTestCase):
+    def set_key(self, secret='sk-new'):
+        return self.client.post('/user/api_key', json={'api_key': secret}, headers={'User-Token': 'token_a'})
+
+    def test_refused_without_an_encryption_key(self):
+        with self.valid_token(), patch.object(self.server, 'API_KEY_ENCRYPTION_KEY', None), \
+                patch.object(self.server, 'db_set_api_key') as db_set_api_key:
+            self.assertEqual(self.set_key().status_code, 501)
+        db_set_api_key.assert_not_called()
+
+    def test_key_rejected_by_openai_is_not_stored(self):
+        with self.valid_token(), patch.object(self.server, 'API_KEY_ENCRYPTION_KEY', encryption_key()), \
+                patch.object(self.server, 'validate_openai_key', return_value=False), \
+                patch.object(self.server, 'db_set_api_key') as db_set_api_key:
+            self.assertEqual(self.set_key().status_code, 400)
+        db_set_api_key.assert_not_called()
+        self.assertIsNone(self.server.key_pool.user_key_id('token_a'))
+
+    def test_validated_key_is_stored_and_used(self):
+        self.server.remember_without_own_key('token_b')
+        with self.valid_token(), patch.object(self.server, 'API_KEY_ENCRYPTION_KEY', encryption_key()), \
+                patch.object(self.server, 'validate_openai_key', return_value=True), \
+                patch.object(self.server, 'db_set_api_key') as db_set_api_key:
+            response = self.client.post('/user/api_key', json={'api_key': 'sk-valid'}, headers={'User-Token': 'token_b'})
+        self.assertEqual(response.status_code, 200)
+        key_id = response.get_json()['api_key_id']
+        db_set_api_key.assert_called_once_with('token_b', key_id, 'sk-valid')
+        self.assertEqual(self.server.key_pool.user_key_id('token_b'), key_id)
+        self.assertFalse(self.server.known_without_own_key('token_b'))
+        self.server.key_pool.remove_user_key('token_b')
+
+class OwnKeyLookupCacheTest(unittest.TestCase):
+    def test_lookups_are_bounded_and_expire(self):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        with patch.object(herokuserver, 'OWN_KEY_LOOKUP_CACHE_SIZE', 3), \
+                patch.object(herokuserver, 'tokens_without_own_key', OrderedDict()):
+            for token in ('token_1', 'token_2', 'token_3', 'token_4'):
+                herokuserver.remember_without_own_key(token)
+            self.assertFalse(herokuserver.known_without_own_key('token_1'))
+            self.assertTrue(herokuserver.known_without_own_key('token_4'))
+            self.assertEqual(len(herokuserver.tokens_without_own_key), 3)
+            with patch.object(herokuserver, 'OWN_KEY_LOOKUP_TTL_SECONDS', 0):
+                self.assertFalse(herokuserver.known_without_own_key('token_4'))
+
+@requires_postgres
+class StoredApiKeyTest(HerokuServerTestCase):
+    def test_keys_are_encrypted_at_rest(self):
+        server = self.server
+        with patch.object(server, 'API_KEY_ENCRYPTION_KEY', encryption_key()):
+            server.db_set_api_key('token_a', 'usr-a', 'sk-stored')
+            self.query("INSERT INTO api_keys (id, token, secret, created_at) VALUES ('usr-old', 'token_b', 'sk-plain', now())")
+            self.assertEqual(server.db_encrypt_api_keys(), 1)
+
+            stored = dict(self.query("SELECT id, secret FROM api_keys"))
+            self.assertNotIn('sk-', ''.join(stored.values()))
+            self.assertEqual(server.db_get_api_key(token='token_a')['secret'], 'sk-stored')
+            self.assertEqual(server.db_get_api_key(key_id='usr-old')['secret'], 'sk-plain')
+
+if __name__ == '__main__':
+    unittest.main()
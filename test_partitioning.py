@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime, timedelta
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+@requires_postgres
+class BatchLogsPartitioningMigrationTest(HerokuServerTestCase):
+    migrate = False
+
+    def migrate_to(self, version):
+        server = self.server
+        migrations, schema_version = server.MIGRATIONS, server.SCHEMA_VERSION
+        server.MIGRATIONS = [migration for migration in migrations if migration[0] <= version]
+        server.SCHEMA_VERSION = version
+        try:
+            server.init_db()
+        finally:
+            server.MIGRATIONS, server.SCHEMA_VERSION = migrations, schema_version
+
+    def test_existing_rows_from_this_month_survive_partitioning(self):
+        self.migrate_to(14)
+        now = datetime.now()
+        for timestamp in (now - timedelta(days=70), now - timedelta(days=40), now - timedelta(seconds=5), now):
+            self.query("INSERT INTO batch_logs (timestamp, batch_id, status) VALUES (%s, 'batch_a', 'in_progress')",
+                       (timestamp,))
+
+        self.migrate_to(15)
+
+        partitions = dict(self.query("SELECT tableoid::regclass::text, count(*) FROM batch_logs GROUP BY 1"))
+        this_month = f"batch_logs_y{now:%Y}m{now:%m}"
+        self.assertEqual(partitions.get(this_month), 2)
+        self.assertEqual(sum(partitions.values()), 4)
+        self.assertEqual(self.query("SELECT count(*) FROM batch_logs WHERE timestamp >= date_trunc('month', now())")[0][0], 2)
+        # New rows keep drawing ids from the old sequence
+        new_id = self.query("INSERT INTO batch_logs (timestamp, batch_id, status) VALUES (now(), 'batch_b', 'validating') RETURNING id")[0][0]
+        self.assertEqual(new_id, 5)
+
+@requires_postgres
+class BatchJobArchiveTest(HerokuServerTestCase):
+    def create_old_batch(self, batch_id, token):
+        self.server.db_create_batch_job(batch_id, 'validating', datetime.now() - timedelta(days=60), token, f'file-{batch_id}')
+        self.query("UPDATE batch_jobs SET status = 'failed', completed_at = %s WHERE id = %s",
+                   (datetime.now() - timedelta(days=45), batch_id))
+
+    def test_archive_and_view_survive_a_new_batch_jobs_column(self):
+        self.server.db_create_token('archive_token', 100, datetime.now() + timedelta(days=1))
+        self.create_old_batch('batch_before', 'archive_token')
+        self.assertEqual(self.server.db_archive_batch_jobs(datetime.now() - timedelta(days=30), 10), 1)
+
+        self.query("ALTER TABLE batch_jobs ADD COLUMN added_later TEXT")
+        self.create_old_batch('batch_after', 'archive_token')
+        self.assertEqual(self.server.db_archive_batch_jobs(datetime.now() - timedelta(days=30), 10), 1)
+
+        for batch_id in ('batch_before', 'batch_after'):
+            batch_job = self.server.db_get_batch_job(batch_id)
+            self.assertTrue(batch_job['archived'])
+            self.assertEqual(batch_job['status'], 'failed')
+        self.assertEqual(self.query("SELECT count(*) FROM batch_jobs WHERE token = 'archive_token'")[0][0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import threading
+import unittest
+
+from priority_executor import PriorityThreadPool
+
+class PriorityThreadPoolTest(unittest.TestCase):
+    def test_burst_after_idle_starts_enough_workers(self):
+        pool = PriorityThreadPool(max_workers=4)
+        pool.submit(0, lambda: None).result(timeout=2)  # Leaves one idle worker
+
+        # Each task waits for the other three, so they only finish if all four run at once
+        barrier = threading.Barrier(4, timeout=2)
+        futures = [pool.submit(0, barrier.wait) for _ in range(4)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(len(pool.threads), 4)
+
+    def test_queued_work_runs_by_priority_then_fifo(self):
+        pool = PriorityThreadPool(max_workers=1)
+        release = threading.Event()
+        pool.submit(0, release.wait)
+        order = []
+        futures = [pool.submit(priority, order.append, name)
+                   for priority, name in ((2, 'low'), (0, 'high'), (1, 'mid'), (0, 'high-later'))]
+        release.set()
+        for future in futures:
+            future.result(timeout=2)
+        self.assertEqual(order, ['high', 'high-later', 'mid', 'low'])
+
+    def test_exceptions_reach_the_future(self):
+        pool = PriorityThreadPool(max_workers=1)
+        future = pool.submit(0, lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(timeout=2)
+
+if __name__ == '__main__':
+    unittest.main()
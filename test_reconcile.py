@@ -0,0 +1,94 @@
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, assert_admin_only, requires_postgres
+
+def listed_batch(batch_id, status, created_at):
+    fields = {'id': batch_id, 'status': status, 'created_at': int(created_at.timestamp()), 'output_file_id': None,
+              'request_counts': SimpleNamespace(total=4, completed=1, failed=0), 'completed_at': None,
+              'expires_at': None, 'metadata': None}
+    batch = SimpleNamespace(**fields)
+    batch.model_dump = lambda: {**fields, 'request_counts': {'total': 4, 'completed': 1, 'failed': 0}}
+    return batch
+
+@requires_postgres
+class ReconcileTest(HerokuServerTestCase):
+    def setUp(self):
+        self.upstream = []  # Newest first, as batches.list returns them
+        self.list_calls = []
+        patchers = [patch.object(self.server, 'call_openai', self.call_openai),
+                    patch.object(self.server, 'BATCH_LIST_PAGE_SIZE', 2),
+                    patch.object(self.server.batch_logger, 'log_batch_status'),
+                    patch.object(self.server.webhook_dispatcher, 'notify')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call_openai(self, name, key_id, call, retry=False):
+        self.assertEqual(name, 'batches.list')
+        if key_id == 'broken-key':
+            raise ConnectionError('batches.list failed')
+        return call(SimpleNamespace(batches=SimpleNamespace(list=self.list_page)))
+
+    def list_page(self, limit, after=None):
+        self.list_calls.append(after)
+        start = 0 if after is None else [b.id for b in self.upstream].index(after) + 1
+        data = self.upstream[start:start + limit]
+        return SimpleNamespace(data=data, has_next_page=lambda: start + limit < len(self.upstream))
+
+    def test_paging_stops_once_every_wanted_batch_was_seen(self):
+        now = datetime.now().replace(microsecond=0)
+        self.upstream = [listed_batch(f'batch_{index}', 'in_progress', now - timedelta(minutes=index))
+                         for index in range(10)]
+        seen, pages, _ = self.server.list_key_batches('key', {'batch_1', 'batch_3'}, now - timedelta(minutes=3))
+        self.assertEqual(sorted(seen), ['batch_1', 'batch_3'])
+        self.assertEqual(pages, 2)
+
+    def test_paging_stops_past_the_oldest_wanted_batch(self):
+        now = datetime.now().replace(microsecond=0)
+        self.upstream = [listed_batch(f'batch_{index}', 'in_progress', now - timedelta(minutes=index))
+                         for index in range(10)]
+        seen, pages, covered_from = self.server.list_key_batches('key', {'batch_1', 'batch_gone'},
+                                                                  now - timedelta(minutes=2, seconds=30))
+        self.assertEqual((sorted(seen), pages), (['batch_1'], 2))
+        self.assertEqual(covered_from, now - timedelta(minutes=3))
+
+    def test_sweep_updates_listed_batches_and_flags_missing_ones(self):
+        server = self.server
+        server.db_create_token('sweep_token', 100, datetime.now() + timedelta(days=1))
+        now = datetime.now().replace(microsecond=0)
+        self.upstream = [listed_batch('batch_other', 'completed', now),
+                         listed_batch('batch_running', 'finalizing', now - timedelta(seconds=30)),
+                         listed_batch('batch_older', 'completed', now - timedelta(minutes=5))]
+        # Unfinished here: listed, gone from a listing that covered it, and under a key that
+        # could not be listed, which must not be taken for missing
+        for batch_id, created_at, key_id in (('batch_running', now - timedelta(seconds=30), None),
+                                             ('batch_vanished', now - timedelta(seconds=90), None),
+                                             ('batch_unlisted', now - timedelta(seconds=90), 'broken-key')):
+            server.db_create_batch_job(batch_id, 'in_progress', created_at, 'sweep_token', f'file-{batch_id}',
+                                       api_key_id=key_id)
+
+        result = server.reconcile_batch_jobs()
+
+        self.assertEqual((result['unfinished'], result['changed'], result['missing_upstream']),
+                         (3, 1, ['batch_vanished']))
+        self.assertEqual(server.db_get_batch_job('batch_running')['status'], 'finalizing')
+        flagged = dict(self.query("SELECT id, missing_upstream_at IS NOT NULL FROM batch_jobs"))
+        self.assertEqual(flagged, {'batch_running': False, 'batch_vanished': True, 'batch_unlisted': False})
+        self.assertEqual(self.list_calls, [None, 'batch_running'])
+
+        # A flagged batch is not paged back to on the next sweep
+        self.assertEqual(server.reconcile_batch_jobs()['unfinished'], 2)
+
+    def test_admin_route_requires_the_admin_token(self):
+        client = self.server.app.test_client()
+        with patch.object(self.server, 'reconcile_batch_jobs', return_value={'unfinished': 0}) as reconcile:
+            assert_admin_only(self, client, 'post', '/admin/reconcile_batches')
+            reconcile.assert_not_called()
+            response = client.post('/admin/reconcile_batches', headers={'Admin-Token': 'test-admin-token'})
+        self.assertEqual(response.get_json(), {'unfinished': 0})
+
+if __name__ == '__main__':
+    unittest.main()
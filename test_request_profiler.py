@@ -0,0 +1,105 @@
+import marshal
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from flask import Flask, Response
+
+import request_profiler
+
+ADMIN = {'Admin-Token': 'profiler-admin-token'}
+
+def busy_work():
+    return sum(i * i for i in range(20000))
+
+def slow_chunks():
+    for _ in range(3):
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            busy_work()
+        yield b'chunk\n'
+
+class RequestProfilerTest(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.dict(os.environ, {'ADMIN_TOKEN': ADMIN['Admin-Token']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        app = Flask(__name__)
+
+        @app.route('/work')
+        def work():
+            return str(busy_work())
+
+        @app.route('/stream')
+        def stream():
+            return Response(slow_chunks(), mimetype='text/plain')
+
+        @app.route('/fail')
+        def fail():
+            raise RuntimeError('boom')
+
+        app.config['PROPAGATE_EXCEPTIONS'] = True  # So failures reach the middleware
+        self.profiler = request_profiler.install(app, max_profiles=2, sample_interval=0.001)
+        self.client = app.test_client()
+
+    def profiled(self, path, mode='1', headers=ADMIN):
+        response = self.client.get(path, headers={'X-Profile': mode, **headers})
+        response.get_data()  # Streamed bodies are produced, and profiled, as they are read
+        response.close()
+        return response
+
+    def test_only_admin_requests_with_the_header_are_profiled(self):
+        self.assertNotIn('X-Profile-Id', self.client.get('/work').headers)
+        self.assertNotIn('X-Profile-Id', self.profiled('/work', headers={'Admin-Token': 'wrong'}).headers)
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 403)
+        self.assertEqual(self.client.get('/admin/profiles', headers=ADMIN).get_json(), {'profiles': []})
+
+    def test_unset_admin_token_admits_nobody(self):
+        with patch.dict(os.environ):
+            os.environ.pop('ADMIN_TOKEN')
+            self.assertFalse(request_profiler.is_admin_environ({}))
+            self.assertFalse(request_profiler.is_admin_environ({'HTTP_ADMIN_TOKEN': ''}))
+            self.assertEqual(self.client.get('/admin/profiles').status_code, 403)
+        self.assertTrue(request_profiler.is_admin_environ({'HTTP_ADMIN_TOKEN': ADMIN['Admin-Token']}))
+
+    def test_cprofile_results_can_be_fetched(self):
+        profile_id = self.profiled('/work').headers['X-Profile-Id']
+
+        summaries = self.client.get('/admin/profiles', headers=ADMIN).get_json()['profiles']
+        self.assertEqual([(s['id'], s['path'], s['status'], s['mode']) for s in summaries],
+                         [(profile_id, '/work', 200, 'cprofile')])
+        stats = marshal.loads(self.client.get(f'/admin/profiles/{profile_id}', headers=ADMIN).data)
+        self.assertIn('busy_work', {function for _, _, function in stats})
+        text = self.client.get(f'/admin/profiles/{profile_id}?format=text', headers=ADMIN)
+        self.assertIn(b'busy_work', text.data)
+        self.assertEqual(self.client.get(f'/admin/profiles/{profile_id}?format=collapsed', headers=ADMIN).status_code,
+                         400)
+        self.assertEqual(self.client.get('/admin/profiles/unknown', headers=ADMIN).status_code, 404)
+
+    def test_sampler_covers_the_streamed_body(self):
+        response = self.profiled('/stream', mode='sample')
+        self.assertEqual(response.data, b'chunk\n' * 3)
+        profile_id = response.headers['X-Profile-Id']
+        collapsed = self.client.get(f'/admin/profiles/{profile_id}', headers=ADMIN).data.decode()
+        self.assertIn('slow_chunks', collapsed)
+
+    def test_concurrent_cprofile_request_is_sampled_instead(self):
+        with self.profiler.cprofile_lock:
+            profile_id = self.profiled('/work').headers['X-Profile-Id']
+        self.assertEqual(self.profiler.get(profile_id).session.mode, 'sample')
+
+    def test_failed_request_releases_cprofile(self):
+        with self.assertRaises(RuntimeError):
+            self.profiled('/fail')
+        self.assertTrue(self.profiler.cprofile_lock.acquire(blocking=False))
+        self.profiler.cprofile_lock.release()
+
+    def test_oldest_profiles_are_dropped(self):
+        profile_ids = [self.profiled('/work').headers['X-Profile-Id'] for _ in range(3)]
+        summaries = self.client.get('/admin/profiles', headers=ADMIN).get_json()['profiles']
+        self.assertEqual([s['id'] for s in summaries], profile_ids[:0:-1])
+
+if __name__ == '__main__':
+    unittest.main()
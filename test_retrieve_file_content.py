@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+@requires_postgres
+class RetrieveFileContentTest(HerokuServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        server = cls.server
+        for token in ('owner_token', 'other_token'):
+            server.db_create_token(token, 100, datetime.now() + timedelta(days=1))
+        server.db_create_batch_job('batch_owned', 'completed', datetime.now(), 'owner_token', 'file-input', 'file-output')
+        content = tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        content.write('{"custom_id": "a"}\n')
+        content.close()
+        cls.content_path = content.name
+        cls.client = server.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.content_path)
+        super().tearDownClass()
+
+    def retrieve(self, file_id, token):
+        with patch.object(self.server, 'validate_token', return_value=True), \
+                patch.object(self.server.file_cache, 'get_or_fetch', return_value=self.content_path) as get_or_fetch:
+            response = self.client.get(f'/retrieve_file_content/{file_id}', headers={'User-Token': token})
+        return response, get_or_fetch
+
+    def test_owner_gets_the_output_file(self):
+        response, get_or_fetch = self.retrieve('file-output', 'owner_token')
+        self.assertEqual(response.status_code, 200)
+        get_or_fetch.assert_called_once()
+
+    def test_other_tokens_get_404_without_a_fetch(self):
+        for file_id in ('file-output', 'file-input', 'file-unknown'):
+            response, get_or_fetch = self.retrieve(file_id, 'other_token')
+            self.assertEqual(response.status_code, 404)
+            get_or_fetch.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+from signed_tokens import issue_token, is_signed_token, verify_token
+
+class SignedTokenTest(unittest.TestCase):
+    def test_round_trip(self):
+        expiry = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        token = issue_token('signing-key', 'abc_-123', expiry)
+        self.assertTrue(is_signed_token(token))
+        self.assertEqual(verify_token('signing-key', token), ('abc_-123', expiry))
+
+    def test_tampered_expired_and_foreign_tokens_fail(self):
+        expiry = datetime.now() + timedelta(hours=1)
+        token = issue_token('signing-key', 'abc', expiry)
+        version, token_id, expires_at, signature = token.split('.')
+        extended = '.'.join([version, token_id, str(int(expires_at) + 86400), signature])
+        self.assertIsNone(verify_token('signing-key', extended))
+        self.assertIsNone(verify_token('other-key', token))
+        self.assertIsNone(verify_token('signing-key', token, now=time.time() + 7200))
+        self.assertIsNone(verify_token('signing-key', token + 'x'))
+        self.assertIsNone(verify_token('signing-key', 'v1.abc.soon.sig'))
+
+    def test_opaque_tokens_are_not_signed_tokens(self):
+        self.assertFalse(is_signed_token('Xy3_kq-Zr8PwLm2tVb9nQg'))
+
+@requires_postgres
+class SignedTokenValidationTest(HerokuServerTestCase):
+    def test_signed_tokens_validate_without_the_database(self):
+        with patch.object(self.server, 'TOKEN_SIGNING_KEY', 'signing-key'):
+            token = self.server.create_token(10)
+            self.assertTrue(is_signed_token(token))
+            with patch.object(self.server, 'db_get_token', side_effect=AssertionError('database lookup')):
+                self.assertTrue(self.server.validate_token(token))
+                self.assertFalse(self.server.validate_token(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+
+        # Once the key is removed, the same token is looked up like an opaque one
+        with patch.object(self.server, 'TOKEN_SIGNING_KEY', None):
+            self.assertTrue(self.server.validate_token(token))
+
+    def test_signed_token_without_an_account_cannot_spend(self):
+        with patch.object(self.server, 'TOKEN_SIGNING_KEY', 'signing-key'):
+            token = self.server.create_token(10)
+            self.server.delete_token(token)
+            self.assertTrue(self.server.validate_token(token))
+            self.assertIsNone(self.server.charge_tokens(token, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+class LazyImportTest(unittest.TestCase):
+    def test_heavy_modules_are_imported_on_first_use(self):
+        # A fresh interpreter, since this one may already have them loaded
+        script = ("import sys, herokuserver; "
+                  "print(' '.join(m for m in ('openai', 'psycopg2', 'requests') if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env={**os.environ, 'ADMIN_TOKEN': 'test-admin-token'})
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.splitlines()[-1:], [''])
+
+@requires_postgres
+class MigrationTestCase(HerokuServerTestCase):
+    migrate = False
+
+    def applied(self):
+        return self.query("SELECT version, applied_at FROM schema_migrations ORDER BY version")
+
+class ConcurrentMigrationTest(MigrationTestCase):
+    def test_concurrent_startups_apply_each_migration_once(self):
+        errors = []
+
+        def boot():
+            try:
+                self.server.init_db()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=boot) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+
+        self.assertEqual(errors, [])
+        applied = self.applied()
+        self.assertEqual([version for version, _ in applied], [version for version, _ in self.server.MIGRATIONS])
+
+        # An up-to-date database is only read, never migrated again
+        with patch.object(self.server, 'MIGRATIONS', []):
+            self.server.init_db()
+        self.assertEqual(self.applied(), applied)
+
+class LegacySchemaMigrationTest(MigrationTestCase):
+    def test_database_from_before_the_migration_marker_keeps_its_rows(self):
+        # The three tables the old init_db created on every boot
+        self.query('''CREATE TABLE tokens (token TEXT PRIMARY KEY, amount INTEGER, used INTEGER, expiry TIMESTAMP);
+                      CREATE TABLE batch_jobs (id TEXT PRIMARY KEY, status TEXT, created_at TIMESTAMP, token TEXT,
+                                               openai_file_id TEXT, output_file_id TEXT);
+                      CREATE TABLE file_deletions (file_id TEXT PRIMARY KEY, batch_id TEXT, token TEXT, status TEXT,
+                                                   attempts INTEGER, last_error TEXT, updated_at TIMESTAMP)''')
+        self.query("INSERT INTO tokens VALUES ('old_token', 50, 10, %s)", (datetime.now() + timedelta(days=1),))
+        self.query("INSERT INTO batch_jobs VALUES ('batch_old', 'completed', %s, 'old_token', 'file-in', 'file-out')",
+                   (datetime.now(),))
+
+        self.server.init_db()
+
+        self.assertEqual(self.server.get_token_balance('old_token'), 50)
+        self.assertEqual(self.server.db_get_batch_job('batch_old')['status'], 'completed')
+        self.assertEqual(self.applied()[-1][0], self.server.SCHEMA_VERSION)
+
+if __name__ == '__main__':
+    unittest.main()
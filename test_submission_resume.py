@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+from test_token_stats import openai_batch
+
+@requires_postgres
+class CutOffSubmissionTest(HerokuServerTestCase):
+    def setUp(self):
+        server = self.server
+        server.db_create_token('resume_token', 100, datetime.now() + timedelta(days=1))
+        self.key_id = server.key_pool.add_server_key('sk-resume-test')
+        self.spool_dir = tempfile.mkdtemp()
+
+    def submission(self, submission_id, num_requests, spooled=True):
+        path = os.path.join(self.spool_dir, f'{submission_id}.jsonl')
+        if spooled:
+            with open(path, 'w') as spooled_file:
+                spooled_file.write('{}\n')
+        self.server.db_create_submission(submission_id, 'resume_token', f'{submission_id}.jsonl', path, num_requests, 50)
+        self.server.db_update_submission(submission_id, 'submitting', api_key_id=self.key_id)
+
+    def statuses(self):
+        return dict(self.query("SELECT id, status FROM batch_submissions"))
+
+    def test_cut_off_submissions_are_matched_upstream_before_being_sent_again(self):
+        server = self.server
+        self.submission('sub_created', 4)
+        self.submission('sub_never_sent', 5)
+        self.submission('sub_file_lost', 6, spooled=False)
+        # What run_submission charged for the three parts
+        server.charge_tokens('resume_token', 15)
+
+        created = openai_batch('batch_from_sub', 'in_progress')
+        created.created_at = int(datetime.now().timestamp()) + 1
+        created.input_file_id = 'file-input'
+        created.metadata = {'submission_id': 'sub_created'}
+        created.model_dump = lambda: {'id': created.id, 'status': created.status}
+        page = SimpleNamespace(data=[created], has_next_page=lambda: False)
+
+        with patch.object(server, 'enqueue_submission') as enqueue_submission, \
+                patch.object(server.submission_scheduler, 'load_in_flight'), \
+                patch.object(server.key_pool, 'load_in_flight'), \
+                patch.object(server, 'call_openai', return_value=page), \
+                patch.object(server.batch_logger, 'log_batch_status'), \
+                patch.object(server.batch_logger, 'log_batch_created'):
+            server.resume_submissions()
+            self.assertEqual(set(self.statuses().values()), {'reconciling'})
+            enqueue_submission.assert_not_called()
+
+            self.assertEqual(server.reconcile_submissions(), 3)
+
+        self.assertEqual(self.statuses(), {'sub_created': 'submitted', 'sub_never_sent': 'queued',
+                                           'sub_file_lost': 'failed'})
+        self.assertEqual(enqueue_submission.call_count, 1)
+        self.assertEqual(enqueue_submission.call_args.kwargs['submission_id'], 'sub_never_sent')
+        batch_job = server.db_get_batch_job('batch_from_sub')
+        self.assertEqual((batch_job['token'], batch_job['status'], batch_job['api_key_id']),
+                         ('resume_token', 'in_progress', self.key_id))
+        # Only the lost part is refunded
+        self.assertEqual(server.get_token_balance('resume_token'), 91)
+        self.assertFalse(os.path.exists(os.path.join(self.spool_dir, 'sub_created.jsonl')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import threading
+import unittest
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
+
+from pg_testing import assert_admin_only
+from submission_scheduler import FairScheduler, Submission
+
+def submission(submission_id, token='token_a', estimated_tokens=100):
+    return Submission(submission_id, token, 1, estimated_tokens, weight=1, max_in_flight=10)
+
+def started(submission):
+    future = Future()
+    future.set_result(submission.id)
+    return future
+
+class FairSchedulerTest(unittest.TestCase):
+    def test_waiting_submission_starts_when_a_key_frees_up_without_a_release(self):
+        # A key short of request rate frees up as its window slides, which nobody signals
+        key_has_room = threading.Event()
+        scheduler = FairScheduler(started, lambda s: 'key' if key_has_room.is_set() else None, retry_seconds=0.05)
+        future = scheduler.enqueue(submission('sub_rate_limited'))
+        self.assertFalse(future.done())
+
+        key_has_room.set()
+        self.assertEqual(future.result(timeout=2), 'sub_rate_limited')
+
+    def test_release_starts_the_next_submission(self):
+        room = {'tokens': 100}
+
+        def place(s):
+            if s.estimated_tokens > room['tokens']:
+                return None
+            room['tokens'] -= s.estimated_tokens
+            return 'key'
+
+        scheduler = FairScheduler(started, place, retry_seconds=60)
+        first = scheduler.enqueue(submission('sub_first'))
+        self.assertEqual(first.result(timeout=2), 'sub_first')
+        second = scheduler.enqueue(submission('sub_second'))
+        self.assertFalse(second.done())
+
+        room['tokens'] += 100
+        scheduler.release('token_a', 100)
+        self.assertEqual(second.result(timeout=2), 'sub_second')
+
+class ReleaseBatchBudgetTest(unittest.TestCase):
+    def test_key_is_released_before_the_scheduler_is_woken(self):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        calls = Mock()
+        with patch.object(herokuserver, 'db_release_batch_budget', return_value=('token_a', 100, 'srv-key')), \
+                patch.object(herokuserver.key_pool, 'release', calls.key_pool_release), \
+                patch.object(herokuserver.submission_scheduler, 'release', calls.scheduler_release):
+            herokuserver.release_batch_budget('batch_done')
+        self.assertEqual([call[0] for call in calls.mock_calls], ['key_pool_release', 'scheduler_release'])
+
+class SchedulerRouteTest(unittest.TestCase):
+    def test_scheduler_state_requires_the_admin_token(self):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        client = herokuserver.app.test_client()
+        assert_admin_only(self, client, 'get', '/admin/scheduler')
+        response = client.get('/admin/scheduler', headers={'Admin-Token': os.environ['ADMIN_TOKEN']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('api_keys', response.get_json())
+
+if __name__ == '__main__':
+    unittest.main()
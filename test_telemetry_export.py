@@ -0,0 +1,51 @@
+import io
+import unittest
+from datetime import datetime
+
+import telemetry_export
+from pg_testing import HerokuServerTestCase, assert_admin_only, requires_postgres
+
+@requires_postgres
+class ExportQueryTest(HerokuServerTestCase):
+    def setUp(self):
+        self.pa = telemetry_export.load_pyarrow()
+        if self.pa is None:
+            self.skipTest('pyarrow is not installed')
+        self.connections = []
+
+    def connect(self):
+        conn = self.server.get_db_connection()
+        self.connections.append(conn)
+        return conn
+
+    def test_connection_is_opened_by_the_stream_and_closed_with_it(self):
+        for index in range(3):
+            self.query("INSERT INTO batch_logs (timestamp, batch_id, status) VALUES (%s, %s, 'completed')",
+                       (datetime.now(), f'batch_{index}'))
+
+        unread = telemetry_export.export_query(self.pa, self.connect, 'batch_logs', 'arrow')
+        self.assertEqual(self.connections, [])
+        unread.close()
+
+        chunks = telemetry_export.export_query(self.pa, self.connect, 'batch_logs', 'arrow')
+        first = next(chunks)
+        self.assertEqual(len(self.connections), 1)
+        chunks.close()
+        self.assertTrue(self.connections[0].closed)
+
+        body = b''.join(telemetry_export.export_query(self.pa, self.connect, 'batch_logs', 'arrow'))
+        self.assertTrue(body.startswith(first))
+        table = self.pa.ipc.open_stream(io.BytesIO(body)).read_all()
+        self.assertEqual(sorted(table.column('batch_id').to_pylist()), ['batch_0', 'batch_1', 'batch_2'])
+
+@requires_postgres
+class ExportRouteTest(HerokuServerTestCase):
+    def test_export_requires_the_admin_token(self):
+        client = self.server.app.test_client()
+        for table in telemetry_export.EXPORT_TABLES:
+            assert_admin_only(self, client, 'get', f'/admin/export/{table}?format=arrow')
+        response = client.get('/admin/export/api_keys', headers={'Admin-Token': 'test-admin-token'})
+        self.assertEqual(response.status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
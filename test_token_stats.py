@@ -0,0 +1,95 @@
+import time
+import unittest
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+REFRESHERS = 8
+
+def openai_batch(batch_id, status):
+    return SimpleNamespace(id=batch_id, status=status, output_file_id='file-output' if status == 'completed' else None,
+                           request_counts=SimpleNamespace(total=4, completed=4 if status == 'completed' else 0, failed=0),
+                           completed_at=int(time.time()) if status == 'completed' else None,
+                           expires_at=int(time.time()) + 86400)
+
+@requires_postgres
+class BatchEndCountedOnceTest(HerokuServerTestCase):
+    # Status polls, the webhook refresher and the reconciler can all see the same batch finish
+    def setUp(self):
+        self.token = f"stats_{self.id().rsplit('.', 1)[-1]}"
+        self.server.db_create_token(self.token, 100, datetime.now() + timedelta(days=1))
+
+    def create_batch(self, batch_id):
+        self.server.db_create_batch_job(batch_id, 'in_progress', datetime.now(), self.token, f'file-{batch_id}',
+                                        num_requests=4)
+
+    def stats(self):
+        return self.query("SELECT active_batches, completed_batches, failed_batches FROM token_stats WHERE token = %s",
+                          (self.token,))[0]
+
+    def run_together(self, calls):
+        barrier = threading.Barrier(len(calls))
+        results = [None] * len(calls)
+
+        def run(index, call):
+            barrier.wait()
+            results[index] = call()
+
+        threads = [threading.Thread(target=run, args=(index, call)) for index, call in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_refreshes_count_completion_once(self):
+        self.create_batch('batch_refreshes')
+        completed = openai_batch('batch_refreshes', 'completed')
+        results = self.run_together([lambda: self.server.db_update_batch_progress('batch_refreshes', completed)] * REFRESHERS)
+
+        self.assertEqual(self.stats(), (0, 1, 0))
+        previous_statuses = [previous_status for _, previous_status in results]
+        self.assertEqual(previous_statuses.count('in_progress'), 1)
+        self.assertEqual(previous_statuses.count('completed'), REFRESHERS - 1)
+
+    def test_refresh_racing_reconcile_counts_completion_once(self):
+        self.create_batch('batch_race')
+        completed = openai_batch('batch_race', 'completed')
+        snapshot = self.server.batch_progress_snapshot(completed)
+        calls = [lambda: self.server.db_update_batch_progress('batch_race', completed),
+                 lambda: self.server.db_reconcile_batch_jobs([snapshot], [])] * (REFRESHERS // 2)
+        results = self.run_together(calls)
+
+        self.assertEqual(self.stats(), (0, 1, 0))
+        transitions = [previous for _, previous in results[0::2]] + [changed[0][2] for changed, _ in results[1::2] if changed]
+        self.assertEqual(transitions.count('in_progress'), 1)
+
+    def test_batch_missing_upstream_counts_as_failed_until_seen_again(self):
+        self.create_batch('batch_missing')
+        changed, flagged = self.server.db_reconcile_batch_jobs([], ['batch_missing'])
+        self.assertEqual(flagged, ['batch_missing'])
+        self.assertEqual(self.stats(), (0, 0, 1))
+        # Flagging again changes nothing
+        self.server.db_reconcile_batch_jobs([], ['batch_missing'])
+        self.assertEqual(self.stats(), (0, 0, 1))
+
+        # Listed again, still running: back to active
+        running = self.server.batch_progress_snapshot(openai_batch('batch_missing', 'in_progress'))
+        self.server.db_reconcile_batch_jobs([running], [])
+        self.assertEqual(self.stats(), (1, 0, 0))
+
+        # Flagged, then a status request finds it completed: moves from failed to completed
+        self.server.db_reconcile_batch_jobs([], ['batch_missing'])
+        self.server.db_update_batch_progress('batch_missing', openai_batch('batch_missing', 'completed'))
+        self.assertEqual(self.stats(), (0, 1, 0))
+
+    def test_deleting_a_missing_batch_leaves_active_alone(self):
+        self.create_batch('batch_deleted')
+        self.server.db_reconcile_batch_jobs([], ['batch_deleted'])
+        self.server.db_delete_batch_job('batch_deleted')
+        self.assertEqual(self.stats(), (0, 0, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import gzip
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from pg_testing import HerokuServerTestCase, requires_postgres
+
+def jsonl(lines):
+    return b''.join(b'{"custom_id": "r%d", "method": "POST", "url": "/v1/chat/completions", '
+                    b'"body": {"messages": [{"role": "user", "content": "hi"}]}}\n' % i for i in range(lines))
+
+@requires_postgres
+class UploadTestCase(HerokuServerTestCase):
+    def setUp(self):
+        self.token = f"upload_{self.id().rsplit('.', 1)[-1]}"
+        self.server.db_create_token(self.token, 100, datetime.now() + timedelta(days=1))
+        self.client = self.server.app.test_client()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def upload(self, *parts):
+        data = {'file': [(io.BytesIO(content), name) for name, content in parts]}
+        with patch.object(self.server, 'validate_token', return_value=True), \
+                patch.object(self.server, 'rate_limited', return_value=False), \
+                patch.object(self.server, 'SUBMISSION_SPOOL_DIR', self.spool_dir):
+            return self.client.post('/upload_jsonl', data=data, content_type='multipart/form-data',
+                                    headers={'User-Token': self.token})
+
+class UploadRefundTest(UploadTestCase):
+    def test_parts_that_cannot_be_queued_are_refunded(self):
+        with patch.object(self.server, 'db_create_submission', side_effect=RuntimeError('database is down')):
+            response = self.upload(('a.jsonl', jsonl(3)), ('b.jsonl', jsonl(4)))
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(response.get_json()['errors']), 2)
+        self.assertEqual(self.server.get_token_balance(self.token), 100)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+class MultiFileUploadTest(UploadTestCase):
+    def test_every_part_is_validated_before_anything_is_charged(self):
+        with patch.object(self.server, 'enqueue_submission') as enqueue_submission:
+            response = self.upload(('good.jsonl', jsonl(3)), ('bad.txt', jsonl(1)))
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.get_json()['error'].startswith('bad.txt: '))
+        enqueue_submission.assert_not_called()
+        self.assertEqual(self.server.get_token_balance(self.token), 100)
+
+    def test_too_many_parts_are_refused(self):
+        parts = [(f'part{i}.jsonl', jsonl(1)) for i in range(self.server.MAX_FILES_PER_UPLOAD + 1)]
+        self.assertEqual(self.upload(*parts).status_code, 400)
+
+    def test_each_part_becomes_its_own_batch(self):
+        self.server.key_pool.add_server_key('sk-upload-test')
+        submitted = []
+
+        def submit_jsonl_file(file, user_token, submission):
+            submitted.append((file.filename, file.read().count(b'\n')))
+            batch = SimpleNamespace(id=f'batch_{submission.filename}', status='validating')
+            return batch, {'id': f'file-{submission.filename}'}
+
+        with patch.object(self.server, 'submit_jsonl_file', submit_jsonl_file), \
+                patch.object(self.server.batch_logger, 'log_batch_created'):
+            response = self.upload(('a.jsonl', jsonl(3)), ('b.jsonl', jsonl(4)))
+
+        self.assertEqual(response.status_code, 202)
+        body = response.get_json()
+        self.assertEqual(sorted(batch['batch_id'] for batch in body['batches']), ['batch_a.jsonl', 'batch_b.jsonl'])
+        self.assertEqual((body['total_requests'], body['remaining_balance'], body['errors']), (7, 93, []))
+        self.assertEqual(sorted(submitted), [('a.jsonl', 3), ('b.jsonl', 4)])
+
+    def test_compressed_parts_are_decoded_before_validation(self):
+        with patch.object(self.server, 'enqueue_submission') as enqueue_submission:
+            response = self.upload(('a.jsonl.gz', gzip.compress(jsonl(3))), ('b.txt.gz', gzip.compress(jsonl(1))))
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.get_json()['error'].startswith('b.txt.gz: '))
+        enqueue_submission.assert_not_called()
+
+        submitted = []
+
+        def submit_jsonl_file(file, user_token, submission):
+            submitted.append((file.filename, file.read().count(b'\n')))
+            return SimpleNamespace(id=f'batch_{submission.filename}', status='validating'), {'id': 'file-a'}
+
+        self.server.key_pool.add_server_key('sk-upload-test')
+        with patch.object(self.server, 'submit_jsonl_file', submit_jsonl_file), \
+                patch.object(self.server.batch_logger, 'log_batch_created'):
+            response = self.upload(('a.jsonl.gz', gzip.compress(jsonl(3))))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['total_requests'], 3)
+        self.assertEqual(submitted, [('a.jsonl.gz', 3)])
+
+if __name__ == '__main__':
+    unittest.main()
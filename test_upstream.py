@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from pg_testing import assert_admin_only
+from upstream import CircuitBreaker, CircuitOpenError, Upstream, UpstreamError, is_transient
+
+class Flaky:
+    # fn(timeout) for Upstream.call that raises the given errors in turn, then returns 'ok'
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, timeout):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+class UpstreamTest(unittest.TestCase):
+    def upstream(self, **kwargs):
+        return Upstream({'default': 1}, base_delay=0.001, max_delay=0.002, **kwargs)
+
+    def test_transient_failures_are_retried_for_idempotent_calls(self):
+        upstream = self.upstream()
+        fn = Flaky(TimeoutError(), UpstreamError('busy', status_code=503))
+        self.assertEqual(upstream.call('batches.retrieve', 'key', fn, retry=True), 'ok')
+        self.assertEqual(fn.calls, 3)
+        self.assertEqual(upstream.snapshot()['operations']['batches.retrieve']['retries'], 2)
+
+        # Not retried: non-idempotent calls, and answers that are not brownouts
+        with self.assertRaises(TimeoutError):
+            upstream.call('batches.create', 'key', Flaky(TimeoutError()))
+        fn = Flaky(UpstreamError('no such batch', status_code=404))
+        with self.assertRaises(UpstreamError):
+            upstream.call('batches.retrieve', 'key', fn, retry=True)
+        self.assertEqual(fn.calls, 1)
+
+    def test_breaker_opens_and_stops_retries(self):
+        upstream = self.upstream(failure_threshold=2, max_attempts=5)
+        fn = Flaky(*[ConnectionError()] * 5)
+        with self.assertRaises(ConnectionError):
+            upstream.call('batches.retrieve', 'key', fn, retry=True)
+        self.assertEqual(fn.calls, 2)
+        with self.assertRaises(CircuitOpenError):
+            upstream.call('batches.retrieve', 'key', fn, retry=True)
+        self.assertEqual(fn.calls, 2)
+        # Breakers are per key
+        self.assertEqual(upstream.call('batches.retrieve', 'other-key', Flaky()), 'ok')
+        snapshot = upstream.snapshot()
+        self.assertEqual(snapshot['breakers']['key']['state'], 'open')
+        self.assertEqual(snapshot['operations']['batches.retrieve']['short_circuited'], 1)
+
+    def test_slow_attempt_is_hedged(self):
+        upstream = self.upstream(hedge_min_delay=0.05)
+        release = threading.Event()
+        calls = []
+
+        def fn(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                release.wait(2)
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual(upstream.call('files.list', 'key', fn, hedge=True), 'fast')
+        release.set()
+        stats = upstream.snapshot()['operations']['files.list']
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_fast_attempt_is_not_hedged(self):
+        upstream = self.upstream(hedge_min_delay=1)
+        fn = Flaky()
+        self.assertEqual(upstream.call('files.list', 'key', fn, hedge=True), 'ok')
+        self.assertEqual((fn.calls, upstream.snapshot()['operations']['files.list']['hedges']), (1, 0))
+
+class CircuitBreakerTest(unittest.TestCase):
+    def open_breaker(self):
+        breaker = CircuitBreaker('key', failure_threshold=1, reset_seconds=30)
+        breaker.record(TimeoutError())
+        return breaker
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = self.open_breaker()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        self.assertGreater(breaker.retry_after(), 0)
+
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 31):
+            self.assertEqual(breaker.retry_after(), 0)
+            breaker.before_call()  # The probe
+            with self.assertRaises(CircuitOpenError):
+                breaker.before_call()
+            # A probe that never got an answer frees the slot for the next one
+            breaker.release_probe()
+            breaker.before_call()
+        breaker.record()
+        self.assertEqual(breaker.snapshot()['state'], 'closed')
+        breaker.before_call()
+
+    def test_failed_probe_reopens(self):
+        breaker = self.open_breaker()
+        with patch.object(time, 'monotonic', return_value=time.monotonic() + 31):
+            breaker.before_call()
+            breaker.record(ConnectionError())
+            self.assertTrue(breaker.is_open())
+        self.assertEqual(breaker.snapshot()['times_opened'], 2)
+
+    def test_non_transient_errors_do_not_count(self):
+        breaker = CircuitBreaker('key', failure_threshold=1, reset_seconds=30)
+        breaker.record(UpstreamError('bad request', status_code=400))
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(is_transient(UpstreamError('rate limited', status_code=429)))
+        self.assertFalse(is_transient(ValueError('bad input')))
+
+class UpstreamRouteTest(unittest.TestCase):
+    def test_upstream_state_requires_the_admin_token(self):
+        os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+        import herokuserver
+        client = herokuserver.app.test_client()
+        assert_admin_only(self, client, 'get', '/admin/upstream')
+        response = client.get('/admin/upstream', headers={'Admin-Token': os.environ['ADMIN_TOKEN']})
+        self.assertEqual(response.get_json(), herokuserver.upstream.snapshot())
+
+if __name__ == '__main__':
+    unittest.main()
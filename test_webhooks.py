@@ -0,0 +1,195 @@
+import http.server
+import json
+import socket
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import webhooks
+from pg_testing import HerokuServerTestCase, requires_postgres
+from webhooks import WebhookDispatcher
+
+def resolver(hosts):
+    # Stands in for socket.getaddrinfo, answering from hosts ({hostname: [address, ...]})
+    def getaddrinfo(host, port, type=0):
+        if host not in hosts:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, port))
+                for address in hosts[host]]
+    return getaddrinfo
+
+def finished_batch(batch_id):
+    return {'id': batch_id, 'status': 'completed', 'request_counts': {'total': 2, 'completed': 2, 'failed': 0},
+            'output_file_id': 'file-output', 'created_at': 1700000000, 'completed_at': 1700000600}
+
+class SignatureTest(unittest.TestCase):
+    def test_signature_covers_body_and_timestamp(self):
+        timestamp = str(int(time.time()))
+        signature = webhooks.sign_payload('secret', timestamp, b'{"a":1}')
+        self.assertTrue(webhooks.verify_signature('secret', timestamp, b'{"a":1}', signature))
+        self.assertFalse(webhooks.verify_signature('secret', timestamp, b'{"a":2}', signature))
+        self.assertFalse(webhooks.verify_signature('other', timestamp, b'{"a":1}', signature))
+        self.assertFalse(webhooks.verify_signature('secret', str(int(timestamp) + 1), b'{"a":1}', signature))
+        self.assertFalse(webhooks.verify_signature('secret', timestamp, b'{"a":1}', None))
+
+    def test_stale_timestamps_are_rejected(self):
+        stale = str(int(time.time()) - webhooks.SIGNATURE_TOLERANCE_SECONDS - 10)
+        signature = webhooks.sign_payload('secret', stale, b'{}')
+        self.assertFalse(webhooks.verify_signature('secret', stale, b'{}', signature))
+        self.assertFalse(webhooks.verify_signature('secret', 'not-a-time', b'{}', signature))
+
+class WebhookUrlTest(unittest.TestCase):
+    def test_private_and_internal_addresses_are_rejected(self):
+        for url in ('http://127.0.0.1/hook', 'http://10.1.2.3/hook', 'http://192.168.0.1/hook',
+                    'http://169.254.169.254/latest/meta-data/', 'http://[::1]:8080/hook', 'http://[::ffff:127.0.0.1]/',
+                    'http://0.0.0.0/', 'http://100.64.0.1/', 'http://224.0.0.1/', 'ftp://example.test/hook',
+                    'https:///hook', 'https://example.test:99999/', None):
+            with self.subTest(url=url), self.assertRaises(webhooks.UnsafeWebhookURL):
+                webhooks.resolve_webhook_url(url)
+
+    def test_every_resolved_address_must_be_public(self):
+        hosts = {'public.test': ['93.184.216.34', '2606:2800:220:1::1'], 'mixed.test': ['93.184.216.34', '10.0.0.8'],
+                 'internal.test': ['172.16.5.4']}
+        with patch.object(webhooks.socket, 'getaddrinfo', resolver(hosts)):
+            self.assertEqual(webhooks.resolve_webhook_url('https://public.test/hook'), '93.184.216.34')
+            for host in ('mixed.test', 'internal.test', 'unknown.test'):
+                with self.subTest(host=host), self.assertRaises(webhooks.UnsafeWebhookURL):
+                    webhooks.resolve_webhook_url(f'https://{host}/hook')
+
+class PostToAddressTest(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        received = self.received
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append((self.path, self.headers['Host'], self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(302)
+                self.send_header('Location', '/elsewhere')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def test_request_goes_to_the_checked_address_and_is_not_redirected(self):
+        port = self.httpd.server_address[1]
+        # The hostname does not resolve at all: only the pinned address is ever connected to
+        response = webhooks.post_to_address(f'http://hooks.invalid:{port}/hook?x=1', '127.0.0.1', b'{}',
+                                            {'Content-Type': 'application/json'}, 5)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.received, [('/hook?x=1', f'hooks.invalid:{port}', b'{}')])
+
+@requires_postgres
+class WebhookDispatcherTest(HerokuServerTestCase):
+    def setUp(self):
+        self.token = f"hook_{self.id().rsplit('.', 1)[-1]}"
+        self.dispatcher = WebhookDispatcher()
+        self.dispatcher.DATABASE_URL = self.database_url
+        self.posts = []
+        self.status_codes = []
+        self.hosts = {'example.test': ['93.184.216.34']}
+        patcher = patch.object(webhooks.socket, 'getaddrinfo', resolver(self.hosts))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, url, address, data, headers, timeout):
+        self.posts.append((url, data, headers))
+        self.assertEqual(address, self.hosts['example.test'][0])
+        return SimpleNamespace(status_code=self.status_codes.pop(0) if self.status_codes else 200)
+
+    def notify(self, batch):
+        with patch.object(webhooks, 'post_to_address', self.post), patch.object(webhooks.threading, 'Timer') as timer:
+            self.dispatcher.notify(self.token, batch)
+            self.dispatcher.queue.join()
+        return timer
+
+    def delivery(self, webhook_id, batch_id):
+        return self.query("SELECT status, attempts FROM webhook_deliveries WHERE webhook_id = %s AND batch_id = %s",
+                          (webhook_id, batch_id))[0]
+
+    def test_each_matching_webhook_gets_one_signed_delivery(self):
+        self.server.db_create_webhook('wh_all', self.token, None, 'https://example.test/all', 'secret-all')
+        self.server.db_create_webhook('wh_one', self.token, 'batch_one', 'https://example.test/one', 'secret-one')
+        self.server.db_create_webhook('wh_other', self.token, 'batch_other', 'https://example.test/other', 'x')
+
+        self.notify(finished_batch('batch_one'))
+        # A second refresh seeing the same batch finish must not deliver again
+        self.notify(finished_batch('batch_one'))
+
+        self.assertEqual(sorted(url for url, _, _ in self.posts), ['https://example.test/all', 'https://example.test/one'])
+        for url, body, headers in self.posts:
+            secret = 'secret-all' if url.endswith('/all') else 'secret-one'
+            self.assertTrue(webhooks.verify_signature(secret, headers[webhooks.TIMESTAMP_HEADER], body,
+                                                      headers[webhooks.SIGNATURE_HEADER]))
+            self.assertEqual(json.loads(body)['event'], 'batch.completed')
+        self.assertEqual(self.delivery('wh_all', 'batch_one'), ('delivered', 1))
+
+    def test_failed_delivery_is_retried_with_backoff_then_given_up(self):
+        self.server.db_create_webhook('wh_flaky', self.token, None, 'https://example.test/flaky', 'secret')
+        self.status_codes = [500]
+        timer = self.notify(finished_batch('batch_flaky'))
+
+        self.assertEqual(self.delivery('wh_flaky', 'batch_flaky'), ('retrying', 1))
+        self.assertEqual(timer.call_args.args[0], self.dispatcher.retry_base_seconds)
+        task, args = timer.call_args.kwargs['args'][0]
+        self.assertEqual(args[-1], 2)
+
+        self.status_codes = [503]
+        with patch.object(webhooks, 'post_to_address', self.post), patch.object(webhooks.threading, 'Timer') as timer:
+            self.dispatcher._deliver(*args[:-1], self.dispatcher.max_attempts)
+        timer.assert_not_called()
+        self.assertEqual(self.delivery('wh_flaky', 'batch_flaky'), ('failed', self.dispatcher.max_attempts))
+
+    def test_host_that_now_resolves_privately_is_not_called(self):
+        self.server.db_create_webhook('wh_rebound', self.token, None, 'https://rebound.test/hook', 'secret')
+        self.hosts['rebound.test'] = ['169.254.169.254']
+        self.notify(finished_batch('batch_rebound'))
+        self.assertEqual(self.posts, [])
+        self.assertEqual(self.delivery('wh_rebound', 'batch_rebound'), ('retrying', 1))
+
+    def test_pending_deliveries_resume_after_a_restart(self):
+        self.server.db_create_webhook('wh_resumed', self.token, None, 'https://example.test/resumed', 'secret')
+        self.query("""INSERT INTO webhook_deliveries (webhook_id, batch_id, status, attempts, payload, updated_at)
+                      VALUES ('wh_resumed', 'batch_resumed', 'retrying', 2, '{}', %s)""", (datetime.now(),))
+        self.query("""INSERT INTO webhook_deliveries (webhook_id, batch_id, status, attempts, payload, updated_at)
+                      VALUES ('wh_resumed', 'batch_done', 'delivered', 1, '{}', %s)""", (datetime.now(),))
+
+        with patch.object(webhooks, 'post_to_address', self.post):
+            self.dispatcher.resume_pending()
+            self.dispatcher.queue.join()
+
+        self.assertEqual(len(self.posts), 1)
+        self.assertEqual(self.delivery('wh_resumed', 'batch_resumed'), ('delivered', 3))
+
+    def test_webhooks_can_only_watch_the_tokens_own_batches(self):
+        for token in (self.token, 'stranger_token'):
+            self.server.db_create_token(token, 100, datetime.now() + timedelta(days=1))
+        self.server.db_create_batch_job('batch_watched', 'in_progress', datetime.now(), self.token, 'file-in')
+        client = self.server.app.test_client()
+
+        def register(token, **data):
+            with patch.object(self.server, 'validate_token', return_value=True):
+                return client.post('/webhooks', json=data, headers={'User-Token': token})
+
+        self.assertEqual(register('stranger_token', url='https://example.test', batch_id='batch_watched').status_code, 403)
+        self.assertEqual(register(self.token, url='ftp://example.test').status_code, 400)
+        self.hosts['intranet.test'] = ['10.0.0.8']
+        for url in ('http://127.0.0.1:5000/admin', 'http://169.254.169.254/latest/meta-data/',
+                    'https://intranet.test/hook', 'https://unresolvable.test/hook'):
+            self.assertEqual(register(self.token, url=url).status_code, 400)
+        self.assertEqual(self.server.db_get_user_webhooks(self.token), [])
+        response = register(self.token, url='https://example.test', batch_id='batch_watched')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.get_json()['secret'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import time
+import random
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    # A failed upstream call that didn't come from the OpenAI SDK, e.g. the raw file upload
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"OpenAI is unavailable for key {name}; retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+def is_transient(error):
+    # Timeouts, dropped connections, rate limiting and 5xx: worth retrying and counted by the
+    # breaker. Anything else (a 404, a bad request) is the caller's answer, not a brownout.
+    if isinstance(error, (CircuitOpenError, TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code in (408, 409, 429) or status_code >= 500
+    import requests  # Deferred like the other HTTP client imports
+    from openai import APIConnectionError  # Also covers APITimeoutError
+    return isinstance(error, (APIConnectionError, requests.ConnectionError, requests.Timeout))
+
+class CircuitBreaker:
+    # Closed until failure_threshold transient failures in a row, then open (calls fail fast)
+    # for reset_seconds, then half-open: one probe call decides whether it closes or reopens.
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.times_opened = 0
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + self.reset_seconds - time.monotonic()
+            if self.state == 'open' and retry_after <= 0:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return
+            raise CircuitOpenError(self.name, max(retry_after, 1))
+
+    def is_open(self):
+        with self.lock:
+            return self.state == 'open'
+
+    def release_probe(self):
+        # For a call let through by before_call() that never got an answer, so another probe may go
+        with self.lock:
+            self.probing = False
+
+    def retry_after(self):
+        # Seconds until before_call() lets a call through again; 0 once it would
+        with self.lock:
+            if self.state != 'open':
+                return 0
+            return max(self.opened_at + self.reset_seconds - time.monotonic(), 0)
+
+    def record(self, error=None):
+        with self.lock:
+            probing, self.probing = self.probing, False
+            if error is None or not is_transient(error):
+                if self.state != 'closed':
+                    logger.info(f"Circuit for key {self.name} closed")
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if probing or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                    logger.warning(f"Circuit for key {self.name} opened after {self.failures} failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {'state': self.state, 'consecutive_failures': self.failures,
+                        'times_opened': self.times_opened}
+            if self.state != 'closed':
+                snapshot['retry_in_seconds'] = round(max(self.opened_at + self.reset_seconds - time.monotonic(), 0), 1)
+            return snapshot
+
+class OperationStats:
+    # Counters and recent latencies for one operation, e.g. batches.retrieve
+    def __init__(self, latency_window):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuited = 0
+        self.latencies = deque(maxlen=latency_window)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def snapshot(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'short_circuited': self.short_circuited,
+            'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+class Upstream:
+    # Resilience layer for calls to OpenAI. Each call gets its operation's timeout and goes
+    # through the circuit breaker of the API key it uses; idempotent calls are retried with
+    # decorrelated jitter, and hedged calls send a second attempt when the first is slower
+    # than the operation's recent p95.
+    def __init__(self, timeouts, max_attempts=3, base_delay=0.2, max_delay=5.0,
+                 failure_threshold=5, reset_seconds=30, hedge_min_delay=0.5, hedge_workers=8,
+                 latency_window=200):
+        self.timeouts = timeouts  # operation -> seconds; 'default' for the rest
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge_min_delay = hedge_min_delay
+        self.latency_window = latency_window
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.stats = {}
+        self.hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='upstream_hedge')
+
+    def breaker(self, name):
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_seconds)
+            return self.breakers[name]
+
+    def _stats(self, operation):
+        with self.lock:
+            if operation not in self.stats:
+                self.stats[operation] = OperationStats(self.latency_window)
+            return self.stats[operation]
+
+    def call(self, operation, name, fn, retry=False, hedge=False):
+        # fn(timeout) makes the call; name is the API key it goes through. Only pass retry or
+        # hedge for idempotent calls, since a timed-out attempt may still land upstream.
+        timeout = self.timeouts.get(operation, self.timeouts['default'])
+        breaker = self.breaker(name)
+        stats = self._stats(operation)
+        attempts = self.max_attempts if retry else 1
+        delay = self.base_delay
+        with self.lock:
+            stats.calls += 1
+        for attempt in range(1, attempts + 1):
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                with self.lock:
+                    stats.short_circuited += 1
+                raise
+            try:
+                if hedge:
+                    result = self._hedged(stats, breaker, fn, timeout)
+                else:
+                    result = self._timed(stats, breaker, fn, timeout)
+                return result
+            except Exception as e:
+                # No point waiting to retry once this failure has opened the breaker
+                if attempt == attempts or not is_transient(e) or breaker.is_open():
+                    with self.lock:
+                        stats.failures += 1
+                    raise
+                # Decorrelated jitter: spreads retries out without lockstep waves across callers
+                delay = min(self.max_delay, random.uniform(self.base_delay, delay * 3))
+                logger.warning(f"OpenAI {operation} failed ({str(e)}); retry {attempt} in {delay:.2f} seconds")
+                with self.lock:
+                    stats.retries += 1
+                time.sleep(delay)
+
+    def _timed(self, stats, breaker, fn, timeout):
+        started = time.monotonic()
+        try:
+            result = fn(timeout)
+        except Exception as e:
+            breaker.record(e)
+            raise
+        breaker.record()
+        with self.lock:
+            stats.latencies.append(time.monotonic() - started)
+        return result
+
+    def _hedged(self, stats, breaker, fn, timeout):
+        # The first answer wins; the slower attempt is left to finish on its own
+        with self.lock:
+            p95 = stats.percentile(0.95)
+        hedge_delay = max(p95 or 0, self.hedge_min_delay)
+        first = self.hedge_executor.submit(self._timed, stats, breaker, fn, timeout)
+        done, _ = wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+        with self.lock:
+            stats.hedges += 1
+        second = self.hedge_executor.submit(self._timed, stats, breaker, fn, timeout)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self.lock:
+                            stats.hedge_wins += 1
+                    return future.result()
+        # Both failed: report the original attempt's error
+        return first.result()
+
+    def snapshot(self):
+        with self.lock:
+            breakers = dict(self.breakers)
+            operations = {operation: entry.snapshot() for operation, entry in self.stats.items()}
+        return {
+            'breakers': {name: breaker.snapshot() for name, breaker in breakers.items()},
+            'operations': operations,
+        }
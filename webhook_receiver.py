@@ -0,0 +1,42 @@
+from flask import Flask, request, jsonify
+import os
+import json
+import logging
+from webhooks import verify_signature, SIGNATURE_HEADER, TIMESTAMP_HEADER
+
+# Local receiver for batch completion webhooks, for checking deliveries offline.
+#
+#   WEBHOOK_SECRET=<secret from POST /webhooks> python webhook_receiver.py
+#   curl -X POST localhost:5000/webhooks -H "User-Token: ..." -d '{"url": "http://localhost:5001/hook"}'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# Every verified delivery, newest last
+received = []
+
+@app.route('/hook', methods=['POST'])
+def receive():
+    body = request.get_data()
+    if WEBHOOK_SECRET and not verify_signature(WEBHOOK_SECRET, request.headers.get(TIMESTAMP_HEADER),
+                                               body, request.headers.get(SIGNATURE_HEADER)):
+        logger.warning("Rejected webhook with an invalid signature")
+        return jsonify({'error': 'Invalid signature'}), 401
+
+    payload = json.loads(body)
+    received.append(payload)
+    logger.info(f"Received {payload['event']} for batch {payload['batch_id']}: {payload['request_counts']}")
+    return jsonify({'received': True}), 200
+
+@app.route('/hook', methods=['GET'])
+def list_received():
+    return jsonify({'received': received}), 200
+
+if __name__ == '__main__':
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set; signatures will not be checked")
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5001)))
@@ -0,0 +1,235 @@
+import hmac
+import json
+import time
+import queue
+import hashlib
+import threading
+import os
+import socket
+import logging
+import ipaddress
+import urllib.parse
+import db_instrumentation
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+WEBHOOKS_DDL = [
+    # batch_id is NULL for webhooks that cover every batch of the token
+    '''CREATE TABLE IF NOT EXISTS webhooks (
+        id TEXT PRIMARY KEY,
+        token TEXT,
+        batch_id TEXT,
+        url TEXT,
+        secret TEXT,
+        created_at TIMESTAMP
+    )''',
+    'CREATE INDEX IF NOT EXISTS webhooks_token_idx ON webhooks (token)',
+    # One row per webhook and batch, so a terminal state is only ever delivered once
+    '''CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        webhook_id TEXT,
+        batch_id TEXT,
+        status TEXT,
+        attempts INTEGER,
+        last_error TEXT,
+        payload TEXT,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (webhook_id, batch_id)
+    )''',
+]
+
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+TIMESTAMP_HEADER = 'X-Webhook-Timestamp'
+SIGNATURE_TOLERANCE_SECONDS = 300
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 5
+DELIVERY_TIMEOUT_SECONDS = 10
+
+class UnsafeWebhookURL(ValueError):
+    # The URL is not http(s), or its host resolves to an address the server must not call
+    pass
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])  # Drop an IPv6 zone index
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # is_global already excludes loopback, private, link-local (169.254.169.254) and shared ranges
+    return ip.is_global and not (ip.is_multicast or ip.is_reserved)
+
+def resolve_webhook_url(url):
+    # Returns the address to deliver to. Every address the host resolves to must be public,
+    # so a webhook cannot reach the server's own network or the cloud metadata service.
+    parts = urllib.parse.urlsplit(url) if isinstance(url, str) else None
+    if not parts or parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnsafeWebhookURL('url must be an http(s) URL')
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        addresses = [info[4][0] for info in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)]
+    except ValueError:
+        raise UnsafeWebhookURL('url has an invalid port')
+    except (OSError, UnicodeError):
+        raise UnsafeWebhookURL(f"Could not resolve {parts.hostname}")
+    if not addresses or not all(is_public_address(address) for address in addresses):
+        raise UnsafeWebhookURL(f"{parts.hostname} does not resolve to a public address")
+    return addresses[0]
+
+def post_to_address(url, address, data, headers, timeout):
+    # POSTs to url over a connection to address, the one resolve_webhook_url checked, so a DNS
+    # answer that changes after the check cannot point the request elsewhere. The Host header,
+    # SNI and certificate check still use the URL's hostname. Redirects are not followed.
+    import requests  # Deferred with the other HTTP clients
+    from requests.adapters import HTTPAdapter
+    parts = urllib.parse.urlsplit(url)
+    host = f"[{address}]" if ':' in address else address
+    pinned_url = urllib.parse.urlunsplit(parts._replace(netloc=host if parts.port is None else f"{host}:{parts.port}"))
+    adapter = HTTPAdapter()
+    adapter.poolmanager.connection_pool_kw.update(server_hostname=parts.hostname, assert_hostname=parts.hostname)
+    with requests.Session() as session:
+        session.trust_env = False  # An environment proxy would resolve the hostname again
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        auth = (parts.username, parts.password or '') if parts.username else None
+        return session.post(pinned_url, data=data, headers={**headers, 'Host': parts.netloc.rsplit('@', 1)[-1]},
+                            auth=auth, timeout=timeout, allow_redirects=False)
+
+def sign_payload(secret, timestamp, body):
+    # The timestamp is signed with the body so a captured request cannot be replayed later
+    message = f"{timestamp}.".encode() + body
+    return 'sha256=' + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def verify_signature(secret, timestamp, body, signature, tolerance=SIGNATURE_TOLERANCE_SECONDS):
+    # For receivers: body is the raw request body, timestamp and signature the headers above
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature or '')
+
+def build_payload(batch):
+    # Compact summary of a finished batch; the full status stays available from /batches/<id>
+    counts = batch['request_counts']
+    return {
+        'event': f"batch.{batch['status']}",
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'request_counts': {'total': counts['total'], 'completed': counts['completed'], 'failed': counts['failed']},
+        'output_file_id': batch.get('output_file_id'),
+        'error_file_id': batch.get('error_file_id'),
+        'created_at': batch.get('created_at'),
+        'completed_at': batch.get('completed_at') or batch.get('failed_at') or batch.get('expired_at')
+                        or batch.get('cancelled_at'),
+    }
+
+class WebhookDispatcher:
+    # Delivers batch completion callbacks from a background thread, retrying failed
+    # deliveries with exponential backoff. Deliveries are recorded in webhook_deliveries
+    # so pending ones survive a restart (see resume_pending).
+    def __init__(self, max_attempts=MAX_ATTEMPTS, retry_base_seconds=RETRY_BASE_SECONDS):
+        self.queue = queue.Queue()
+        self.worker_thread = None
+        self.start_lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.DATABASE_URL = os.environ.get('DATABASE_URL')
+
+    def _connect(self):
+        import psycopg2  # Deferred so importing this module stays cheap
+        return db_instrumentation.connect(psycopg2.connect, self.DATABASE_URL)
+
+    def _ensure_worker(self):
+        if self.worker_thread is not None:
+            return
+        with self.start_lock:
+            if self.worker_thread is None:
+                self.worker_thread = threading.Thread(target=self._worker, daemon=True)
+                self.worker_thread.start()
+
+    def notify(self, token, batch):
+        # Called when a batch reaches a terminal state; batch is its OpenAI status as a dict
+        self._ensure_worker()
+        self.queue.put((self._schedule, (token, batch)))
+
+    def resume_pending(self):
+        # Re-queue deliveries that were still pending or retrying when the server stopped
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('''SELECT d.webhook_id, d.batch_id, w.url, w.secret, d.payload, d.attempts
+                     FROM webhook_deliveries d JOIN webhooks w ON w.id = d.webhook_id
+                     WHERE d.status IN ('pending', 'retrying')''')
+        rows = c.fetchall()
+        conn.close()
+        if rows:
+            self._ensure_worker()
+        for webhook_id, batch_id, url, secret, payload, attempts in rows:
+            self.queue.put((self._deliver, (webhook_id, batch_id, url, secret, payload, attempts + 1)))
+        logger.info(f"Resumed {len(rows)} pending webhook deliveries")
+
+    def _worker(self):
+        while True:
+            task, args = self.queue.get()
+            try:
+                task(*args)
+            except Exception as e:
+                logger.error(f"Webhook task failed for {args[:2]}: {str(e)}")
+            self.queue.task_done()
+
+    def _schedule(self, token, batch):
+        payload = json.dumps(build_payload(batch), separators=(',', ':'))
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('''SELECT id, url, secret FROM webhooks
+                     WHERE token = %s AND (batch_id IS NULL OR batch_id = %s)''', (token, batch['id']))
+        deliveries = []
+        for webhook_id, url, secret in c.fetchall():
+            c.execute('''INSERT INTO webhook_deliveries (webhook_id, batch_id, status, attempts, payload, updated_at)
+                         VALUES (%s, %s, 'pending', 0, %s, %s)
+                         ON CONFLICT (webhook_id, batch_id) DO NOTHING
+                         RETURNING webhook_id''', (webhook_id, batch['id'], payload, datetime.now()))
+            if c.fetchone():
+                deliveries.append((webhook_id, url, secret))
+        conn.commit()
+        conn.close()
+        for webhook_id, url, secret in deliveries:
+            self._deliver(webhook_id, batch['id'], url, secret, payload, 1)
+
+    def _deliver(self, webhook_id, batch_id, url, secret, payload, attempt):
+        import requests  # Deferred with the other HTTP clients
+        body = payload.encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign_payload(secret, timestamp, body),
+        }
+        try:
+            # Checked again on every attempt: the host may resolve elsewhere than at registration
+            address = resolve_webhook_url(url)
+            response = post_to_address(url, address, body, headers, DELIVERY_TIMEOUT_SECONDS)
+            error = None if 200 <= response.status_code < 300 else f"HTTP {response.status_code}"
+        except (UnsafeWebhookURL, requests.RequestException) as e:
+            error = str(e)
+
+        if error is None:
+            logger.info(f"Delivered webhook {webhook_id} for batch {batch_id} on attempt {attempt}")
+            self._update_delivery(webhook_id, batch_id, 'delivered', attempt)
+        elif attempt < self.max_attempts:
+            delay = self.retry_base_seconds * 2 ** (attempt - 1)
+            logger.warning(f"Webhook {webhook_id} for batch {batch_id} failed ({error}); retrying in {delay}s")
+            self._update_delivery(webhook_id, batch_id, 'retrying', attempt, error)
+            timer = threading.Timer(delay, self.queue.put,
+                                    args=((self._deliver, (webhook_id, batch_id, url, secret, payload, attempt + 1)),))
+            timer.daemon = True
+            timer.start()
+        else:
+            logger.error(f"Giving up on webhook {webhook_id} for batch {batch_id} after {attempt} attempts: {error}")
+            self._update_delivery(webhook_id, batch_id, 'failed', attempt, error)
+
+    def _update_delivery(self, webhook_id, batch_id, status, attempts, last_error=None):
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute('''UPDATE webhook_deliveries SET status = %s, attempts = %s, last_error = %s, updated_at = %s
+                     WHERE webhook_id = %s AND batch_id = %s''',
+                  (status, attempts, last_error, datetime.now(), webhook_id, batch_id))
+        conn.commit()
+        conn.close()